@@ -0,0 +1,464 @@
+#!/usr/bin/env python3
+"""
+CPU Pipeline Benchmark
+prepare_data -> training steps -> evaluation -> demo generation on a tiny Qwen2
+
+Runs the real project code end to end without a GPU, unsloth or network:
+
+- prepare: training/prepare_data.py streaming pipeline (near-dup clustering,
+  hash split) on the first BENCH_SAMPLES generated samples, then the token
+  cache with the tokenizer files in trained_model/
+- train: a randomly initialized Qwen2 (TINY_MODEL) with LoRA on
+  TARGET_MODULES, BucketingTrainerMixin + transformers.Trainer (SFTTrainer
+  needs unsloth/Triton), packed rows, response-only loss, TrainingProfiler
+- evaluate: evaluate_model.py perplexity (token cache) and batched
+  generate_responses
+- demo: demo/scheduler.py continuous batching, every demo example
+  submitted at once with the adapter on and off and streamed (the Gradio
+  app's CPU + PEFT path); request latency and time to first token are
+  measured from the common submit time
+
+Every stage runs in a fresh process, so its peak RSS is its own. Stages
+pass artifacts (data, base model, adapter) through a temporary directory.
+The pipeline runs REPEATS times (each pass in its own directory) and every
+metric is reported as the median over the passes.
+The report is JSON: environment, config and per-stage metrics. Metrics
+named *_per_sec are better when higher; *_seconds, *_ms and *_mb are better
+when lower; anything else is informational. Demo token counts are
+measured by re-tokenizing the decoded text.
+
+Usage:
+    python benchmarks/benchmark_pipeline.py                    # compare with baseline.json
+    python benchmarks/benchmark_pipeline.py --update-baseline  # record a new baseline
+    python benchmarks/benchmark_pipeline.py --stages prepare train
+
+Exits non-zero if a metric regressed by more than the relative tolerance
+and by more than its absolute floor (ABSOLUTE_FLOORS: a 1s wobble on a 3s
+stage is timer and scheduler noise, not a regression; a rate is held to
+the floor of the stage time it was measured over). Baselines
+only mean something on the machine class they were recorded on; the
+environment block is compared and a mismatch is reported.
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import multiprocessing
+import platform
+import resource
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+from pathlib import Path
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+sys.path[:0] = [str(REPO_ROOT / "training"), str(REPO_ROOT / "demo")]
+
+BASELINE_FILE = Path(__file__).resolve().parent / "baseline.json"
+OUTPUT_FILE = Path("./benchmark_results.json")
+INPUT_FILE = REPO_ROOT / "generated_data" / "synthetic_geriatric_data (2).jsonl"
+TOKENIZER_DIR = REPO_ROOT / "trained_model"
+STAGES = ("prepare", "train", "evaluate", "demo")
+
+# Workload
+BENCH_SAMPLES = 10_000  # Input lines fed to prepare_data
+SEED = 42
+TINY_MODEL = dict(hidden_size=64, intermediate_size=128, num_hidden_layers=2,
+                  num_attention_heads=4, num_key_value_heads=2, tie_word_embeddings=True)
+MAX_SEQ_LENGTH = 256
+BATCH_SIZE = 4
+TRAIN_STEPS = 6  # The first step is reported separately (warmup)
+LORA_R = 8
+LORA_ALPHA = 16
+TARGET_MODULES = ["q_proj", "k_proj", "v_proj", "o_proj", "gate_proj", "up_proj", "down_proj"]
+EVAL_SAMPLES = 32  # Perplexity samples
+GEN_SAMPLES = 16  # Prompts for evaluate_model.generate_responses
+GEN_BATCH_SIZE = 8
+MAX_NEW_TOKENS = 32  # Per generation (evaluate and demo)
+
+# Allowed relative slowdown / growth before a metric counts as a regression
+TIME_TOLERANCE = 0.30
+MEMORY_TOLERANCE = 0.15
+# ...and the absolute change it must also exceed, by metric suffix. A rate <stage>_*_per_sec
+# uses the change of its <stage>_seconds (the same work timed), or is relative only without one
+ABSOLUTE_FLOORS = {"_seconds": 2.0, "_ms": 100.0, "_mb": 64.0}
+REPEATS = 3  # Pipeline passes; metrics are the median over passes
+
+
+# --- helpers ----------------------------------------------------------
+
+def peak_rss_mb():
+    # ru_maxrss is KiB on Linux, bytes on macOS
+    unit = 1 if sys.platform == "darwin" else 1024
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * unit / 2**20, 1)
+
+
+def environment():
+    import torch
+    import transformers
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "processor": platform.processor() or platform.machine(),
+        "cpus": multiprocessing.cpu_count(),
+        "torch": torch.__version__,
+        "transformers": transformers.__version__,
+        "torch_threads": torch.get_num_threads(),
+    }
+
+
+def load_tokenizer():
+    from transformers import AutoTokenizer
+    return AutoTokenizer.from_pretrained(str(TOKENIZER_DIR))
+
+
+def load_token_cache(workdir, tokenizer):
+    from prepare_data import ALPACA_PROMPT
+    from token_cache import cache_key, load_token_cache as load_cache
+    return load_cache(workdir / "data", cache_key(TOKENIZER_DIR, ALPACA_PROMPT), tokenizer)
+
+
+def load_adapted_model(workdir):
+    """Base weights + LoRA adapter, as the demo's CPU fallback loads them."""
+    from peft import PeftModel
+    from transformers import AutoModelForCausalLM
+    base = AutoModelForCausalLM.from_pretrained(str(workdir / "base"), dtype="float32")
+    model = PeftModel.from_pretrained(base, str(workdir / "adapter"))
+    model.eval()
+    return model
+
+
+def count_tokens(tokenizer, texts):
+    return sum(len(ids) for ids in tokenizer(list(texts), add_special_tokens=False)["input_ids"])
+
+
+# --- stages -----------------------------------------------------------
+
+def stage_prepare(workdir):
+    import prepare_data
+    from prepare_data import ALPACA_PROMPT
+    from token_cache import build_token_cache, cache_key
+
+    source = workdir / "input.jsonl"
+    with open(INPUT_FILE, "rb") as f, open(source, "wb") as out:
+        for i, line in enumerate(f):
+            if i >= BENCH_SAMPLES:
+                break
+            out.write(line)
+
+    start = time.perf_counter()
+    totals = prepare_data.prepare_streaming(source, workdir / "data", workers=1)
+    prepare_seconds = time.perf_counter() - start
+
+    tokenizer = load_tokenizer()
+    start = time.perf_counter()
+    cache_dir = build_token_cache(workdir / "data", tokenizer, cache_key(TOKENIZER_DIR, ALPACA_PROMPT), ALPACA_PROMPT)
+    tokenize_seconds = time.perf_counter() - start
+    with open(cache_dir / "meta.json") as f:
+        tokens = sum(json.load(f)["tokens"].values())
+
+    return {
+        "input_samples": BENCH_SAMPLES,
+        "kept_samples": totals["train"] + totals["validation"],
+        "prepare_seconds": round(prepare_seconds, 3),
+        "prepare_samples_per_sec": round(BENCH_SAMPLES / prepare_seconds, 1),
+        "tokenize_seconds": round(tokenize_seconds, 3),
+        "tokenize_tokens_per_sec": round(tokens / tokenize_seconds, 1),
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def stage_train(workdir):
+    import torch
+    from peft import LoraConfig, get_peft_model
+    from transformers import Qwen2Config, Qwen2ForCausalLM, Trainer, TrainingArguments
+    from packing import BucketingTrainerMixin, PackedCollator, pack_dataset
+    from profiler import TrainingProfiler
+
+    class BenchmarkTrainer(BucketingTrainerMixin, Trainer):
+        pass
+
+    start = time.perf_counter()
+    tokenizer = load_tokenizer()
+    cached = load_token_cache(workdir, tokenizer)
+    torch.manual_seed(SEED)
+    base = Qwen2ForCausalLM(Qwen2Config(vocab_size=len(tokenizer), max_position_embeddings=MAX_SEQ_LENGTH * 2,
+                                        eos_token_id=tokenizer.eos_token_id, pad_token_id=tokenizer.pad_token_id,
+                                        **TINY_MODEL))
+    base.save_pretrained(str(workdir / "base"))
+    model = get_peft_model(base, LoraConfig(r=LORA_R, lora_alpha=LORA_ALPHA, lora_dropout=0.05,
+                                            target_modules=TARGET_MODULES, bias="none", task_type="CAUSAL_LM"))
+    train_dataset = pack_dataset(cached["train"], MAX_SEQ_LENGTH)
+    args = TrainingArguments(
+        output_dir=str(workdir / "trainer"),
+        per_device_train_batch_size=BATCH_SIZE,
+        max_steps=TRAIN_STEPS,
+        learning_rate=2e-4,
+        logging_steps=TRAIN_STEPS,
+        save_strategy="no",
+        eval_strategy="no",
+        report_to="none",
+        remove_unused_columns=False,
+        use_cpu=True,
+        dataloader_num_workers=0,
+        seed=SEED,
+    )
+    trainer = BenchmarkTrainer(model=model, args=args, train_dataset=train_dataset,
+                               data_collator=PackedCollator(tokenizer.pad_token_id, MAX_SEQ_LENGTH, True))
+    profiler = TrainingProfiler(workdir / "profile", counters=trainer.token_counts, tensorboard=False)
+    trainer.add_callback(profiler)
+    setup_seconds = time.perf_counter() - start
+
+    trainer.train()
+    model.save_pretrained(str(workdir / "adapter"))
+    summary = profiler.summary()
+    return {
+        "setup_seconds": round(setup_seconds, 3),
+        "first_step_seconds": profiler.steps[0]["step_time"],
+        "step_seconds": round(summary["mean_step_time"], 4),
+        "train_seconds": round(summary["mean_step_time"] * summary["steps"], 3),
+        "train_samples_per_sec": round(summary["samples_per_sec"], 2),
+        "train_tokens_per_sec": round(summary["tokens_per_sec"], 1),
+        "dataloader_share": summary["share"]["dataloader_wait"],
+        "final_loss": next((round(h["loss"], 4) for h in reversed(trainer.state.log_history) if "loss" in h), None),
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def stage_evaluate(workdir):
+    import torch
+    from datasets import load_dataset
+    import evaluate_model
+
+    start = time.perf_counter()
+    tokenizer = load_tokenizer()
+    model = load_adapted_model(workdir)
+    evaluate_model.stop_string_criteria(tokenizer)  # Built once per run
+    load_seconds = time.perf_counter() - start
+    dataset = load_dataset("json", data_files={"validation": str(workdir / "data" / "validation.jsonl")})["validation"]
+    cached = load_token_cache(workdir, tokenizer)
+
+    start = time.perf_counter()
+    perplexity = evaluate_model.calculate_perplexity(model, tokenizer, dataset, max_samples=EVAL_SAMPLES,
+                                                     token_dataset=cached["validation"])
+    perplexity_seconds = time.perf_counter() - start
+
+    torch.manual_seed(SEED)
+    prompts = [evaluate_model.extract_instruction_input(dataset[i]["text"]) for i in range(min(GEN_SAMPLES, len(dataset)))]
+    start = time.perf_counter()
+    results = evaluate_model.generate_responses(model, tokenizer, prompts, GEN_BATCH_SIZE, MAX_NEW_TOKENS)
+    generate_seconds = time.perf_counter() - start
+
+    return {
+        "load_seconds": round(load_seconds, 3),
+        "perplexity_seconds": round(perplexity_seconds, 3),
+        "perplexity_samples_per_sec": round(min(EVAL_SAMPLES, len(dataset)) / perplexity_seconds, 2),
+        "perplexity": round(perplexity, 2),
+        "generate_seconds": round(generate_seconds, 3),
+        "generate_samples_per_sec": round(len(prompts) / generate_seconds, 2),
+        "generate_tokens_per_sec": round(sum(r["tokens"] for r in results) / generate_seconds, 1),
+        "generate_p50_ms": round(statistics.median(r["latency"] for r in results) * 1000, 1),
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def stage_demo(workdir):
+    import torch
+    from generation import EXAMPLES, build_prompt
+    from scheduler import ContinuousBatcher
+
+    start = time.perf_counter()
+    tokenizer = load_tokenizer()
+    model = load_adapted_model(workdir)
+    load_seconds = time.perf_counter() - start
+
+    # Every example arrives at once, both panes each, like concurrent users
+    torch.manual_seed(SEED)
+    scheduler = ContinuousBatcher(model, tokenizer, max_new_tokens=MAX_NEW_TOKENS)
+    latencies = []
+    start = time.perf_counter()
+    futures = []
+    for instruction, patient_context in EXAMPLES:
+        prompt = build_prompt(instruction, patient_context)
+        for adapter in (True, False):  # Zima pane, then the base pane
+            future = scheduler.submit(prompt, adapter, on_text=lambda piece: None)  # Streamed, as in the app
+            future.add_done_callback(lambda _: latencies.append(time.perf_counter() - start))
+            futures.append(future)
+    completions = [future.result() for future in futures]
+    wall = time.perf_counter() - start
+    scheduler.close()
+    outputs = [c.text for c in completions]
+    inter_token = [gap for c in completions for gap in c.inter_token]
+
+    return {
+        "load_seconds": round(load_seconds, 3),
+        "requests": len(latencies),
+        "request_p50_ms": round(statistics.median(latencies) * 1000, 1),
+        "request_max_ms": round(max(latencies) * 1000, 1),
+        "ttft_p50_ms": round(statistics.median(c.ttft for c in completions) * 1000, 1),
+        "inter_token_p50_ms": round(statistics.median(inter_token) * 1000, 1),
+        "demo_seconds": round(wall, 3),
+        "demo_tokens_per_sec": round(count_tokens(tokenizer, outputs) / wall, 1),
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+STAGE_FUNCTIONS = {"prepare": stage_prepare, "train": stage_train, "evaluate": stage_evaluate, "demo": stage_demo}
+
+
+def _run_stage(name, workdir, verbose):
+    """Stage body in the worker process (output and progress bars dropped unless verbose)."""
+    if verbose:
+        return STAGE_FUNCTIONS[name](workdir)
+    with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+        return STAGE_FUNCTIONS[name](workdir)
+
+
+def median_metrics(runs):
+    """Per-metric median over repeated runs of one stage (None if no run reported it)."""
+    metrics = {}
+    for metric in runs[0]:
+        values = [run[metric] for run in runs if run.get(metric) is not None]
+        metrics[metric] = round(statistics.median(values), 4) if values else None
+    return metrics
+
+
+def run_stage(name, workdir, verbose=False):
+    """Run one stage in a fresh spawned process; returns its metrics and wall time."""
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as pool:
+        metrics = pool.submit(_run_stage, name, workdir, verbose).result()
+    metrics["wall_seconds"] = round(time.perf_counter() - start, 3)  # Includes interpreter + import time
+    return metrics
+
+
+# --- baseline comparison ---------------------------------------------
+
+def direction(metric):
+    """+1 if higher is better, -1 if lower is better, 0 if informational."""
+    if metric.endswith("_per_sec"):
+        return 1
+    if metric.endswith(("_seconds", "_ms", "_mb")):
+        return -1
+    return 0
+
+
+def beyond_floor(metric, metrics, previous):
+    """Did `metric` move by more than its absolute floor (see ABSOLUTE_FLOORS)?"""
+    if metric.endswith("_per_sec"):
+        metric = metric.split("_")[0] + "_seconds"
+        if metrics.get(metric) is None or not previous.get(metric):
+            return True
+    floor = next((f for suffix, f in ABSOLUTE_FLOORS.items() if metric.endswith(suffix)), 0.0)
+    return abs(metrics[metric] - previous[metric]) > floor
+
+
+def compare(report, baseline, time_tolerance=TIME_TOLERANCE, memory_tolerance=MEMORY_TOLERANCE):
+    """Rows of (stage, metric, baseline, current, change, regressed) for comparable metrics."""
+    rows = []
+    for stage, metrics in report["stages"].items():
+        previous = baseline.get("stages", {}).get(stage, {})
+        for metric, value in metrics.items():
+            sign = direction(metric)
+            old = previous.get(metric)
+            if sign == 0 or not old or value is None:
+                continue
+            change = (value - old) / old
+            tolerance = memory_tolerance if metric.endswith("_mb") else time_tolerance
+            regressed = -sign * change > tolerance and beyond_floor(metric, metrics, previous)
+            rows.append((stage, metric, old, value, change, regressed))
+    return rows
+
+
+def print_comparison(rows):
+    print(f"\n{'stage':<10} {'metric':<28} {'baseline':>12} {'current':>12} {'change':>8}")
+    print("-" * 74)
+    for stage, metric, old, value, change, regressed in rows:
+        flag = "  ❌" if regressed else ""
+        print(f"{stage:<10} {metric:<28} {old:>12,.2f} {value:>12,.2f} {change:>+7.1%}{flag}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="CPU benchmark of the prepare/train/evaluate/demo pipeline")
+    parser.add_argument("--stages", nargs="+", choices=STAGES, default=list(STAGES),
+                        help="Stages to run (later stages need the artifacts of earlier ones)")
+    parser.add_argument("--output", default=str(OUTPUT_FILE), help="Where to write the JSON report")
+    parser.add_argument("--baseline", default=str(BASELINE_FILE))
+    parser.add_argument("--update-baseline", action="store_true", help="Store this run as the baseline")
+    parser.add_argument("--workdir", help="Keep artifacts here instead of a temporary directory")
+    parser.add_argument("--time-tolerance", type=float, default=TIME_TOLERANCE)
+    parser.add_argument("--memory-tolerance", type=float, default=MEMORY_TOLERANCE)
+    parser.add_argument("--repeats", type=int, default=REPEATS, help="Pipeline passes to take the median over")
+    parser.add_argument("--verbose", action="store_true", help="Show the stages' own output")
+    args = parser.parse_args()
+
+    stages = [s for s in STAGES if s in args.stages]
+    workdir = Path(args.workdir) if args.workdir else Path(tempfile.mkdtemp(prefix="zima_bench_"))
+    workdir.mkdir(parents=True, exist_ok=True)
+
+    print("=" * 70)
+    print("ZIMA PIPELINE BENCHMARK (CPU, tiny Qwen2)")
+    print("=" * 70)
+    report = {
+        "created": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "environment": environment(),
+        "config": {
+            "bench_samples": BENCH_SAMPLES, "tiny_model": TINY_MODEL, "max_seq_length": MAX_SEQ_LENGTH,
+            "batch_size": BATCH_SIZE, "train_steps": TRAIN_STEPS, "lora_r": LORA_R,
+            "eval_samples": EVAL_SAMPLES, "gen_samples": GEN_SAMPLES, "gen_batch_size": GEN_BATCH_SIZE,
+            "max_new_tokens": MAX_NEW_TOKENS,
+        },
+        "repeats": args.repeats,
+        "stages": {},
+    }
+    runs = {stage: [] for stage in stages}
+    try:
+        for repeat in range(args.repeats):
+            (workdir / f"pass{repeat}").mkdir(exist_ok=True)
+            for stage in stages:
+                print(f"\n⏱️  {stage} (pass {repeat + 1}/{args.repeats})...")
+                metrics = run_stage(stage, workdir / f"pass{repeat}", args.verbose)
+                runs[stage].append(metrics)
+                print("   " + ", ".join(f"{k}={v}" for k, v in metrics.items()))
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    report["stages"] = {stage: median_metrics(stage_runs) for stage, stage_runs in runs.items()}
+    Path(args.output).write_text(json.dumps(report, indent=2))
+    print(f"\n💾 Report: {args.output}")
+
+    baseline_path = Path(args.baseline)
+    if args.update_baseline:
+        baseline_path.write_text(json.dumps(report, indent=2) + "\n")
+        print(f"📌 Baseline updated: {baseline_path}")
+        return
+    if not baseline_path.exists():
+        print(f"⚠️  No baseline at {baseline_path}; run with --update-baseline to record one")
+        return
+
+    baseline = json.loads(baseline_path.read_text())
+    if baseline.get("config") != report["config"]:
+        print("⚠️  Baseline was recorded with a different workload config; comparison is approximate")
+    changed = [k for k in ("cpus", "processor", "torch", "transformers")
+               if baseline.get("environment", {}).get(k) != report["environment"][k]]
+    if changed:
+        print(f"⚠️  Environment differs from the baseline ({', '.join(changed)}); expect noise")
+    rows = compare(report, baseline, args.time_tolerance, args.memory_tolerance)
+    print_comparison(rows)
+    regressions = [r for r in rows if r[-1]]
+    if regressions:
+        floors = ", ".join(f"*{suffix} {floor:g}" for suffix, floor in ABSOLUTE_FLOORS.items())
+        raise SystemExit(f"\n{len(regressions)} metric(s) regressed beyond tolerance "
+                         f"(time {args.time_tolerance:.0%}, memory {args.memory_tolerance:.0%}; "
+                         f"absolute floors {floors})")
+    print(f"\n✅ No regressions against {baseline_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+"""
+Adaptive Batch-Size and Token-Budget Controller
+===============================================
+
+Tunes the two knobs of every generation call to maximize valid samples
+per GPU-second:
+
+- batch_size: samples requested per call (the system prompt is rebuilt
+  to match, see `build_system_prompt` in data_creation_lightning.py)
+- max_tokens: completion budget, sized from the observed tokens per valid
+  sample times a safety headroom
+
+Truncated (finish_reason == "length") or unparsable responses widen the
+headroom and shrink the batch. Otherwise the controller hill-climbs: every
+WINDOW_CALLS calls it compares valid samples/second with the previous
+window and keeps moving the batch size in the direction that helped.
+
+`backoff_delay` replaces the fixed sleeps after errors with capped
+exponential backoff (full jitter).
+"""
+
+import math
+import random
+
+WINDOW_CALLS = 12  # Calls per hill-climbing window
+BATCH_STEP = 4  # Samples added/removed per adjustment
+EWMA_ALPHA = 0.2  # Smoothing for tokens-per-sample and failure rate
+MAX_FAILURE_RATE = 0.2  # Above this truncation/parse failure rate, shrink batches
+MIN_HEADROOM, MAX_HEADROOM = 1.15, 2.0
+
+
+def backoff_delay(failures, base=1.0, cap=60.0, rng=random):
+    """Seconds to wait after `failures` consecutive errors (full-jitter exponential)."""
+    if failures <= 0:
+        return 0.0
+    return rng.uniform(0, min(cap, base * 2 ** (failures - 1)))
+
+
+class AdaptiveBatchController:
+    """Tracks per-call latency, output tokens and parse failures to size the next call."""
+
+    def __init__(self, batch_size=20, min_batch=4, max_batch=40,
+                 tokens_per_sample=150.0, headroom=1.3, min_tokens=512, max_tokens_cap=8192):
+        self.batch_size = batch_size
+        self.min_batch = min_batch
+        self.max_batch = max_batch
+        self.tokens_per_sample = tokens_per_sample
+        self.headroom = headroom
+        self.min_tokens = min_tokens
+        self.max_tokens_cap = max_tokens_cap
+
+        self.failure_rate = 0.0
+        self.consecutive_errors = 0
+        self.direction = 1
+        self.calls = 0
+        self._window = {"valid": 0, "seconds": 0.0, "calls": 0}
+        self._last_rate = None
+        self._rng = random.Random()  # Private: keep the checkpointed global RNG untouched
+
+    # --- sizing --------------------------------------------------------
+
+    @property
+    def max_tokens(self):
+        budget = math.ceil(self.batch_size * self.tokens_per_sample * self.headroom)
+        return max(self.min_tokens, min(self.max_tokens_cap, budget))
+
+    def next_call(self):
+        """Return (batch_size, max_tokens) for the next generation call."""
+        # Never ask for more samples than the token cap can hold
+        fit = int(self.max_tokens_cap / (self.tokens_per_sample * self.headroom))
+        self.batch_size = max(self.min_batch, min(self.batch_size, self.max_batch, fit))
+        return self.batch_size, self.max_tokens
+
+    # --- feedback ------------------------------------------------------
+
+    def record(self, batch_size, latency, output_tokens, valid, truncated=False, parse_failed=False):
+        """Feed back the outcome of one completed call."""
+        self.calls += 1
+        self.consecutive_errors = 0
+        failed = truncated or parse_failed
+        self.failure_rate += EWMA_ALPHA * ((1.0 if failed else 0.0) - self.failure_rate)
+
+        if valid and output_tokens and not failed:
+            observed = output_tokens / valid
+            self.tokens_per_sample += EWMA_ALPHA * (observed - self.tokens_per_sample)
+
+        if failed:
+            self.headroom = min(MAX_HEADROOM, self.headroom * 1.15)
+        else:
+            self.headroom = max(MIN_HEADROOM, self.headroom * 0.99)
+
+        self._window["valid"] += valid
+        self._window["seconds"] += latency
+        self._window["calls"] += 1
+        if self._window["calls"] >= WINDOW_CALLS:
+            self._adjust()
+
+    def record_error(self):
+        """Count a failed request (timeout, connection error) and return the backoff delay."""
+        self.consecutive_errors += 1
+        return backoff_delay(self.consecutive_errors, rng=self._rng)
+
+    def _adjust(self):
+        rate = self._window["valid"] / self._window["seconds"] if self._window["seconds"] else 0.0
+        if self.failure_rate > MAX_FAILURE_RATE:
+            self.direction = -1
+        elif self._last_rate is not None and rate < self._last_rate:
+            self.direction = -self.direction  # Last move hurt: go back the other way
+        self.batch_size = max(self.min_batch, min(self.max_batch, self.batch_size + self.direction * BATCH_STEP))
+        self._last_rate = rate
+        self._window = {"valid": 0, "seconds": 0.0, "calls": 0}
+
+    # --- reporting / resume --------------------------------------------
+
+    def summary(self):
+        return (f"batch {self.batch_size}, max_tokens {self.max_tokens}, "
+                f"{self.tokens_per_sample:.0f} tok/sample, headroom {self.headroom:.2f}, "
+                f"failure rate {self.failure_rate:.1%}")
+
+    def state_dict(self):
+        return {
+            "batch_size": self.batch_size,
+            "tokens_per_sample": self.tokens_per_sample,
+            "headroom": self.headroom,
+            "failure_rate": self.failure_rate,
+            "direction": self.direction,
+            "last_rate": self._last_rate,
+        }
+
+    def load_state_dict(self, state):
+        self.batch_size = state.get("batch_size", self.batch_size)
+        self.tokens_per_sample = state.get("tokens_per_sample", self.tokens_per_sample)
+        self.headroom = state.get("headroom", self.headroom)
+        self.failure_rate = state.get("failure_rate", self.failure_rate)
+        self.direction = state.get("direction", self.direction)
+        self._last_rate = state.get("last_rate")
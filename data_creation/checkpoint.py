@@ -0,0 +1,166 @@
+"""
+Crash-safe Checkpoint Manifest for Resumable Generation
+=======================================================
+
+The manifest is a small JSON file written next to OUTPUT_FILE after every
+durable write. It records how far the run got:
+
+- samples: number of complete samples in the output file
+- batches: successful generation calls so far
+- topic_cursor: next index into the topic rotation
+- rng_state: `random.getstate()` so sampling choices replay identically
+- byte_offset: end of the last fully written (and fsynced) line
+
+On restart `recover_output_file` only parses the bytes written after the
+recorded offset, and truncates any partial or corrupt line a crash left
+behind, so resuming never re-reads the whole JSONL.
+"""
+
+import json
+import os
+from pathlib import Path
+
+MANIFEST_VERSION = 1
+COUNT_CHUNK_BYTES = 1 << 20  # 1 MB chunks when counting lines without a manifest
+TAIL_PROBE_BYTES = 1 << 16  # 64 KB window used to find the last newline
+
+
+def manifest_path_for(output_file) -> Path:
+    """Manifest lives next to the output file: foo.jsonl -> foo.jsonl.manifest.json"""
+    return Path(str(output_file) + ".manifest.json")
+
+
+def rng_state_to_json(state):
+    """Convert `random.getstate()` (nested tuples) into JSON-friendly lists."""
+    version, internal, gauss_next = state
+    return [version, list(internal), gauss_next]
+
+
+def rng_state_from_json(data):
+    """Inverse of rng_state_to_json, ready for `random.setstate()`."""
+    version, internal, gauss_next = data
+    return (version, tuple(internal), gauss_next)
+
+
+def load_manifest(path):
+    """Load a manifest, returning None if it is missing or unreadable."""
+    path = Path(path)
+    if not path.exists():
+        return None
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+    except (OSError, json.JSONDecodeError) as e:
+        print(f"⚠️  Ignoring unreadable manifest {path}: {e}")
+        return None
+    if manifest.get("version") != MANIFEST_VERSION:
+        print(f"⚠️  Ignoring manifest with unknown version: {manifest.get('version')}")
+        return None
+    return manifest
+
+
+def save_manifest(path, manifest):
+    """Atomically replace the manifest (write temp file, fsync, rename)."""
+    path = Path(path)
+    manifest = dict(manifest, version=MANIFEST_VERSION)
+    tmp_path = path.with_name(path.name + ".tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def _count_lines(path, end):
+    """Count newline-terminated lines in the first `end` bytes without parsing them."""
+    count = 0
+    with open(path, "rb") as f:
+        remaining = end
+        while remaining > 0:
+            chunk = f.read(min(COUNT_CHUNK_BYTES, remaining))
+            if not chunk:
+                break
+            count += chunk.count(b"\n")
+            remaining -= len(chunk)
+    return count
+
+
+def _last_line_start(path, size):
+    """Byte offset where the last complete line starts (0 if only one line)."""
+    with open(path, "rb") as f:
+        end = size - 1  # Skip the trailing newline itself
+        while end > 0:
+            start = max(0, end - TAIL_PROBE_BYTES)
+            f.seek(start)
+            chunk = f.read(end - start)
+            idx = chunk.rfind(b"\n")
+            if idx != -1:
+                return start + idx + 1
+            end = start
+    return 0
+
+
+def _validate_lines(path, start, size):
+    """
+    Parse lines in [start, size) and return (valid_lines, good_end).
+
+    Stops at the first unterminated or unparsable line; everything from
+    `good_end` onward should be truncated.
+    """
+    valid = 0
+    good_end = start
+    with open(path, "rb") as f:
+        f.seek(start)
+        while good_end < size:
+            line = f.readline()
+            if not line.endswith(b"\n"):
+                break
+            try:
+                json.loads(line)
+            except ValueError:
+                break
+            valid += 1
+            good_end += len(line)
+    return valid, good_end
+
+
+def recover_output_file(output_file, manifest=None):
+    """
+    Validate the tail of the output JSONL and truncate partial lines.
+
+    Returns (sample_count, byte_offset) describing the clean file. With a
+    manifest only the bytes after its `byte_offset` are parsed; without
+    one, lines are counted in binary and only the last line is parsed.
+    """
+    path = Path(output_file)
+    if not path.exists():
+        if manifest and manifest.get("samples"):
+            print(f"⚠️  Manifest says {manifest['samples']} samples but {path} is missing - starting over")
+        return 0, 0
+
+    size = path.stat().st_size
+
+    if manifest and 0 <= manifest.get("byte_offset", -1) <= size:
+        base_count = manifest.get("samples", 0)
+        valid, good_end = _validate_lines(path, manifest["byte_offset"], size)
+        count = base_count + valid
+    else:
+        if manifest:
+            print(f"⚠️  Manifest offset beyond end of {path} - recounting")
+        # Drop any unterminated fragment, then check the last complete line
+        with open(path, "rb") as f:
+            f.seek(max(0, size - 1))
+            ends_clean = size == 0 or f.read(1) == b"\n"
+        end = size if ends_clean else _last_line_start(path, size)
+        tail_start = _last_line_start(path, end) if end > 0 else 0
+        valid, good_end = _validate_lines(path, tail_start, end)
+        count = _count_lines(path, tail_start) + valid
+
+    if good_end < size:
+        print(f"🩹 Truncating {size - good_end} bytes of partial output at offset {good_end}")
+        with open(path, "r+b") as f:
+            f.truncate(good_end)
+            f.flush()
+            os.fsync(f.fileno())
+
+    return count, good_end
@@ -13,16 +13,59 @@ Target: 50,000 samples in ~3-4 hours
 import os
 import json
 import time
+import random
+import asyncio
+import functools
 from pathlib import Path
-import pandas as pd
+
+from checkpoint import (
+    load_manifest, save_manifest, manifest_path_for, recover_output_file,
+    rng_state_to_json, rng_state_from_json,
+)
+from dedup import NearDuplicateFilter
+from writer import BatchedJsonlWriter, WriterError
+from batch_controller import AdaptiveBatchController, backoff_delay
+from json_salvage import salvage_samples, IncrementalSampleParser
+from load_balancer import EndpointPool, parse_endpoints
+from scheduler import DiversityScheduler
+from seed_loader import SEED_EXTENSIONS, load_seed_rows
+from telemetry import RunTelemetry
 
 # --- LIGHTNING.AI GPU-OPTIMIZED Configuration ---
 QWEN_MODEL = 'qwen2.5:14b'  # Optimized for L40 GPU (48GB VRAM)
 OUTPUT_FILE = 'synthetic_geriatric_data.jsonl'
+MANIFEST_FILE = manifest_path_for(OUTPUT_FILE)
+RESUME = True  # Continue from MANIFEST_FILE instead of counting from 0
+
+# DEDUP - reject repeats before they reach OUTPUT_FILE
+DEDUP_ENABLED = True
+DEDUP_INDEX_FILE = OUTPUT_FILE + '.dedup'
+DEDUP_CAPACITY = 200_000  # Max samples held in the near-duplicate index
+DEDUP_SAVE_EVERY = 25  # Persist the index every N written batches
+
+# WRITER - batched background writes (see writer.py for flush policy)
+OUTPUT_COMPRESSION = None  # None = plain OUTPUT_FILE, "gz" or "zst" = compressed shards
+SHARD_MAX_RECORDS = None  # e.g. 10_000 to rotate output shards
+SHARDED_OUTPUT = OUTPUT_COMPRESSION is not None or SHARD_MAX_RECORDS is not None
 
 # GPU OPTIMIZATION
-BATCH_SIZE = 20  # Generate 20 samples per call
+BATCH_SIZE = 20  # Starting samples per call (tuned by the adaptive controller)
+MAX_TOKENS = 3000  # Starting completion budget for a batch of 20
+ADAPTIVE_BATCHING = True  # Tune batch size / max_tokens from latency, tokens and parse failures
+MIN_BATCH_SIZE, MAX_BATCH_SIZE = 4, 40
+MAX_TOKENS_CAP = 8192  # Never request more than this per call
 COOLDOWN_SECONDS = 1  # Minimal cooldown
+SALVAGE_PARTIAL_JSON = True  # Keep complete samples from truncated/malformed responses
+
+# TELEMETRY
+METRICS_FILE = OUTPUT_FILE + '.metrics.jsonl'  # JSONL snapshot stream (None = off)
+PROMETHEUS_FILE = OUTPUT_FILE + '.prom'  # Prometheus textfile-collector file (None = off)
+PROMETHEUS_PORT = None  # e.g. 9108 to also serve http://127.0.0.1:9108/metrics
+METRICS_INTERVAL_SECONDS = 15
+
+# TOPIC / SEED SCHEDULING
+DIVERSITY_SCHEDULING = True  # False = round-robin topics with the first 5 seeds as examples
+EXEMPLARS_PER_CALL = 5  # Seed examples shown per call, rotated across sources and topics
 
 # Time tracking (4-hour limit)
 import datetime
@@ -44,12 +87,8 @@ def resolve_all_seed_files():
     seed_files = {'intents': None, 'claude': None, 'gemini': None}
     
     for name in seed_files.keys():
-        filename = f"{name}.json"
-        for search_dir in SEARCH_DIRS:
-            candidate = search_dir / filename
-            if candidate.exists():
-                seed_files[name] = candidate
-                break
+        candidates = [search_dir / f"{name}{ext}" for search_dir in SEARCH_DIRS for ext in SEED_EXTENSIONS]
+        seed_files[name] = next((c for c in candidates if c.exists()), None)
     
     found_files = {k: v for k, v in seed_files.items() if v is not None}
     if not found_files:
@@ -59,7 +98,7 @@ def resolve_all_seed_files():
     
     print(f"Found {len(found_files)} seed file(s):")
     for name, path in found_files.items():
-        print(f"  - {name}.json: {path}")
+        print(f"  - {name}: {path}")
     
     return found_files
 
@@ -67,28 +106,46 @@ SEED_FILES = resolve_all_seed_files()
 SEED_SAMPLE_SIZE = 500
 TARGET_GENERATION_SIZE = 50000
 
+# ASYNC ENGINE - keep the inference server saturated
+ASYNC_MODE = True  # False = original one-call-at-a-time loop
+MAX_CONCURRENCY = 8  # Max in-flight requests per endpoint (Ollama: match OLLAMA_NUM_PARALLEL)
+REQUEST_TIMEOUT_SECONDS = 180  # Per-request timeout for a full batch
+STREAM_RESPONSES = False  # Async engine: stream tokens and emit each sample as its object closes
+
 # Initialize Qwen client (100% local, GPU-accelerated)
 QWEN_API_KEY = "EMPTY"
-QWEN_API_BASE = "http://localhost:11434/v1"
+QWEN_API_BASE = os.environ.get("QWEN_API_BASE", "http://localhost:11434/v1")
+# One server per GPU, e.g. QWEN_API_BASES="http://localhost:11434/v1,http://localhost:11435/v1"
+QWEN_API_BASES = parse_endpoints(os.environ.get("QWEN_API_BASES", QWEN_API_BASE))
 
 from openai import OpenAI
 qwen_client = None
+qwen_endpoints = None
 try:
     qwen_client = OpenAI(
         api_key=QWEN_API_KEY,
-        base_url=QWEN_API_BASE,
+        base_url=QWEN_API_BASES[0],  # Sequential mode uses the first endpoint only
         timeout=60.0,  # Longer timeout for larger model
         max_retries=1
     )
+    qwen_endpoints = EndpointPool(
+        QWEN_API_BASES,
+        api_key=QWEN_API_KEY,
+        timeout=REQUEST_TIMEOUT_SECONDS,
+        max_outstanding=MAX_CONCURRENCY
+    )
     print("✓ Qwen client initialized (GPU-ACCELERATED)")
 except Exception as e:
     print(f"⚠️ Qwen client initialization deferred: {e}")
 
 # --- Master System Prompt for Local Generation ---
-MASTER_SYSTEM_PROMPT = f"""You are an AI Geriatric Health Assistant providing PRACTICAL, ACTIONABLE wellness and first-aid advice for elderly patients (70+ years).
+@functools.lru_cache(maxsize=None)
+def build_system_prompt(batch_size):
+    """System prompt asking for exactly `batch_size` samples (cached per size)."""
+    return f"""You are an AI Geriatric Health Assistant providing PRACTICAL, ACTIONABLE wellness and first-aid advice for elderly patients (70+ years).
 
 CRITICAL FORMATTING RULES:
-1. Your response MUST be a JSON array (list) containing exactly {BATCH_SIZE} objects
+1. Your response MUST be a JSON array (list) containing exactly {batch_size} objects
 2. Each object must have: "instruction", "input", "output"
 3. ALWAYS return an array, NEVER a single object
 
@@ -116,7 +173,7 @@ EXAMPLES OF GOOD vs BAD OUTPUTS:
 ❌ BAD: "See a doctor for your cold"
 ✅ GOOD: "Rest and drink warm fluids like tea with honey. Use saline nasal spray to clear congestion. Gargle with warm salt water for sore throat. Take over-the-counter cold medicine as directed on the package."
 
-REQUIRED OUTPUT FORMAT (JSON array with {BATCH_SIZE} objects):
+REQUIRED OUTPUT FORMAT (JSON array with {batch_size} objects):
 [
   {{
     "instruction": "What can I do about constipation?",
@@ -128,58 +185,13 @@ REQUIRED OUTPUT FORMAT (JSON array with {BATCH_SIZE} objects):
     "input": "Patient is 76, twisted ankle yesterday.",
     "output": "Rest and elevate your ankle above heart level. Apply ice wrapped in a towel for 15-20 minutes every 2 hours. Take ibuprofen if not contraindicated. If swelling doesn't improve in 24 hours or you can't bear weight, see a doctor."
   }}
-  ... ({BATCH_SIZE} total)
+  ... ({batch_size} total)
 ]
 
 REMEMBER: Be HELPFUL and SPECIFIC! Give actionable steps seniors can take RIGHT NOW!
 """
 
-def load_seed_dataframe(path: Path) -> pd.DataFrame:
-    """Load seed data flexibly from csv/json/jsonl."""
-    suffix = path.suffix.lower()
-    
-    if suffix == '.json':
-        try:
-            with open(path, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-            
-            if isinstance(data, list) and len(data) > 0:
-                if all(isinstance(item, dict) and 'instruction' in item for item in data):
-                    df = pd.DataFrame(data)
-                    return df.rename(columns={'instruction': 'text', 'output': 'label'})
-            
-            if isinstance(data, dict) and "intents" in data:
-                rows = []
-                for item in data["intents"]:
-                    patterns = item.get("patterns", [])
-                    responses = item.get("responses", [])
-                    if isinstance(patterns, str): patterns = [patterns]
-                    if isinstance(responses, str): responses = [responses]
-                    for p in patterns:
-                        for r in responses:
-                            rows.append({"text": p, "label": r})
-                if rows:
-                    return pd.DataFrame(rows)
-        except Exception as e:
-            print(f"JSON parsing failed: {e}")
-    
-    if suffix in {'.jsonl', '.jsonl.gz'}:
-        df = pd.read_json(path, lines=True)
-    elif suffix == '.json':
-        df = pd.read_json(path)
-    else:
-        df = pd.read_csv(path, encoding='utf-8', sep=None, engine='python')
-    
-    text_candidates = ['text', 'question', 'prompt', 'input', 'instruction']
-    label_candidates = ['label', 'answer', 'response', 'output']
-    
-    text_col = next((c for c in text_candidates if c in df.columns), None)
-    label_col = next((c for c in label_candidates if c in df.columns), None)
-    
-    if not text_col or not label_col:
-        raise ValueError(f"Seed file must contain text and label columns. Found: {df.columns.tolist()}")
-    
-    return df.rename(columns={text_col: 'text', label_col: 'label'})
+MASTER_SYSTEM_PROMPT = build_system_prompt(BATCH_SIZE)
 
 def prepare_seed_data(seed_files_dict, sample_size):
     """Load and transform seed data from multiple sources."""
@@ -198,12 +210,12 @@ def prepare_seed_data(seed_files_dict, sample_size):
         if file_path is None:
             continue
         
-        print(f"  Loading {name}.json...")
-        df = load_seed_dataframe(Path(file_path))
-        samples_from_this_file = min(len(df), sample_size // len(seed_files_dict))
-        df_sampled = df.sample(min(samples_from_this_file, len(df)), random_state=42)
+        print(f"  Loading {Path(file_path).name}...")
+        # One streaming pass with a bounded reservoir, however large the file
+        rows, total = load_seed_rows(file_path, sample_size // len(seed_files_dict))
+        print(f"    sampled {len(rows)} of {total} rows")
         
-        for index, row in df_sampled.iterrows():
+        for row in rows:
             instruction = row['text']
             output_advice = row['label']
             
@@ -219,7 +231,6 @@ def prepare_seed_data(seed_files_dict, sample_size):
                 "source": name
             })
     
-    import random
     random.seed(42)
     random.shuffle(all_seed_data)
     all_seed_data = all_seed_data[:sample_size]
@@ -227,155 +238,672 @@ def prepare_seed_data(seed_files_dict, sample_size):
     print(f"Prepared {len(all_seed_data)} seed samples.")
     return all_seed_data
 
+TOPICS = [
+    "Hydration and dietary advice", "Chronic pain management",
+    "Fall prevention", "Medication management", "Common illnesses",
+    "Sleep and fatigue", "Memory and cognition", "Diabetes management",
+    "Heart health", "Exercise safety", "Treating minor injuries",
+    "Headache management", "Nosebleeds", "Sore throat relief",
+    "Digestive issues", "Vision comfort", "Emotional well-being",
+    "Stress and anxiety", "Insomnia", "Grief and loss"
+]
+
+def build_generation_prompt(topic, exemplars, batch_size=BATCH_SIZE):
+    """Build the user prompt for one batch about a topic."""
+    seed_sample = json.dumps(exemplars, indent=2)
+    
+    return f"""
+        Generate {batch_size} NEW unique instruction/input/output JSON triples about: {topic}
+        
+        Examples:
+        {seed_sample}
+        """
+
+def extract_triples(data, batch_count=0):
+    """Pull the list of candidate triples out of a parsed model response."""
+    # DEBUG: Show parsed structure
+    if batch_count < 3:
+        print(f"  🔍 DEBUG - Parsed type: {type(data)}")
+        if isinstance(data, dict):
+            print(f"  🔍 DEBUG - Dict keys: {list(data.keys())}")
+    
+    # Handle different response formats
+    if isinstance(data, list):
+        return data
+    if isinstance(data, dict):
+        # Check if it's a single example with the right keys
+        if all(k in data for k in ["instruction", "input", "output"]):
+            # Model returned single example instead of array - wrap it
+            if batch_count < 3:
+                print(f"  ⚠️  Model returned single example instead of array - wrapping...")
+            return [data]
+        # Try to find the list of examples in the dict
+        triples = next((v for v in data.values() if isinstance(v, list)), [])
+        if not triples:
+            # Might be a single-level dict with keys like "examples", "data", "results"
+            for key in ['examples', 'data', 'results', 'samples', 'triples']:
+                if key in data and isinstance(data[key], list):
+                    triples = data[key]
+                    break
+        return triples
+    return []
+
+def parse_generation_response(raw_content, batch_count=0):
+    """Parse raw model output into (all triples, valid triples)."""
+    # DEBUG: Show raw response
+    if batch_count < 3:  # Only print first 3 for debugging
+        print(f"  🔍 DEBUG - Raw response preview: {raw_content[:200]}...")
+    
+    try:
+        triples = extract_triples(json.loads(raw_content), batch_count)
+        parse_error = None
+    except json.JSONDecodeError as e:
+        triples, parse_error = [], e
+    
+    if batch_count < 3:
+        print(f"  🔍 DEBUG - Found {len(triples)} triples")
+    
+    valid = [t for t in triples if isinstance(t, dict) and all(k in t for k in ["instruction", "input", "output"])]
+    
+    # Truncated or malformed output: keep every complete object instead of dropping the batch
+    if not valid and SALVAGE_PARTIAL_JSON:
+        salvaged = salvage_samples(raw_content)
+        if salvaged:
+            print(f"  🩹 Salvaged {len(salvaged)} complete samples from a malformed/truncated response")
+            return triples or salvaged, salvaged
+    if parse_error is not None:
+        raise parse_error
+    
+    if batch_count < 3:
+        print(f"  🔍 DEBUG - Valid triples: {len(valid)}")
+        if len(valid) == 0 and len(triples) > 0:
+            print(f"  🔍 DEBUG - Sample triple: {triples[0]}")
+    
+    return triples, valid
+
+def load_generation_state():
+    """Restore counters, topic cursor and RNG from the manifest (or start fresh)."""
+    state = {"generated": 0, "batches": 0, "topic_cursor": 0, "byte_offset": 0, "shard_index": 0}
+    if not RESUME:
+        return state
+    
+    manifest = load_manifest(MANIFEST_FILE)
+    if SHARDED_OUTPUT:
+        # Shards are written once: trust the manifest and open the next shard
+        if manifest:
+            state["generated"] = manifest.get("samples", 0)
+            state["shard_index"] = manifest.get("shard_index", -1) + 1
+    else:
+        state["generated"], state["byte_offset"] = recover_output_file(OUTPUT_FILE, manifest)
+    if manifest:
+        state["batches"] = manifest.get("batches", 0)
+        state["topic_cursor"] = manifest.get("topic_cursor", 0)
+        state["controller"] = manifest.get("controller")
+        state["scheduler"] = manifest.get("scheduler")
+        if manifest.get("rng_state"):
+            random.setstate(rng_state_from_json(manifest["rng_state"]))
+    
+    if state["generated"]:
+        print(f"♻️  Resuming: {state['generated']} samples, batch {state['batches']}, topic cursor {state['topic_cursor']}")
+    return state
+
+def checkpoint_snapshot(state):
+    """Generator state to record once the batch just submitted is durable."""
+    controller = state.get("controller")
+    scheduler = state.get("scheduler")
+    dedup = state.get("dedup")
+    return {
+        "samples": state["generated"],
+        "dedup_indexed": dedup.indexed if dedup else None,
+        "batches": state["batches"],
+        "topic_cursor": state["topic_cursor"],
+        "rng_state": rng_state_to_json(random.getstate()),
+        "controller": controller.state_dict() if controller else None,
+        "scheduler": scheduler.state_dict() if scheduler else None,
+    }
+
+def open_writer(state):
+    """Start the background writer; each fsynced flush rewrites the manifest."""
+    def on_flush(info):
+        # Runs on the writer thread, after the records are on disk
+        state["byte_offset"] = info["byte_offset"]
+        if info["meta"].get("dedup_indexed") is not None:
+            # One assignment, so save_dedup_index never sees a mixed pair
+            state["dedup_synced"] = (info["byte_offset"], info["meta"]["dedup_indexed"])
+        save_manifest(MANIFEST_FILE, dict(
+            info["meta"],
+            byte_offset=info["byte_offset"],
+            shard_index=info["shard_index"],
+            output_file=info["shard"],
+            updated_at=datetime.datetime.now().isoformat(),
+        ))
+    
+    writer = BatchedJsonlWriter(
+        OUTPUT_FILE,
+        compression=OUTPUT_COMPRESSION,
+        shard_max_records=SHARD_MAX_RECORDS,
+        on_flush=on_flush,
+        start_shard=state["shard_index"],
+    )
+    print(f"💾 Writing to {writer.shard_path()} (background writer)")
+    return writer
+
+def make_batch_controller(state):
+    """Adaptive sizing controller, restored from the manifest on resume (None = fixed sizes)."""
+    if not ADAPTIVE_BATCHING:
+        return None
+    controller = AdaptiveBatchController(
+        batch_size=BATCH_SIZE,
+        min_batch=MIN_BATCH_SIZE,
+        max_batch=MAX_BATCH_SIZE,
+        tokens_per_sample=MAX_TOKENS / BATCH_SIZE / 1.3,
+        max_tokens_cap=MAX_TOKENS_CAP,
+    )
+    if state.get("controller"):
+        controller.load_state_dict(state["controller"])
+    state["controller"] = controller
+    return controller
+
+def make_scheduler(state, seed_data, target_size):
+    """Topic/exemplar scheduler, restored from the manifest on resume (None = round-robin)."""
+    if not DIVERSITY_SCHEDULING:
+        return None
+    scheduler = DiversityScheduler(TOPICS, seed_data, target_size, exemplars_per_call=EXEMPLARS_PER_CALL)
+    if state.get("scheduler"):
+        scheduler.load_state_dict(state["scheduler"])
+    state["scheduler"] = scheduler
+    return scheduler
+
+def next_batch(scheduler, state, seed_data, batch_size):
+    """(topic, exemplars) for the next call; advances the call cursor."""
+    cursor = state["topic_cursor"]
+    state["topic_cursor"] += 1
+    if scheduler is None:
+        return TOPICS[cursor % len(TOPICS)], seed_data[:5]
+    return scheduler.next_batch(batch_size)
+
+def record_batch(scheduler, topic, batch_size, valid=0, novel=0, error=False):
+    """Feed one call's outcome back to the scheduler."""
+    if scheduler is not None:
+        scheduler.record(topic, batch_size, valid, novel, error)
+
+def start_telemetry(state, writer, target_size, controller=None, endpoints=None):
+    """Publish run metrics every METRICS_INTERVAL_SECONDS (JSONL + Prometheus)."""
+    def gauges():
+        yield "in_flight_requests", {}, state.get("in_flight", 0)
+        yield "writer_queue_batches", {}, writer.queue_depth
+        yield "writer_lag_records", {}, writer.pending
+        yield "writer_lag_seconds", {}, round(writer.lag_seconds, 3)
+        if controller is not None:
+            yield "batch_size", {}, controller.batch_size
+            yield "max_tokens", {}, controller.max_tokens
+        for ep in (endpoints.endpoints if endpoints else []):
+            yield "endpoint_outstanding", {"endpoint": ep.base_url}, ep.outstanding
+            yield "endpoint_circuit_open", {"endpoint": ep.base_url}, int(ep.state != "closed")
+    
+    telemetry = RunTelemetry(
+        metrics_file=METRICS_FILE,
+        prometheus_file=PROMETHEUS_FILE,
+        prometheus_port=PROMETHEUS_PORT,
+        interval=METRICS_INTERVAL_SECONDS,
+        gauges=gauges,
+        target_size=target_size,
+    )
+    return telemetry.start(lambda: state["generated"])
+
+def print_telemetry_summary(snapshot):
+    """One-line latency/throughput/quality summary from a telemetry snapshot."""
+    latency = snapshot["latency_s"]
+    if latency["p50"] is None:
+        return
+    print(f"   Latency p50/p95/p99: {latency['p50']:.2f}s / {latency['p95']:.2f}s / {latency['p99']:.2f}s "
+          f"| {snapshot['tokens_per_sec']:.0f} tok/s | {snapshot['valid_per_call']:.1f} valid/call "
+          f"| parse failures {snapshot['parse_failure_rate']:.1%} | duplicates {snapshot['duplicate_rate']:.1%}")
+    if METRICS_FILE:
+        print(f"   Metrics: {METRICS_FILE}{' + ' + PROMETHEUS_FILE if PROMETHEUS_FILE else ''}")
+
+def next_call_size(controller):
+    """(samples per call, max_tokens) for the next request."""
+    if controller is None:
+        return BATCH_SIZE, MAX_TOKENS
+    return controller.next_call()
+
+def completion_request(topic, exemplars, batch_size, max_tokens):
+    """Keyword arguments for chat.completions.create for one batch."""
+    return dict(
+        model=QWEN_MODEL,
+        messages=[
+            {"role": "system", "content": build_system_prompt(batch_size)},
+            {"role": "user", "content": build_generation_prompt(topic, exemplars, batch_size)}
+        ],
+        response_format={"type": "json_object"},
+        temperature=0.8,
+        max_tokens=max_tokens
+    )
+
+def read_completion(response, batch_count=0):
+    """
+    Parse a completion into (triples, valid, output_tokens, truncated, parse_failed).
+    
+    A truncated response still yields its complete samples (salvaged), and
+    the truncation feeds the controller, which widens max_tokens or shrinks
+    the batch. parse_failed means nothing at all could be recovered.
+    """
+    choice = response.choices[0]
+    raw_content = choice.message.content or ""
+    truncated = choice.finish_reason == "length"
+    usage = getattr(response, "usage", None)
+    output_tokens = usage.completion_tokens if usage and usage.completion_tokens else len(raw_content) // 4
+    
+    try:
+        triples, valid = parse_generation_response(raw_content, batch_count)
+        parse_failed = False
+    except json.JSONDecodeError as e:
+        print(f"  ⚠️  Unparsable response ({'truncated at max_tokens' if truncated else e})")
+        triples, valid, parse_failed = [], [], True
+    
+    return triples, valid, output_tokens, truncated, parse_failed
+
+def save_samples(writer, samples, state, new_batch=True):
+    """Hand novel samples to the writer without waiting for the disk."""
+    state["generated"] += len(samples)
+    if new_batch:
+        state["batches"] += 1
+    writer.submit(samples, meta=checkpoint_snapshot(state))
+
+async def stream_completion(client, request, on_sample):
+    """
+    Run one streamed completion, calling on_sample(sample) as each object closes.
+    
+    Samples reach validation, dedup and the writer while the rest of the
+    batch is still decoding. Returns (emitted, output_tokens, truncated,
+    time_to_first_sample) - the last is None if nothing was emitted.
+    """
+    parser = IncrementalSampleParser()
+    started = time.perf_counter()
+    first_sample = None
+    emitted = 0
+    chars = 0
+    output_tokens = None
+    finish_reason = None
+    
+    stream = await client.chat.completions.create(
+        **request, stream=True, stream_options={"include_usage": True}
+    )
+    async for chunk in stream:
+        if getattr(chunk, "usage", None):
+            output_tokens = chunk.usage.completion_tokens
+        if not chunk.choices:
+            continue
+        choice = chunk.choices[0]
+        finish_reason = choice.finish_reason or finish_reason
+        text = choice.delta.content if choice.delta else None
+        if not text:
+            continue
+        chars += len(text)
+        for sample in parser.feed(text):
+            if first_sample is None:
+                first_sample = time.perf_counter() - started
+            emitted += 1
+            on_sample(sample)
+    
+    truncated = finish_reason == "length" or parser.close()
+    return emitted, output_tokens or chars // 4, truncated, first_sample
+
+def load_dedup_filter(state):
+    """
+    Load the persisted dedup index, drop samples it indexed that never reached
+    the output, and replay output written after its last save.
+    
+    Sharded output can't be replayed by offset: the index is used as of
+    its last flushed batch.
+    """
+    if not DEDUP_ENABLED:
+        return None
+    
+    output_offset = None if SHARDED_OUTPUT else state["byte_offset"]
+    dedup = None
+    if RESUME and Path(DEDUP_INDEX_FILE).exists():
+        try:
+            dedup = NearDuplicateFilter.load(DEDUP_INDEX_FILE)
+        except (OSError, ValueError, KeyError) as e:
+            print(f"⚠️  Could not load dedup index ({e}) - rebuilding")
+    if dedup is None or (output_offset is not None and dedup.byte_offset > output_offset):
+        dedup = NearDuplicateFilter(capacity=DEDUP_CAPACITY)
+    
+    # Samples indexed after the last flush the index saw were lost in the crash
+    dropped = dedup.indexed - dedup.synced
+    if dropped > 0:
+        dedup.rollback(dedup.synced)
+        print(f"🧬 Dedup index: dropped {dropped} samples that were never written")
+    
+    # Only the lines written since the index was last saved need replaying
+    if output_offset is not None and dedup.byte_offset < output_offset:
+        replayed = 0
+        with open(OUTPUT_FILE, "rb") as f:
+            f.seek(dedup.byte_offset)
+            while f.tell() < output_offset:
+                dedup.add(json.loads(f.readline()))
+                replayed += 1
+        print(f"🧬 Dedup index: replayed {replayed} samples from {OUTPUT_FILE}")
+        dedup.byte_offset = output_offset
+    dedup.synced = dedup.indexed
+    
+    state["dedup"] = dedup
+    state["dedup_synced"] = (dedup.byte_offset, dedup.synced)
+    print(f"🧬 Dedup index: {len(dedup)} samples (capacity {dedup.capacity})")
+    return dedup
+
+def filter_duplicates(dedup, samples, topic):
+    """Drop exact and near duplicates; returns the novel samples."""
+    if dedup is None:
+        return samples
+    return dedup.filter(samples, topic)
+
+def save_dedup_index(dedup, state, force=False):
+    """
+    Persist the dedup index every DEDUP_SAVE_EVERY batches (or when forced).
+    
+    The index may already hold samples still queued in the writer, so it
+    records the last durable flush - its offset and how many indexed samples
+    it covered. A resume rolls the index back to that count and replays the
+    output after that offset.
+    """
+    if dedup is None:
+        return
+    if force or state["batches"] % DEDUP_SAVE_EVERY == 0:
+        byte_offset, dedup.synced = state["dedup_synced"]
+        dedup.byte_offset = 0 if SHARDED_OUTPUT else byte_offset
+        dedup.save(DEDUP_INDEX_FILE)
+
+def print_progress(batch_count, generated_count, target_size, remaining):
+    """Print the periodic checkpoint block with speed and ETA."""
+    elapsed = (datetime.datetime.now() - START_TIME).total_seconds() / 3600
+    rate = generated_count / elapsed if elapsed > 0 else 0
+    eta = (target_size - generated_count) / rate if rate > 0 else 0
+    print(f"\n📊 Checkpoint {batch_count}")
+    print(f"   Progress: {generated_count}/{target_size} ({100*generated_count/target_size:.1f}%)")
+    print(f"   Speed: {rate:.0f} samples/hour")
+    print(f"   ETA: {eta:.1f} hours")
+    print(f"   Time remaining: {remaining:.1f} hours\n")
+
+def print_generation_summary(generated_count, dedup=None, controller=None, scheduler=None):
+    """Print the end-of-run summary."""
+    print(f"\n✅ GENERATION COMPLETE!")
+    print(f"   Generated: {generated_count} samples")
+    print(f"   Runtime: {(datetime.datetime.now() - START_TIME).total_seconds() / 3600:.2f} hours")
+    print(f"   File: {OUTPUT_FILE}")
+    if controller is not None:
+        print(f"   Final sizing: {controller.summary()}")
+    if dedup is not None:
+        dedup.print_topic_stats()
+    if scheduler is not None:
+        scheduler.print_topic_stats()
+
 def generate_synthetic_data(seed_data, target_size, qwen_client):
     """Generate data with 100% local GPU acceleration - Lightning.ai optimized."""
     if not qwen_client:
         print("ERROR: Qwen client not available!")
         return []
     
-    generated_count = 0
-    batch_count = 0
-    
-    topics = [
-        "Hydration and dietary advice", "Chronic pain management",
-        "Fall prevention", "Medication management", "Common illnesses",
-        "Sleep and fatigue", "Memory and cognition", "Diabetes management",
-        "Heart health", "Exercise safety", "Treating minor injuries",
-        "Headache management", "Nosebleeds", "Sore throat relief",
-        "Digestive issues", "Vision comfort", "Emotional well-being",
-        "Stress and anxiety", "Insomnia", "Grief and loss"
-    ]
-    
     print(f"\n🚀 LIGHTNING.AI 100% LOCAL GPU MODE - NVIDIA L40")
     print(f"   Target: {target_size} samples")
-    print(f"   Batch size: {BATCH_SIZE} samples/call")
+    print(f"   Batch size: {BATCH_SIZE} samples/call{' (adaptive)' if ADAPTIVE_BATCHING else ''}")
     print(f"   Time limit: {MAX_RUNTIME_HOURS:.1f} hours")
     print(f"   Model: {QWEN_MODEL} (GPU-accelerated)")
     print(f"   Mode: 100% Local (No external APIs)\n")
     
-    import random
     random.seed(42)
+    state = load_generation_state()
+    dedup = load_dedup_filter(state)
+    writer = open_writer(state)
+    controller = make_batch_controller(state)
+    scheduler = make_scheduler(state, seed_data, target_size)
+    telemetry = start_telemetry(state, writer, target_size, controller)
+    generated_count = state["generated"]
+    batch_count = state["batches"]
+    errors = 0
     
-    while generated_count < target_size:
-        # Check time limit
-        remaining = time_remaining()
-        if remaining <= 0:
-            print(f"\n⏰ Time limit reached! Stopping at {generated_count} samples.")
-            break
-        
-        # Progress update every 100 batches
-        if batch_count % 100 == 0 and batch_count > 0:
-            elapsed = (datetime.datetime.now() - START_TIME).total_seconds() / 3600
-            rate = generated_count / elapsed if elapsed > 0 else 0
-            eta = (target_size - generated_count) / rate if rate > 0 else 0
-            print(f"\n📊 Checkpoint {batch_count}")
-            print(f"   Progress: {generated_count}/{target_size} ({100*generated_count/target_size:.1f}%)")
-            print(f"   Speed: {rate:.0f} samples/hour")
-            print(f"   ETA: {eta:.1f} hours")
-            print(f"   Time remaining: {remaining:.1f} hours\n")
-        
-        topic = topics[generated_count % len(topics)]
-        seed_sample = json.dumps(seed_data[:5], indent=2)
+    try:
+        while generated_count < target_size:
+            # Check time limit
+            remaining = time_remaining()
+            if remaining <= 0:
+                print(f"\n⏰ Time limit reached! Stopping at {generated_count} samples.")
+                break
         
-        generation_prompt = f"""
-        Generate {BATCH_SIZE} NEW unique instruction/input/output JSON triples about: {topic}
+            # Progress update every 100 batches
+            if batch_count % 100 == 0 and batch_count > 0:
+                print_progress(batch_count, generated_count, target_size, remaining)
+                if dedup is not None:
+                    dedup.print_topic_stats()
         
-        Examples:
-        {seed_sample}
-        """
+            batch_size, max_tokens = next_call_size(controller)
+            topic, exemplars = next_batch(scheduler, state, seed_data, batch_size)
         
-        if batch_count % 50 == 0:  # Print every 50 batches
-            print(f"[Batch {batch_count+1}] {QWEN_MODEL} | {generated_count}/{target_size}")
+            if batch_count % 50 == 0:  # Print every 50 batches
+                print(f"[Batch {batch_count+1}] {QWEN_MODEL} | {batch_size}/call, max_tokens {max_tokens} | {generated_count}/{target_size}")
         
-        try:
-            # Pure local Qwen generation - GPU accelerated
-            response = qwen_client.chat.completions.create(
-                model=QWEN_MODEL,
-                messages=[
-                    {"role": "system", "content": MASTER_SYSTEM_PROMPT},
-                    {"role": "user", "content": generation_prompt}
-                ],
-                response_format={"type": "json_object"},
-                temperature=0.8,
-                max_tokens=3000  # Larger for batch of 20
-            )
-            
-            # DEBUG: Show raw response
-            raw_content = response.choices[0].message.content
-            if batch_count < 3:  # Only print first 3 for debugging
-                print(f"  🔍 DEBUG - Raw response preview: {raw_content[:200]}...")
+            try:
+                # Pure local Qwen generation - GPU accelerated
+                started = time.perf_counter()
+                response = qwen_client.chat.completions.create(
+                    **completion_request(topic, exemplars, batch_size, max_tokens)
+                )
+                latency = time.perf_counter() - started
+                errors = 0
             
-            data = json.loads(raw_content)
-            
-            # DEBUG: Show parsed structure
-            if batch_count < 3:
-                print(f"  🔍 DEBUG - Parsed type: {type(data)}")
-                if isinstance(data, dict):
-                    print(f"  🔍 DEBUG - Dict keys: {list(data.keys())}")
+                triples, valid, output_tokens, truncated, parse_failed = read_completion(response, batch_count)
+                if controller is not None:
+                    controller.record(batch_size, latency, output_tokens, len(valid), truncated, parse_failed)
+                novel = filter_duplicates(dedup, valid, topic)
+                record_batch(scheduler, topic, batch_size, len(valid), len(novel))
+                telemetry.record_call(topic, latency, output_tokens, batch_size, len(valid), len(novel),
+                                      parse_failed, truncated)
             
-            # Handle different response formats
-            if isinstance(data, list):
-                triples = data
-            elif isinstance(data, dict):
-                # Check if it's a single example with the right keys
-                if all(k in data for k in ["instruction", "input", "output"]):
-                    # Model returned single example instead of array - wrap it
-                    triples = [data]
-                    if batch_count < 3:
-                        print(f"  ⚠️  Model returned single example instead of array - wrapping...")
+                if novel:
+                    save_samples(writer, novel, state)
+                
+                    generated_count = state["generated"]
+                    batch_count = state["batches"]
+                    save_dedup_index(dedup, state)
+                    print(f"  ✓ Generated {len(novel)} novel samples ({len(valid) - len(novel)} duplicates dropped) | Total: {generated_count}/{target_size}")
+                
+                    # Minimal cooldown
+                    time.sleep(COOLDOWN_SECONDS)
+                elif valid:
+                    print(f"  ♻️  All {len(valid)} valid samples were duplicates ({topic})")
                 else:
-                    # Try to find the list of examples in the dict
-                    triples = next((v for v in data.values() if isinstance(v, list)), [])
-                    if not triples:
-                        # Might be a single-level dict with keys like "examples", "data", "results"
-                        for key in ['examples', 'data', 'results', 'samples', 'triples']:
-                            if key in data and isinstance(data[key], list):
-                                triples = data[key]
-                                break
-            else:
-                triples = []
+                    # No valid triples found - show why
+                    print(f"  ⚠️  No valid triples found (got {len(triples)} triples total)")
+                    if len(triples) > 0:
+                        print(f"  📝 Sample: {json.dumps(triples[0], indent=2)[:300]}")
+        
+            except WriterError:
+                raise
+            except Exception as e:
+                error_str = str(e)
+                print(f"  ❌ Error: {error_str}")
+                record_batch(scheduler, topic, batch_size, error=True)
+                telemetry.record_error(topic, type(e).__name__)
+                import traceback
+                print(f"  📍 Traceback: {traceback.format_exc()[:500]}")
+                errors += 1
+                delay = controller.record_error() if controller else backoff_delay(errors)
+                print(f"  ⏳ Backing off {delay:.1f}s")
+                time.sleep(delay)
+    finally:
+        writer.close()
+        final_metrics = telemetry.close(state["generated"])
+    
+    save_dedup_index(dedup, state, force=True)
+    print_generation_summary(generated_count, dedup, controller, scheduler)
+    print_telemetry_summary(final_metrics)
+    return generated_count
+
+async def generate_synthetic_data_async(seed_data, target_size, endpoints, concurrency=None):
+    """
+    Generate data with a bounded pool of concurrent requests.
+    
+    `concurrency` workers (default: the pool's total capacity, i.e.
+    MAX_CONCURRENCY per endpoint) each keep one request in flight, so every
+    server always has work queued instead of idling between batches. The
+    EndpointPool routes each call to the least-loaded healthy server.
+    Workers stop issuing new calls once the samples already generated plus
+    the batches still in flight cover the target (backpressure), and every
+    call is bounded by REQUEST_TIMEOUT_SECONDS.
+    """
+    if not endpoints:
+        print("ERROR: Qwen client not available!")
+        return 0
+    concurrency = concurrency or endpoints.capacity
+    
+    random.seed(42)
+    state = load_generation_state()
+    state["in_flight"] = 0
+    state["in_flight_samples"] = 0
+    dedup = load_dedup_filter(state)
+    writer = open_writer(state)
+    controller = make_batch_controller(state)
+    scheduler = make_scheduler(state, seed_data, target_size)
+    telemetry = start_telemetry(state, writer, target_size, controller, endpoints)
+    errors = {"consecutive": 0}
+    stream_stats = {"calls": 0, "ttfs_total": 0.0, "ttfs_max": 0.0, "latency_total": 0.0}
+    stop = asyncio.Event()
+    
+    print(f"\n🚀 LIGHTNING.AI 100% LOCAL GPU MODE - ASYNC ENGINE")
+    print(f"   Target: {target_size} samples")
+    print(f"   Batch size: {BATCH_SIZE} samples/call{' (adaptive)' if ADAPTIVE_BATCHING else ''}")
+    print(f"   Concurrency: {concurrency} in-flight requests over {len(endpoints)} endpoint(s)")
+    print(f"   Request timeout: {REQUEST_TIMEOUT_SECONDS}s")
+    print(f"   Streaming: {'on (per-sample emission)' if STREAM_RESPONSES else 'off'}")
+    print(f"   Time limit: {MAX_RUNTIME_HOURS:.1f} hours")
+    print(f"   Model: {QWEN_MODEL} (GPU-accelerated)")
+    if not await endpoints.check_all():
+        print("   ⚠️  No endpoint answered the health check; circuits will keep probing")
+    print()
+    endpoints.start_health_checks()
+    
+    async def worker(worker_id):
+        while not stop.is_set():
+            remaining = time_remaining()
+            if remaining <= 0:
+                if not stop.is_set():
+                    print(f"\n⏰ Time limit reached! Stopping at {state['generated']} samples.")
+                stop.set()
+                break
             
-            if batch_count < 3:
-                print(f"  🔍 DEBUG - Found {len(triples)} triples")
+            # Backpressure: don't issue calls the remaining target can't use
+            if state["generated"] + state["in_flight_samples"] >= target_size:
+                if state["in_flight"] == 0:
+                    stop.set()
+                    break
+                await asyncio.sleep(0.1)
+                continue
             
-            # Validate and save
-            valid = [t for t in triples if isinstance(t, dict) and all(k in t for k in ["instruction", "input", "output"])]
+            batch_index = state["topic_cursor"]
+            batch_size, max_tokens = next_call_size(controller)
+            topic, exemplars = next_batch(scheduler, state, seed_data, batch_size)
+            state["in_flight"] += 1
+            state["in_flight_samples"] += batch_size
             
-            if batch_count < 3:
-                print(f"  🔍 DEBUG - Valid triples: {len(valid)}")
-                if len(valid) == 0 and len(triples) > 0:
-                    print(f"  🔍 DEBUG - Sample triple: {triples[0]}")
+            if batch_index % 50 == 0:
+                print(f"[Batch {batch_index+1}] {QWEN_MODEL} | worker {worker_id} | {batch_size}/call, max_tokens {max_tokens} | {state['generated']}/{target_size}")
             
-            if valid:
-                with open(OUTPUT_FILE, "a") as f:
-                    for item in valid:
-                        f.write(json.dumps(item) + "\n")
+            try:
+                request = completion_request(topic, exemplars, batch_size, max_tokens)
+                async with endpoints.acquire() as endpoint:
+                    started = time.perf_counter()
+                    # Single-threaded event loop: counters need no lock, disk I/O is on the writer thread
+                    if STREAM_RESPONSES:
+                        written = []
+                        
+                        def on_sample(sample):
+                            novel = filter_duplicates(dedup, [sample], topic)
+                            if novel:
+                                save_samples(writer, novel, state, new_batch=not written)
+                                written.extend(novel)
+                        
+                        valid_count, output_tokens, truncated, first_sample = await asyncio.wait_for(
+                            stream_completion(endpoint.client, request, on_sample),
+                            timeout=REQUEST_TIMEOUT_SECONDS
+                        )
+                        novel_count, triples_count = len(written), valid_count
+                        parse_failed = valid_count == 0
+                    else:
+                        response = await asyncio.wait_for(
+                            endpoint.client.chat.completions.create(**request),
+                            timeout=REQUEST_TIMEOUT_SECONDS
+                        )
+                        triples, valid, output_tokens, truncated, parse_failed = read_completion(response, batch_index)
+                        novel = filter_duplicates(dedup, valid, topic)
+                        if novel:
+                            save_samples(writer, novel, state)
+                        valid_count, novel_count, triples_count = len(valid), len(novel), len(triples)
+                        first_sample = None
+                    latency = time.perf_counter() - started
+                errors["consecutive"] = 0
                 
-                generated_count += len(valid)
-                batch_count += 1
-                print(f"  ✓ Generated {len(valid)} valid samples | Total: {generated_count}/{target_size}")
+                if controller is not None:
+                    controller.record(batch_size, latency, output_tokens, valid_count, truncated, parse_failed)
+                record_batch(scheduler, topic, batch_size, valid_count, novel_count)
+                telemetry.record_call(topic, latency, output_tokens, batch_size, valid_count, novel_count,
+                                      parse_failed, truncated)
                 
-                # Minimal cooldown
-                time.sleep(COOLDOWN_SECONDS)
-            else:
-                # No valid triples found - show why
-                print(f"  ⚠️  No valid triples found (got {len(triples)} triples total)")
-                if len(triples) > 0:
-                    print(f"  📝 Sample: {json.dumps(triples[0], indent=2)[:300]}")
-                time.sleep(2)
-        
-        except Exception as e:
-            error_str = str(e)
-            print(f"  ❌ Error: {error_str}")
-            import traceback
-            print(f"  📍 Traceback: {traceback.format_exc()[:500]}")
-            time.sleep(5)
+                timing = ""
+                if first_sample is not None:
+                    stream_stats["calls"] += 1
+                    stream_stats["ttfs_total"] += first_sample
+                    stream_stats["ttfs_max"] = max(stream_stats["ttfs_max"], first_sample)
+                    stream_stats["latency_total"] += latency
+                    timing = f" | first sample {first_sample:.2f}s of {latency:.2f}s"
+                
+                if novel_count:
+                    save_dedup_index(dedup, state)
+                    print(f"  ✓ [w{worker_id}] {novel_count} novel samples ({valid_count - novel_count} dupes){timing} | Total: {state['generated']}/{target_size}")
+                    
+                    if state["batches"] % 100 == 0:
+                        print_progress(state["batches"], state["generated"], target_size, remaining)
+                        if dedup is not None:
+                            dedup.print_topic_stats()
+                elif valid_count:
+                    print(f"  ♻️  [w{worker_id}] All {valid_count} valid samples were duplicates ({topic})")
+                else:
+                    print(f"  ⚠️  [w{worker_id}] No valid triples found (got {triples_count} triples total)")
+            
+            except WriterError:
+                stop.set()
+                raise
+            except Exception as e:
+                if isinstance(e, asyncio.TimeoutError):
+                    print(f"  ⏱️  [w{worker_id}] Request timed out after {REQUEST_TIMEOUT_SECONDS}s")
+                else:
+                    print(f"  ❌ [w{worker_id}] Error: {e}")
+                record_batch(scheduler, topic, batch_size, error=True)
+                telemetry.record_error(topic, "timeout" if isinstance(e, asyncio.TimeoutError) else type(e).__name__)
+                errors["consecutive"] += 1
+                delay = controller.record_error() if controller else backoff_delay(errors["consecutive"])
+                await asyncio.sleep(delay)
+            finally:
+                state["in_flight"] -= 1
+                state["in_flight_samples"] -= batch_size
     
-    print(f"\n✅ GENERATION COMPLETE!")
-    print(f"   Generated: {generated_count} samples")
-    print(f"   Runtime: {(datetime.datetime.now() - START_TIME).total_seconds() / 3600:.2f} hours")
-    print(f"   File: {OUTPUT_FILE}")
-    return generated_count
+    try:
+        await asyncio.gather(*(worker(i) for i in range(concurrency)))
+    finally:
+        writer.close()
+        final_metrics = telemetry.close(state["generated"])
+        await endpoints.close()
+    
+    save_dedup_index(dedup, state, force=True)
+    print_generation_summary(state["generated"], dedup, controller, scheduler)
+    print_telemetry_summary(final_metrics)
+    endpoints.print_summary()
+    if stream_stats["calls"]:
+        calls = stream_stats["calls"]
+        print(f"   Time to first sample: mean {stream_stats['ttfs_total'] / calls:.2f}s, "
+              f"max {stream_stats['ttfs_max']:.2f}s (mean call {stream_stats['latency_total'] / calls:.2f}s)")
+    return state["generated"]
 
 if __name__ == "__main__":
     print("=" * 70)
@@ -384,6 +912,7 @@ if __name__ == "__main__":
     print(f"Hardware: NVIDIA L40 GPU (48GB VRAM)")
     print(f"Model: {QWEN_MODEL}")
     print(f"Batch Size: {BATCH_SIZE} samples/call")
+    print(f"Engine: {f'async x{MAX_CONCURRENCY} per endpoint, {len(QWEN_API_BASES)} endpoint(s)' if ASYNC_MODE else 'sequential'}")
     print(f"Target: {TARGET_GENERATION_SIZE} samples")
     print(f"Time Limit: {MAX_RUNTIME_HOURS} hours")
     print(f"Mode: 100% Local (No external APIs)")
@@ -391,7 +920,12 @@ if __name__ == "__main__":
     
     seeds = prepare_seed_data(SEED_FILES, SEED_SAMPLE_SIZE)
     
-    final_count = generate_synthetic_data(seeds, TARGET_GENERATION_SIZE, qwen_client)
+    if ASYNC_MODE:
+        final_count = asyncio.run(
+            generate_synthetic_data_async(seeds, TARGET_GENERATION_SIZE, qwen_endpoints)
+        )
+    else:
+        final_count = generate_synthetic_data(seeds, TARGET_GENERATION_SIZE, qwen_client)
     
     print(f"\n📥 Download {OUTPUT_FILE} from Lightning.ai now!")
     print(f"   Total samples: {final_count}")
@@ -0,0 +1,263 @@
+"""
+Streaming Near-Duplicate Filter for Generated Samples
+=====================================================
+
+Rejects generated samples that repeat something already written:
+
+- Exact duplicates: 64-bit blake2b hash of the normalized instruction+output
+- Near duplicates: MinHash over word 3-gram shingles, indexed with LSH
+  banding (NUM_PERM hashes split into BANDS bands). Two samples collide in
+  a band with probability ~ jaccard ** rows_per_band, so 64 perms x 8 bands
+  flags pairs above ~0.77 Jaccard similarity.
+
+Memory is bounded: the index keeps at most `capacity` samples in fixed-size
+ring buffers (8 bytes per key) plus a key -> slot dict, evicting the oldest
+sample once full. At 200k capacity this stays well under 200 MB.
+
+The index persists to a single binary file (JSON header + raw rings) so a
+resumed run keeps rejecting duplicates of earlier output.
+"""
+
+import hashlib
+import json
+import os
+import random
+import re
+from array import array
+from pathlib import Path
+
+NUM_PERM = 64
+BANDS = 8
+SHINGLE_WORDS = 3
+DEFAULT_CAPACITY = 200_000
+
+_MERSENNE_PRIME = (1 << 61) - 1
+_MAX_HASH = (1 << 32) - 1
+_WORD_RE = re.compile(r"[a-z0-9]+")
+
+
+def _hash64(data: bytes) -> int:
+    """Signed 64-bit hash so it fits an array('q') slot."""
+    return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), "little", signed=True)
+
+
+def _hash32(data: bytes) -> int:
+    return int.from_bytes(hashlib.blake2b(data, digest_size=4).digest(), "little")
+
+
+def sample_text(sample) -> str:
+    """The part of a sample that decides whether it is a duplicate."""
+    return f"{sample.get('instruction', '')}\n{sample.get('output', '')}"
+
+
+def normalize(text: str) -> list:
+    """Lowercase word tokens with punctuation stripped."""
+    return _WORD_RE.findall(str(text).lower())
+
+
+class NearDuplicateFilter:
+    """Exact-hash + MinHash/LSH duplicate filter with a bounded ring-buffer index."""
+
+    def __init__(self, num_perm=NUM_PERM, bands=BANDS, capacity=DEFAULT_CAPACITY, seed=42):
+        if num_perm % bands:
+            raise ValueError(f"num_perm ({num_perm}) must be divisible by bands ({bands})")
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.capacity = capacity
+        self.seed = seed
+
+        rng = random.Random(seed)
+        self._perms = [
+            (rng.randrange(1, _MERSENNE_PRIME), rng.randrange(0, _MERSENNE_PRIME))
+            for _ in range(num_perm)
+        ]
+
+        self._exact_ring = array("q", bytes(8 * capacity))
+        self._band_ring = array("q", bytes(8 * capacity * bands))
+        self._exact = {}  # exact hash -> ring slot
+        self._buckets = {}  # band key -> ring slot
+        self._next = 0  # total samples ever added (ring cursor)
+        self.byte_offset = 0  # output offset the index is in sync with
+        self.synced = 0  # samples indexed up to byte_offset (the rest may never have been written)
+        self.topic_stats = {}
+
+    def __len__(self):
+        return min(self._next, self.capacity)
+
+    @property
+    def indexed(self) -> int:
+        """Samples ever indexed (including evicted ones)."""
+        return self._next
+
+    # --- hashing -------------------------------------------------------
+
+    def _signature(self, tokens):
+        if len(tokens) < SHINGLE_WORDS:
+            shingles = {" ".join(tokens)}
+        else:
+            shingles = {" ".join(tokens[i:i + SHINGLE_WORDS]) for i in range(len(tokens) - SHINGLE_WORDS + 1)}
+        hashes = [_hash32(s.encode("utf-8")) for s in shingles]
+        return [
+            min((a * h + b) % _MERSENNE_PRIME for h in hashes) & _MAX_HASH
+            for a, b in self._perms
+        ]
+
+    def _keys(self, sample):
+        tokens = normalize(sample_text(sample))
+        exact = _hash64(" ".join(tokens).encode("utf-8"))
+        sig = self._signature(tokens)
+        # Mix the band index in so identical rows in different bands don't collide
+        band_keys = [
+            hash((band,) + tuple(sig[band * self.rows:(band + 1) * self.rows]))
+            for band in range(self.bands)
+        ]
+        return exact, band_keys
+
+    # --- index ---------------------------------------------------------
+
+    def _insert(self, exact, band_keys):
+        slot = self._next % self.capacity
+        if self._next >= self.capacity:
+            # Evict the oldest sample, unless a newer one re-claimed its keys
+            old = self._exact_ring[slot]
+            if self._exact.get(old) == slot:
+                del self._exact[old]
+            base = slot * self.bands
+            for old in self._band_ring[base:base + self.bands]:
+                if self._buckets.get(old) == slot:
+                    del self._buckets[old]
+
+        self._exact_ring[slot] = exact
+        self._exact[exact] = slot
+        base = slot * self.bands
+        for i, key in enumerate(band_keys):
+            self._band_ring[base + i] = key
+            self._buckets[key] = slot
+        self._next += 1
+
+    def check(self, sample):
+        """Return 'exact', 'near' or None without modifying the index."""
+        exact, band_keys = self._keys(sample)
+        if exact in self._exact:
+            return "exact"
+        if any(key in self._buckets for key in band_keys):
+            return "near"
+        return None
+
+    def add(self, sample):
+        """Index a sample unconditionally."""
+        self._insert(*self._keys(sample))
+
+    def filter(self, samples, topic=None):
+        """
+        Return the novel samples (in order) and index them.
+
+        Duplicates inside the same batch are caught too, since each accepted
+        sample is indexed before the next one is checked.
+        """
+        stats = self.topic_stats.setdefault(topic or "unknown", {"accepted": 0, "exact": 0, "near": 0})
+        novel = []
+        for sample in samples:
+            exact, band_keys = self._keys(sample)
+            if exact in self._exact:
+                stats["exact"] += 1
+            elif any(key in self._buckets for key in band_keys):
+                stats["near"] += 1
+            else:
+                self._insert(exact, band_keys)
+                stats["accepted"] += 1
+                novel.append(sample)
+        return novel
+
+    def rollback(self, count):
+        """
+        Forget every sample indexed after the first `count`.
+
+        Used on resume to drop samples that were handed to the writer but
+        never flushed. Older samples those had already evicted stay evicted.
+        """
+        if count >= self._next:
+            return
+        for n in range(max(count, self._next - self.capacity), self._next):
+            slot = n % self.capacity
+            self._exact_ring[slot] = 0
+            base = slot * self.bands
+            for i in range(self.bands):
+                self._band_ring[base + i] = 0
+        self._next = count
+        self._rebuild()
+
+    def _rebuild(self):
+        """Rebuild lookup dicts oldest -> newest so newer samples own shared keys."""
+        self._exact.clear()
+        self._buckets.clear()
+        for n in range(max(0, self._next - self.capacity), self._next):
+            slot = n % self.capacity
+            self._exact[self._exact_ring[slot]] = slot
+            base = slot * self.bands
+            for key in self._band_ring[base:base + self.bands]:
+                self._buckets[key] = slot
+
+    def duplicate_rate(self, topic):
+        """Fraction of samples for a topic rejected as duplicates."""
+        stats = self.topic_stats.get(topic)
+        if not stats:
+            return 0.0
+        seen = stats["accepted"] + stats["exact"] + stats["near"]
+        return (stats["exact"] + stats["near"]) / seen if seen else 0.0
+
+    def print_topic_stats(self):
+        """Print per-topic duplicate rates, most exhausted topics first."""
+        print("   Duplicate rate by topic:")
+        for topic in sorted(self.topic_stats, key=self.duplicate_rate, reverse=True):
+            stats = self.topic_stats[topic]
+            print(f"     {self.duplicate_rate(topic):5.1%}  {topic} "
+                  f"(kept {stats['accepted']}, exact {stats['exact']}, near {stats['near']})")
+
+    # --- persistence ---------------------------------------------------
+
+    def save(self, path):
+        """Atomically write the index (header + rings) to `path`."""
+        path = Path(path)
+        header = json.dumps({
+            "num_perm": self.num_perm,
+            "bands": self.bands,
+            "capacity": self.capacity,
+            "seed": self.seed,
+            "next": self._next,
+            "byte_offset": self.byte_offset,
+            "synced": self.synced,
+            "topic_stats": self.topic_stats,
+        }).encode("utf-8")
+        used = len(self)  # Rings fill slots 0..used-1 before wrapping
+        tmp_path = path.with_name(path.name + ".tmp")
+        with open(tmp_path, "wb") as f:
+            f.write(len(header).to_bytes(8, "little"))
+            f.write(header)
+            self._exact_ring[:used].tofile(f)
+            self._band_ring[:used * self.bands].tofile(f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        """Load an index written by `save`."""
+        with open(path, "rb") as f:
+            header = json.loads(f.read(int.from_bytes(f.read(8), "little")))
+            index = cls(header["num_perm"], header["bands"], header["capacity"], header["seed"])
+            index._next = header["next"]
+            used = len(index)
+            exact = array("q")
+            exact.fromfile(f, used)
+            index._exact_ring[:used] = exact
+            bands = array("q")
+            bands.fromfile(f, used * index.bands)
+            index._band_ring[:used * index.bands] = bands
+
+        index.byte_offset = header["byte_offset"]
+        index.synced = header.get("synced", index._next)
+        index.topic_stats = header["topic_stats"]
+        index._rebuild()
+        return index
@@ -0,0 +1,194 @@
+"""
+Incremental Salvage Parser for Truncated / Malformed LLM JSON
+=============================================================
+
+`json.loads` on a batch response is all-or-nothing: when the model is
+cut off at max_tokens, every sample in the batch is lost. This parser
+scans the text once, tracking strings, escapes and brace depth, and
+emits every complete `{instruction, input, output}` object as soon as
+its closing brace is seen:
+
+- Truncated arrays: all objects before the cut are kept
+- Wrapped variants ({"examples": [...]}, {"data": ...}, {"results": ...},
+  nested wrappers, a single bare object) need no special-casing, because
+  wrapper objects simply aren't samples
+- Markdown fences and prose around the JSON are skipped
+- Trailing commas are repaired and raw control characters inside
+  strings are tolerated
+
+Text is fed in chunks (`IncrementalSampleParser.feed`), so the same
+parser also drives the streaming generation mode.
+
+Run this file to check the regression/benchmark corpus:
+
+    python json_salvage.py                    # Regression check
+    python json_salvage.py --bench 2000       # Also time 2000 passes
+"""
+
+import json
+import re
+from pathlib import Path
+
+SAMPLE_KEYS = ("instruction", "input", "output")
+FIXTURES_FILE = Path(__file__).parent / "fixtures" / "malformed_responses.jsonl"
+
+_TRAILING_COMMA_RE = re.compile(r",\s*([}\]])")
+_SPECIAL_RE = re.compile(r'[{}"\\]')
+
+
+def is_sample(obj) -> bool:
+    """True for a dict carrying all sample keys."""
+    return isinstance(obj, dict) and all(k in obj for k in SAMPLE_KEYS)
+
+
+def _escape_inner_quotes(fragment):
+    """
+    Escape quotes that can't be JSON delimiters, e.g. `"Say "no" to salt"`.
+    
+    A delimiter quote is preceded (ignoring spaces) by one of `{[,:` or
+    followed by one of `,:}]`; anything else is text inside a string.
+    """
+    out = []
+    last = 0
+    for match in re.finditer(r'(?<!\\)"', fragment):
+        i = match.start()
+        before = fragment[:i].rstrip()[-1:]
+        after = fragment[i + 1:].lstrip()[:1]
+        if before not in ("{", "[", ",", ":", "") and after not in (",", ":", "}", "]", ""):
+            out.append(fragment[last:i] + '\\"')
+            last = i + 1
+    out.append(fragment[last:])
+    return "".join(out)
+
+
+def _loads_lenient(fragment):
+    """Parse one object, trying cheap repairs in turn. Returns None on failure."""
+    candidates = (
+        lambda f: f,
+        lambda f: _TRAILING_COMMA_RE.sub(r"\1", f),
+        lambda f: _escape_inner_quotes(_TRAILING_COMMA_RE.sub(r"\1", f)),
+    )
+    for repair in candidates:
+        try:
+            return json.loads(repair(fragment), strict=False)  # strict=False allows raw newlines/tabs in strings
+        except json.JSONDecodeError:
+            continue
+    return None
+
+
+class IncrementalSampleParser:
+    """Feed text chunks, get back each complete sample object as it closes."""
+
+    def __init__(self):
+        self._text = ""
+        self._pos = 0  # Next character to scan
+        self._in_string = False
+        self._skip = -1  # Offset of a backslash-escaped character to ignore
+        self._starts = []  # Offsets of currently open '{'
+        self.objects_seen = 0
+        self.objects_rejected = 0  # Closed objects that couldn't be parsed
+
+    def feed(self, chunk):
+        """Consume more text; return the samples completed by it."""
+        if not chunk:
+            return []
+        self._text += chunk
+        text = self._text
+        samples = []
+
+        in_string, skip, starts = self._in_string, self._skip, self._starts
+        # Jump between the only characters that change parser state
+        for match in _SPECIAL_RE.finditer(text, self._pos):
+            i = match.start()
+            if i == skip:
+                continue
+            ch = text[i]
+            if in_string:
+                if ch == "\\":
+                    skip = i + 1
+                elif ch == '"':
+                    in_string = False
+            elif ch == '"':
+                in_string = True
+            elif ch == "{":
+                starts.append(i)
+            elif ch == "}" and starts:
+                start = starts.pop()
+                self.objects_seen += 1
+                obj = _loads_lenient(text[start:i + 1])
+                if obj is None:
+                    self.objects_rejected += 1
+                elif is_sample(obj):
+                    samples.append(obj)
+
+        self._pos = len(text)
+        self._in_string, self._skip = in_string, skip
+        self._compact()
+        return samples
+
+    def _compact(self):
+        """Drop text no open object can refer to (keeps memory flat when streaming)."""
+        keep_from = self._starts[0] if self._starts else self._pos
+        if keep_from > 4096:
+            self._text = self._text[keep_from:]
+            self._starts[:] = [s - keep_from for s in self._starts]
+            self._pos -= keep_from
+            self._skip -= keep_from
+
+    def close(self):
+        """Finish the stream. Returns True if the text ended mid-object (truncated)."""
+        return bool(self._starts) or self._in_string
+
+
+def salvage_samples(raw):
+    """Every complete sample object in `raw`, in order."""
+    parser = IncrementalSampleParser()
+    return parser.feed(raw or "")
+
+
+def load_fixtures(path=FIXTURES_FILE):
+    """Load the malformed-response corpus: one {name, raw, expected} per line."""
+    with open(path, "r", encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def main():
+    import argparse
+    import time
+
+    parser = argparse.ArgumentParser(description="Salvage parser regression check and benchmark")
+    parser.add_argument("--fixtures", default=str(FIXTURES_FILE))
+    parser.add_argument("--bench", type=int, default=0, help="Timed passes over the corpus")
+    args = parser.parse_args()
+
+    fixtures = load_fixtures(args.fixtures)
+    failures = 0
+    for fx in fixtures:
+        try:
+            json.loads(fx["raw"])
+            strict = "ok"
+        except json.JSONDecodeError:
+            strict = "fails"
+        got = len(salvage_samples(fx["raw"]))
+        ok = got == fx["expected"]
+        failures += not ok
+        print(f"  {'✓' if ok else '❌'} {fx['name']:<32} salvaged {got:>2}/{fx['expected']:<2} (json.loads: {strict})")
+
+    if args.bench:
+        chars = sum(len(fx["raw"]) for fx in fixtures)
+        start = time.perf_counter()
+        for _ in range(args.bench):
+            for fx in fixtures:
+                salvage_samples(fx["raw"])
+        elapsed = time.perf_counter() - start
+        print(f"\n⏱️  {args.bench} passes: {elapsed:.2f}s "
+              f"({args.bench * chars / elapsed / 1e6:.1f} MB/s, "
+              f"{elapsed / (args.bench * len(fixtures)) * 1e6:.0f} µs/response)")
+
+    if failures:
+        raise SystemExit(f"{failures} fixture(s) failed")
+    print(f"\n✅ All {len(fixtures)} fixtures salvaged as expected")
+
+
+if __name__ == "__main__":
+    main()
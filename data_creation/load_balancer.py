@@ -0,0 +1,248 @@
+"""
+Multi-Endpoint Load Balancer for Local Inference Servers
+========================================================
+
+Spreads generation calls over several OpenAI-compatible servers (one
+Ollama/vLLM instance per GPU) so aggregate throughput scales with the
+number of servers:
+
+- Routing: least outstanding requests, weighted by each endpoint's
+  latency EWMA, so a slow or overloaded server gets fewer calls
+- Capacity: at most `max_outstanding` requests per endpoint (match
+  OLLAMA_NUM_PARALLEL / vLLM max_num_seqs); callers wait for a free slot
+- Circuit breaker: FAILURE_THRESHOLD consecutive failures open an
+  endpoint's circuit for a cooldown that doubles on every re-trip (capped
+  at MAX_OPEN_SECONDS); after the cooldown one trial call is let through
+  (half-open) and its outcome closes or re-opens the circuit
+- Health checks: a background task polls GET /models on every endpoint;
+  a failed probe opens the circuit, a successful probe lets an open
+  circuit go half-open early
+- Connection pooling: one long-lived AsyncOpenAI client per endpoint,
+  so calls reuse its keep-alive connections instead of reconnecting
+
+Client-side retries are disabled (max_retries=0): a failed call goes back
+through the balancer, which routes the retry to a healthy server.
+"""
+
+import asyncio
+import contextlib
+import time
+
+import openai
+from openai import AsyncOpenAI
+
+FAILURE_THRESHOLD = 3  # Consecutive failures that open a circuit
+BASE_OPEN_SECONDS = 5.0  # First cooldown of an open circuit
+MAX_OPEN_SECONDS = 120.0
+HEALTH_CHECK_INTERVAL = 15.0  # Seconds between background /models probes
+HEALTH_CHECK_TIMEOUT = 5.0
+LATENCY_ALPHA = 0.2  # EWMA smoothing for per-endpoint latency
+
+CLOSED, OPEN, HALF_OPEN = "closed", "open", "half-open"
+
+
+def parse_endpoints(value):
+    """Split a comma/whitespace separated list of base URLs."""
+    return [url.strip().rstrip("/") for url in value.replace(",", " ").split() if url.strip()]
+
+
+def is_endpoint_failure(exc):
+    """Errors that say something about the server (vs. our own bugs or 4xx requests)."""
+    if isinstance(exc, (asyncio.TimeoutError, openai.APIConnectionError, OSError)):
+        return True
+    return isinstance(exc, openai.APIStatusError) and (exc.status_code >= 500 or exc.status_code == 429)
+
+
+class Endpoint:
+    """One inference server: its pooled client plus routing and breaker state."""
+
+    def __init__(self, base_url, api_key, timeout, max_outstanding):
+        self.base_url = base_url
+        self.max_outstanding = max_outstanding
+        self.client = AsyncOpenAI(
+            api_key=api_key,
+            base_url=base_url,
+            timeout=timeout,
+            max_retries=0,
+        )
+
+        self.outstanding = 0
+        self.latency = None  # EWMA seconds per successful call
+        self.state = CLOSED
+        self.consecutive_failures = 0
+        self.open_until = 0.0
+        self.open_seconds = BASE_OPEN_SECONDS
+        self.trial_in_flight = False
+
+        self.requests = 0
+        self.failures = 0
+        self.busy_seconds = 0.0
+
+    def available(self, now):
+        """Can this endpoint take another call right now?"""
+        if self.state == OPEN:
+            if now < self.open_until:
+                return False
+            self.state = HALF_OPEN  # Cooldown over: allow one trial call
+        if self.state == HALF_OPEN:
+            return not self.trial_in_flight
+        return self.outstanding < self.max_outstanding
+
+    def score(self, typical_latency):
+        """Expected wait if this endpoint takes the next call (lower is better)."""
+        return (self.outstanding + 1) * (self.latency or typical_latency)
+
+    def record_success(self, latency, trial=False):
+        """Record a finished call; only the half-open trial call may close the circuit."""
+        self.latency = latency if self.latency is None else self.latency + LATENCY_ALPHA * (latency - self.latency)
+        if self.state != CLOSED and not trial:
+            return  # Admitted before the circuit opened: says nothing about recovery
+        self.consecutive_failures = 0
+        if self.state != CLOSED:
+            print(f"  🟢 Endpoint {self.base_url} recovered")
+        self.state = CLOSED
+        self.open_seconds = BASE_OPEN_SECONDS
+
+    def record_failure(self, now, trip=False, trial=False):
+        """Count a failure; `trip` opens the circuit at once (the server is unreachable)."""
+        self.failures += 1
+        self.consecutive_failures += 1
+        if self.state == OPEN:
+            return  # A call already in flight when the circuit opened
+        if self.state == HALF_OPEN and not (trial or trip):
+            return  # Stale call: the trial decides
+        if trip or self.state == HALF_OPEN or self.consecutive_failures >= FAILURE_THRESHOLD:
+            if self.state == HALF_OPEN:
+                self.open_seconds = min(MAX_OPEN_SECONDS, self.open_seconds * 2)
+            self.state = OPEN
+            self.open_until = now + self.open_seconds
+            print(f"  🔴 Endpoint {self.base_url} circuit open for {self.open_seconds:.0f}s "
+                  f"({self.consecutive_failures} consecutive failures)")
+
+
+class EndpointPool:
+    """Routes calls across endpoints; use `async with pool.acquire() as endpoint:`."""
+
+    def __init__(self, base_urls, api_key="EMPTY", timeout=180.0, max_outstanding=8):
+        if not base_urls:
+            raise ValueError("EndpointPool needs at least one base URL")
+        self.endpoints = [Endpoint(url, api_key, timeout, max_outstanding) for url in base_urls]
+        self._changed = None  # asyncio.Condition, created inside the running loop
+        self._health_task = None
+
+    def __len__(self):
+        return len(self.endpoints)
+
+    @property
+    def capacity(self):
+        """Total concurrent calls the pool accepts."""
+        return sum(ep.max_outstanding for ep in self.endpoints)
+
+    def _condition(self):
+        if self._changed is None:
+            self._changed = asyncio.Condition()
+        return self._changed
+
+    def _pick(self, now):
+        candidates = [ep for ep in self.endpoints if ep.available(now)]
+        if not candidates:
+            return None
+        known = [ep.latency for ep in self.endpoints if ep.latency is not None]
+        typical = sum(known) / len(known) if known else 1.0
+        return min(candidates, key=lambda ep: (ep.score(typical), ep.outstanding))
+
+    def _next_reopen(self, now):
+        """Seconds until the earliest open circuit goes half-open."""
+        waits = [ep.open_until - now for ep in self.endpoints if ep.state == OPEN]
+        return max(0.05, min(waits)) if waits else None
+
+    @contextlib.asynccontextmanager
+    async def acquire(self):
+        """
+        Wait for the best available endpoint and hold one of its slots.
+
+        Latency and failures are recorded when the block exits; only
+        server-side errors (see `is_endpoint_failure`) count against the
+        endpoint's circuit.
+        """
+        changed = self._condition()
+        async with changed:
+            while True:
+                now = time.monotonic()
+                endpoint = self._pick(now)
+                if endpoint is not None:
+                    break
+                with contextlib.suppress(asyncio.TimeoutError):
+                    await asyncio.wait_for(changed.wait(), timeout=self._next_reopen(now))
+            endpoint.outstanding += 1
+            endpoint.requests += 1
+            is_trial = endpoint.state == HALF_OPEN
+            if is_trial:
+                endpoint.trial_in_flight = True
+
+        started = time.monotonic()
+        try:
+            yield endpoint
+        except BaseException as e:
+            if isinstance(e, Exception) and is_endpoint_failure(e):
+                endpoint.record_failure(time.monotonic(), trial=is_trial)
+            raise
+        else:
+            endpoint.record_success(time.monotonic() - started, trial=is_trial)
+        finally:
+            endpoint.busy_seconds += time.monotonic() - started
+            endpoint.outstanding -= 1
+            if is_trial:
+                endpoint.trial_in_flight = False
+            async with changed:
+                changed.notify_all()
+
+    # --- health checks -------------------------------------------------
+
+    async def check(self, endpoint):
+        """Probe GET /models; returns True if the server answered."""
+        try:
+            await endpoint.client.with_options(timeout=HEALTH_CHECK_TIMEOUT).models.list()
+        except Exception:
+            endpoint.record_failure(time.monotonic(), trip=True)
+            return False
+        if endpoint.state == OPEN:
+            endpoint.state = HALF_OPEN  # Let a real call confirm recovery
+            async with self._condition():
+                self._changed.notify_all()
+        return True
+
+    async def check_all(self):
+        """Probe every endpoint once and print which are up."""
+        results = await asyncio.gather(*(self.check(ep) for ep in self.endpoints))
+        for endpoint, ok in zip(self.endpoints, results):
+            print(f"   {'✓' if ok else '❌'} {endpoint.base_url} (max {endpoint.max_outstanding} in flight)")
+        return sum(results)
+
+    async def _health_loop(self, interval):
+        while True:
+            await asyncio.sleep(interval)
+            await asyncio.gather(*(self.check(ep) for ep in self.endpoints))
+
+    def start_health_checks(self, interval=HEALTH_CHECK_INTERVAL):
+        if self._health_task is None:
+            self._health_task = asyncio.create_task(self._health_loop(interval))
+
+    async def close(self):
+        """Stop health checks and close every pooled connection."""
+        if self._health_task is not None:
+            self._health_task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._health_task
+            self._health_task = None
+        for endpoint in self.endpoints:
+            await endpoint.client.close()
+
+    # --- reporting -----------------------------------------------------
+
+    def print_summary(self):
+        print("   Endpoints:")
+        for ep in self.endpoints:
+            latency = f"{ep.latency:.2f}s" if ep.latency is not None else "n/a"
+            print(f"     {ep.base_url}: {ep.requests} calls, {ep.failures} failures, "
+                  f"latency {latency}, {ep.busy_seconds:.0f}s busy, circuit {ep.state}")
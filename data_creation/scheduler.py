@@ -0,0 +1,214 @@
+"""
+Diversity-Aware Topic and Seed-Exemplar Scheduler
+=================================================
+
+Decides, for every generation call, which topic to ask about and which
+seed examples to show the model:
+
+- Topics: each topic has an equal quota of the target. A call goes to a
+  topic with probability proportional to its remaining deficit (quota minus
+  accepted and in-flight samples) times its recent novelty rate (EWMA of
+  novel / valid samples). Under-covered topics get more calls; topics
+  whose output keeps getting rejected as duplicates get fewer, so fewer
+  calls are wasted.
+- Exemplars: up to TOPICAL_EXEMPLARS seeds whose text mentions the topic's
+  keywords, then the rest rotated round-robin across seed sources
+  (intents, claude, gemini). Each source (and each topic's matches) is
+  walked in a shuffled order and fully cycled before anything repeats, so
+  all loaded seeds get used instead of the same first five.
+
+`state_dict` / `load_state_dict` round-trip through JSON, so the manifest
+can restore the scheduler on resume. Shuffle orders are derived from
+(seed, source, pass), so only cursors need to be stored.
+"""
+
+import random
+import re
+
+from checkpoint import rng_state_to_json, rng_state_from_json
+
+EXEMPLARS_PER_CALL = 5
+TOPICAL_EXEMPLARS = 2  # Of those, how many should match the topic's keywords
+NOVELTY_ALPHA = 0.2  # EWMA smoothing for per-topic novelty
+MIN_NOVELTY = 0.05  # Floor so an exhausted topic can still recover
+PROMPT_KEYS = ("instruction", "input", "output")
+
+_WORD_RE = re.compile(r"[a-z]+")
+# Topic words too generic to find topical seeds with
+_GENERIC_WORDS = {
+    "and", "or", "of", "the", "advice", "management", "common", "relief",
+    "safety", "issues", "health", "prevention", "treating", "minor", "well",
+    "being", "comfort", "loss",
+}
+
+
+def topic_keywords(topic):
+    """Distinctive lowercase word stems of a topic name."""
+    words = [w for w in _WORD_RE.findall(topic.lower()) if w not in _GENERIC_WORDS and len(w) > 2]
+    return tuple(w[:5] for w in words)  # Crude stemming: "memory" ~ "memories", "fall" ~ "falls"
+
+
+class _Rotation:
+    """Cycle through item indices in a fresh shuffled order each pass."""
+
+    def __init__(self, key, items, seed):
+        self.key = key
+        self.items = items
+        self.seed = seed
+        self.passes = 0
+        self.position = 0
+        self._order = None
+
+    def _shuffled(self):
+        order = list(self.items)
+        random.Random(f"{self.seed}:{self.key}:{self.passes}").shuffle(order)
+        return order
+
+    def next(self):
+        if not self.items:
+            return None
+        if self._order is None:
+            self._order = self._shuffled()
+        if self.position >= len(self._order):
+            self.passes += 1
+            self.position = 0
+            self._order = self._shuffled()
+        item = self._order[self.position]
+        self.position += 1
+        return item
+
+    def state(self):
+        return [self.passes, self.position]
+
+    def restore(self, state):
+        self.passes, self.position = state
+        self._order = None
+
+
+class DiversityScheduler:
+    """Picks (topic, exemplars) per call and learns per-topic novelty."""
+
+    def __init__(self, topics, seed_data, target_size, exemplars_per_call=EXEMPLARS_PER_CALL,
+                 topical_exemplars=TOPICAL_EXEMPLARS, seed=42):
+        self.topics = list(topics)
+        self.seed_data = seed_data
+        self.target_size = target_size
+        self.exemplars_per_call = exemplars_per_call
+        self.topical_exemplars = topical_exemplars
+        self.seed = seed
+        self._rng = random.Random(seed)  # Private: keep the checkpointed global RNG untouched
+
+        by_source = {}
+        for i, sample in enumerate(seed_data):
+            by_source.setdefault(sample.get("source", "seed"), []).append(i)
+        self._sources = {name: _Rotation(f"source:{name}", idx, seed) for name, idx in sorted(by_source.items())}
+        self._source_cursor = 0
+
+        texts = [f"{s.get('instruction', '')} {s.get('output', '')}".lower() for s in seed_data]
+        self._topical = {}
+        for topic in self.topics:
+            keys = topic_keywords(topic)
+            matches = [i for i, text in enumerate(texts)
+                       if any(w.startswith(keys) for w in _WORD_RE.findall(text))] if keys else []
+            self._topical[topic] = _Rotation(f"topic:{topic}", matches, seed)
+
+        self.stats = {
+            topic: {"calls": 0, "valid": 0, "accepted": 0, "novelty": 1.0, "pending": 0}
+            for topic in self.topics
+        }
+
+    # --- scheduling ----------------------------------------------------
+
+    @property
+    def quota(self):
+        return self.target_size / len(self.topics)
+
+    def weight(self, topic):
+        """Expected useful samples from calling this topic next."""
+        stats = self.stats[topic]
+        novelty = max(MIN_NOVELTY, stats["novelty"])
+        deficit = self.quota - stats["accepted"] - stats["pending"] * novelty
+        # Past quota, keep a small weight so every topic stays reachable
+        return max(deficit, self.quota * 0.01) * novelty
+
+    def next_topic(self):
+        weights = [self.weight(t) for t in self.topics]
+        return self._rng.choices(self.topics, weights=weights)[0]
+
+    def exemplars(self, topic):
+        """Seeds to show for one call: topical matches first, then across sources."""
+        if not self.seed_data:
+            return []
+        count = min(self.exemplars_per_call, len(self.seed_data))
+        chosen = []
+        topical = self._topical[topic]
+        for _ in range(min(self.topical_exemplars, len(topical.items))):
+            i = topical.next()
+            if i not in chosen:
+                chosen.append(i)
+
+        names = list(self._sources)
+        attempts = 0
+        while len(chosen) < count and attempts < count * len(names) * 2:
+            rotation = self._sources[names[self._source_cursor % len(names)]]
+            self._source_cursor += 1
+            attempts += 1
+            i = rotation.next()
+            if i not in chosen:
+                chosen.append(i)
+        return [{k: self.seed_data[i].get(k, "") for k in PROMPT_KEYS} for i in chosen]
+
+    def next_batch(self, batch_size):
+        """Return (topic, exemplars) for a call requesting `batch_size` samples."""
+        topic = self.next_topic()
+        self.stats[topic]["calls"] += 1
+        self.stats[topic]["pending"] += batch_size
+        return topic, self.exemplars(topic)
+
+    def record(self, topic, requested, valid=0, novel=0, error=False):
+        """Feed back one call's outcome (error=True only releases its pending samples)."""
+        stats = self.stats[topic]
+        stats["pending"] = max(0, stats["pending"] - requested)
+        if error:
+            return
+        stats["valid"] += valid
+        stats["accepted"] += novel
+        if valid:
+            stats["novelty"] += NOVELTY_ALPHA * (novel / valid - stats["novelty"])
+
+    # --- reporting / resume --------------------------------------------
+
+    def print_topic_stats(self, limit=None):
+        """Per-topic coverage and novelty, least covered first."""
+        print("   Topic coverage (accepted / quota, novelty):")
+        order = sorted(self.topics, key=lambda t: self.stats[t]["accepted"])
+        for topic in order[:limit]:
+            stats = self.stats[topic]
+            print(f"     {stats['accepted']:>6}/{self.quota:<6.0f} {stats['novelty']:5.0%}  "
+                  f"{topic} ({stats['calls']} calls)")
+
+    def state_dict(self):
+        return {
+            "seed_count": len(self.seed_data),
+            "rng_state": rng_state_to_json(self._rng.getstate()),
+            "source_cursor": self._source_cursor,
+            "sources": {name: r.state() for name, r in self._sources.items()},
+            "topical": {topic: r.state() for topic, r in self._topical.items()},
+            "stats": {topic: {k: v for k, v in s.items() if k != "pending"} for topic, s in self.stats.items()},
+        }
+
+    def load_state_dict(self, state):
+        for topic, saved in state.get("stats", {}).items():
+            if topic in self.stats:
+                self.stats[topic].update(saved)
+        if state.get("rng_state"):
+            self._rng.setstate(rng_state_from_json(state["rng_state"]))
+        if state.get("seed_count") != len(self.seed_data):
+            return  # Different seeds: coverage stats still apply, exemplar cursors don't
+        self._source_cursor = state.get("source_cursor", 0)
+        for name, saved in state.get("sources", {}).items():
+            if name in self._sources:
+                self._sources[name].restore(saved)
+        for topic, saved in state.get("topical", {}).items():
+            if topic in self._topical:
+                self._topical[topic].restore(saved)
@@ -0,0 +1,318 @@
+"""
+Streaming Seed Loader
+=====================
+
+Reads seed corpora row by row and reservoir-samples them, so startup cost
+is one pass over the file with memory bounded by the sample size, and
+pandas is only imported for file shapes the streaming readers don't handle.
+
+Supported files (optionally gzip-compressed, e.g. seeds.jsonl.gz):
+- .jsonl: one JSON object per line (only the sampled lines are parsed)
+- .json: a top-level array of objects, or an object whose list values are
+  streamed element by element; `{"intents": [...]}` is expanded into
+  pattern x response pairs one intent at a time
+- .csv / .tsv / anything else: csv module with a sniffed delimiter
+
+Every row is reduced to {"text", "label"} with the same column
+auto-detection as before (TEXT_COLUMNS / LABEL_COLUMNS, first match wins);
+instruction/output arrays in .json files map instruction -> text and
+output -> label.
+"""
+
+import csv
+import gzip
+import itertools
+import json
+import math
+import random
+from pathlib import Path
+
+TEXT_COLUMNS = ['text', 'question', 'prompt', 'input', 'instruction']
+LABEL_COLUMNS = ['label', 'answer', 'response', 'output']
+SEED_EXTENSIONS = ['.json', '.jsonl', '.csv', '.json.gz', '.jsonl.gz', '.csv.gz']
+READ_CHUNK_CHARS = 1 << 16
+SNIFF_CHARS = 1 << 14
+
+_decoder = json.JSONDecoder()
+
+
+class UnsupportedSeedFormat(ValueError):
+    """The streaming readers can't handle this file; fall back to pandas."""
+
+
+def seed_format(path):
+    """('json' | 'jsonl' | 'csv', compressed) from the file name."""
+    suffixes = [s.lower() for s in Path(path).suffixes]
+    compressed = bool(suffixes) and suffixes[-1] == '.gz'
+    if compressed:
+        suffixes = suffixes[:-1]
+    ext = suffixes[-1] if suffixes else ''
+    if ext == '.jsonl':
+        return 'jsonl', compressed
+    if ext == '.json':
+        return 'json', compressed
+    return 'csv', compressed
+
+
+def open_text(path, compressed):
+    if compressed:
+        return gzip.open(path, 'rt', encoding='utf-8', newline='')
+    return open(path, 'r', encoding='utf-8', newline='')
+
+
+# --- streaming JSON ----------------------------------------------------
+
+class _JsonStream:
+    """Minimal pull parser: decode one JSON value at a time from a text file."""
+
+    def __init__(self, f):
+        self.f = f
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self):
+        if self.eof:
+            return False
+        chunk = self.f.read(READ_CHUNK_CHARS)
+        if not chunk:
+            self.eof = True
+            return False
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """Next non-whitespace character ('' at end of file)."""
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in ' \t\r\n':
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._fill():
+                return ''
+
+    def expect(self, chars):
+        ch = self.peek()
+        if ch not in chars:
+            raise UnsupportedSeedFormat(f"Expected one of {chars!r}, got {ch!r}")
+        self.pos += 1
+        return ch
+
+    def value(self):
+        """Decode the next complete value, reading more text until it parses."""
+        self.peek()
+        while True:
+            try:
+                obj, end = _decoder.raw_decode(self.buf, self.pos)
+            except json.JSONDecodeError:
+                if not self._fill():
+                    raise
+                continue
+            # A number at the end of the buffer may continue in the next chunk
+            if end == len(self.buf) and not self.eof and self._fill():
+                continue
+            self.pos = end
+            return obj
+
+    def array_items(self):
+        """Yield the elements of the array starting at the cursor."""
+        self.expect('[')
+        if self.peek() == ']':
+            self.pos += 1
+            return
+        while True:
+            yield self.value()
+            if self.expect(',]') == ']':
+                return
+
+
+def _intent_pairs(intent):
+    patterns = intent.get("patterns", [])
+    responses = intent.get("responses", [])
+    if isinstance(patterns, str): patterns = [patterns]
+    if isinstance(responses, str): responses = [responses]
+    for p in patterns:
+        for r in responses:
+            yield {"text": p, "label": r}
+
+
+def _iter_json(f):
+    stream = _JsonStream(f)
+    root = stream.peek()
+    if root == '[':
+        items = stream.array_items()
+        first = next(items, None)
+        if first is None:
+            return
+        # instruction/output arrays: instruction is the text even though 'input' is a candidate too
+        if isinstance(first, dict) and 'instruction' in first:
+            yield from ({"text": r.get('instruction'), "label": r.get('output')}
+                        for r in itertools.chain([first], items))
+        else:
+            yield from _with_columns(itertools.chain([first], items))
+        return
+    if root != '{':
+        raise UnsupportedSeedFormat(f"Unexpected JSON root {root!r}")
+
+    stream.expect('{')
+    while stream.peek() != '}':
+        key = stream.value()
+        stream.expect(':')
+        if stream.peek() == '[':
+            if key == 'intents':
+                for intent in stream.array_items():
+                    yield from _intent_pairs(intent)
+            else:
+                yield from _with_columns(stream.array_items())
+        else:
+            stream.value()  # Metadata next to the data list
+        if stream.expect(',}') == '}':
+            return
+
+
+# --- column detection --------------------------------------------------
+
+def detect_columns(columns):
+    """(text column, label column) by the usual candidate order."""
+    text_col = next((c for c in TEXT_COLUMNS if c in columns), None)
+    label_col = next((c for c in LABEL_COLUMNS if c in columns), None)
+    if not text_col or not label_col:
+        raise ValueError(f"Seed file must contain text and label columns. Found: {list(columns)}")
+    return text_col, label_col
+
+
+def _with_columns(rows):
+    """Map rows onto text/label using the columns of the first row."""
+    text_col = label_col = None
+    for row in rows:
+        if not isinstance(row, dict):
+            raise UnsupportedSeedFormat(f"Seed rows must be objects, got {type(row).__name__}")
+        if text_col is None:
+            text_col, label_col = detect_columns(row.keys())
+        yield {"text": row.get(text_col), "label": row.get(label_col)}
+
+
+def _iter_jsonl(f):
+    """
+    Raw lines plus a decoder: only the first line (for column detection) and
+    the lines that end up in the sample are ever parsed.
+    """
+    lines = (line for line in f if line.strip())
+    first = next(lines, None)
+    if first is None:
+        return [], None
+    row = json.loads(first)
+    if not isinstance(row, dict):
+        raise UnsupportedSeedFormat(f"Seed rows must be objects, got {type(row).__name__}")
+    text_col, label_col = detect_columns(row.keys())
+
+    def decode(line):
+        row = json.loads(line)
+        return {"text": row.get(text_col), "label": row.get(label_col)}
+
+    return itertools.chain([first], lines), decode
+
+
+def _iter_csv(f):
+    head = []
+    size = 0
+    for line in f:
+        head.append(line)
+        size += len(line)
+        if size >= SNIFF_CHARS:
+            break
+    try:
+        dialect = csv.Sniffer().sniff(''.join(head), delimiters=',\t;|')
+    except csv.Error:
+        dialect = csv.excel
+    return _with_columns(csv.DictReader(itertools.chain(head, f), dialect=dialect)), None
+
+
+def sample_seed_rows(path, k, rng):
+    """
+    Stream a seed file once and keep a uniform sample of k {"text", "label"}
+    rows. Returns (rows, rows seen). Rows with an empty text or label are
+    dropped after sampling, so a file with blanks can return slightly fewer
+    than k.
+    """
+    fmt, compressed = seed_format(path)
+    with open_text(path, compressed) as f:
+        if fmt == 'jsonl':
+            items, decode = _iter_jsonl(f)
+        elif fmt == 'json':
+            items, decode = _iter_json(f), None
+        else:
+            items, decode = _iter_csv(f)
+        sample, seen = reservoir_sample(items, k, rng)
+    if decode is not None:
+        sample = [decode(item) for item in sample]
+    return [row for row in sample if row["text"] and row["label"]], seen
+
+
+# --- sampling ----------------------------------------------------------
+
+def reservoir_sample(items, k, rng):
+    """
+    Uniform sample of k items in one pass with O(k) memory. Returns (sample, items seen).
+
+    Algorithm L: instead of a random draw per item, jump straight to the
+    next item that replaces a reservoir slot (O(k log(n/k)) draws in total).
+    """
+    sample = []
+    if k <= 0:
+        return sample, sum(1 for _ in items)
+    w = math.exp(math.log(rng.random() or 1e-300) / k)
+    next_pick = k
+    seen = 0
+    for seen, item in enumerate(items, 1):
+        if seen <= k:
+            sample.append(item)
+            if seen == k:
+                next_pick = k + _skip(w, rng)
+        elif seen == next_pick:
+            sample[rng.randrange(k)] = item
+            w *= math.exp(math.log(rng.random() or 1e-300) / k)
+            next_pick = seen + _skip(w, rng)
+    return sample, seen
+
+
+def _skip(w, rng):
+    """Items to pass over before the next reservoir replacement, plus one."""
+    if w >= 1.0:
+        return 1
+    return int(math.log(rng.random() or 1e-300) / math.log(1.0 - w)) + 1
+
+
+def load_seed_rows(path, k, seed=42):
+    """Reservoir-sample k text/label rows; falls back to pandas for unusual files."""
+    name = Path(path).name
+    try:
+        return sample_seed_rows(path, k, random.Random(f"{seed}:{name}"))
+    except UnsupportedSeedFormat as e:
+        print(f"  ↪️  {name}: {e}; loading with pandas")
+    df = load_seed_dataframe(Path(path))
+    rows = (row for row in df[['text', 'label']].to_dict('records') if row["text"] and row["label"])
+    return reservoir_sample(rows, k, random.Random(f"{seed}:{name}"))
+
+
+def load_seed_dataframe(path: Path):
+    """Load seed data flexibly from csv/json/jsonl into a DataFrame (imports pandas)."""
+    import pandas as pd
+
+    fmt, compressed = seed_format(path)
+    if fmt == 'json':
+        with open_text(path, compressed) as f:
+            data = json.load(f)
+        if isinstance(data, list) and all(isinstance(item, dict) and 'instruction' in item for item in data):
+            return pd.DataFrame(data).rename(columns={'instruction': 'text', 'output': 'label'})
+        if isinstance(data, dict) and "intents" in data:
+            return pd.DataFrame([pair for item in data["intents"] for pair in _intent_pairs(item)])
+        df = pd.DataFrame(data)
+    elif fmt == 'jsonl':
+        df = pd.read_json(path, lines=True)
+    else:
+        df = pd.read_csv(path, encoding='utf-8', sep=None, engine='python')
+
+    text_col, label_col = detect_columns(df.columns)
+    return df.rename(columns={text_col: 'text', label_col: 'label'})
@@ -0,0 +1,220 @@
+"""
+Local OpenAI-Compatible Stand-in Server
+=======================================
+
+Tiny /v1/chat/completions endpoint that answers with canned geriatric
+samples after a configurable delay. Use it to exercise the generator
+(concurrency, timeouts, resume) on a laptop without Ollama or a GPU:
+
+    python stub_server.py --port 11434 --latency 2.0
+    QWEN_API_BASE=http://localhost:11434/v1 python data_creation_lightning.py
+
+Standard library only.
+"""
+
+import argparse
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+INSTRUCTIONS = [
+    "What can I do about constipation?",
+    "My ankle is swollen",
+    "I feel dizzy when I stand up",
+    "How can I sleep better at night?",
+    "My knees ache in the morning",
+    "I keep forgetting to take my pills",
+    "What should I eat to help my heart?",
+    "I have a sore throat",
+]
+
+TIPS = [
+    "Drink 8-10 glasses of water daily.",
+    "Eat more fiber: prunes, whole grains, vegetables.",
+    "Walk for 20 minutes after meals.",
+    "Rest and elevate the area above heart level.",
+    "Apply ice wrapped in a towel for 15-20 minutes every 2 hours.",
+    "Stand up slowly and hold onto something sturdy.",
+    "Go to bed at the same time each night.",
+    "Avoid caffeine after noon.",
+    "Keep a written list of your medications by the bed.",
+    "Use a pill organizer with morning and evening slots.",
+    "Gargle with warm salt water three times a day.",
+    "Try a warm, caffeine-free tea an hour before bed.",
+    "Sit on the edge of the bed for a minute before standing.",
+    "Take acetaminophen as directed on the package.",
+]
+
+FOLLOW_UPS = [
+    "If no improvement in 3 days, contact your doctor.",
+    "If symptoms get worse, call your doctor.",
+    "If you have chest pain or trouble breathing, call 911 right away.",
+]
+
+stats = {"requests": 0, "in_flight": 0, "max_in_flight": 0}
+stats_lock = threading.Lock()
+
+
+def make_samples(count, rng):
+    """Build `count` random instruction/input/output triples."""
+    return [
+        {
+            "instruction": rng.choice(INSTRUCTIONS),
+            "input": f"Patient is {rng.randint(70, 95)} years old.",
+            "output": " ".join(rng.sample(TIPS, 3) + [rng.choice(FOLLOW_UPS)]),
+        }
+        for _ in range(count)
+    ]
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """Handles the subset of the OpenAI API the generator uses."""
+
+    latency = 1.0
+    jitter = 0.2
+    token_latency = 0.0
+
+    def log_message(self, format, *args):
+        pass  # Keep the console quiet under load
+
+    def _send_json(self, status, payload):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path.rstrip("/").endswith("/models"):
+            self._send_json(200, {"object": "list", "data": [{"id": "stub", "object": "model"}]})
+        elif self.path.rstrip("/").endswith("/stats"):
+            with stats_lock:
+                self._send_json(200, dict(stats))
+        else:
+            self._send_json(404, {"error": {"message": f"Unknown path {self.path}"}})
+
+    def do_POST(self):
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            self._send_json(404, {"error": {"message": f"Unknown path {self.path}"}})
+            return
+
+        length = int(self.headers.get("Content-Length", 0))
+        request = json.loads(self.rfile.read(length) or b"{}")
+
+        with stats_lock:
+            stats["requests"] += 1
+            stats["in_flight"] += 1
+            stats["max_in_flight"] = max(stats["max_in_flight"], stats["in_flight"])
+
+        try:
+            prompt = request.get("messages", [{}])[-1].get("content", "")
+            match = re.search(r"Generate (\d+)", prompt)
+            count = int(match.group(1)) if match else 20
+
+            rng = random.Random()
+            content = json.dumps(make_samples(count, rng), indent=2)
+            finish_reason = "stop"
+
+            # ~4 characters per token; cut off at max_tokens like a real server
+            max_tokens = request.get("max_tokens")
+            if max_tokens and len(content) // 4 > max_tokens:
+                content = content[:max_tokens * 4]
+                finish_reason = "length"
+
+            if request.get("stream"):
+                self._stream_completion(request, content, finish_reason, prompt, rng)
+                return
+
+            delay = self.latency + self.token_latency * (len(content) // 4)
+            time.sleep(max(0.0, delay + rng.uniform(-self.jitter, self.jitter)))
+
+            self._send_json(200, {
+                "id": f"chatcmpl-{uuid.uuid4().hex[:12]}",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": request.get("model", "stub"),
+                "choices": [{
+                    "index": 0,
+                    "message": {"role": "assistant", "content": content},
+                    "finish_reason": finish_reason,
+                }],
+                "usage": {
+                    "prompt_tokens": len(prompt) // 4,
+                    "completion_tokens": len(content) // 4,
+                    "total_tokens": (len(prompt) + len(content)) // 4,
+                },
+            })
+        finally:
+            with stats_lock:
+                stats["in_flight"] -= 1
+
+    def _stream_completion(self, request, content, finish_reason, prompt, rng):
+        """Send `content` as server-sent events, ~4 tokens per chunk."""
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+
+        chunk_id = f"chatcmpl-{uuid.uuid4().hex[:12]}"
+
+        def send(choices, usage=None):
+            event = {
+                "id": chunk_id,
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": request.get("model", "stub"),
+                "choices": choices,
+            }
+            if usage is not None:
+                event["usage"] = usage
+            self.wfile.write(f"data: {json.dumps(event)}\n\n".encode("utf-8"))
+            self.wfile.flush()
+
+        # Latency before the first token, then per-token decode time
+        time.sleep(max(0.0, self.latency + rng.uniform(-self.jitter, self.jitter)))
+        step = 16
+        for i in range(0, len(content), step):
+            piece = content[i:i + step]
+            send([{"index": 0, "delta": {"content": piece}, "finish_reason": None}])
+            if self.token_latency:
+                time.sleep(self.token_latency * len(piece) / 4)
+        send([{"index": 0, "delta": {}, "finish_reason": finish_reason}])
+
+        if (request.get("stream_options") or {}).get("include_usage"):
+            send([], usage={
+                "prompt_tokens": len(prompt) // 4,
+                "completion_tokens": len(content) // 4,
+                "total_tokens": (len(prompt) + len(content)) // 4,
+            })
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.wfile.flush()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="OpenAI-compatible stand-in server for generator testing")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=11434)
+    parser.add_argument("--latency", type=float, default=1.0, help="Seconds per completion")
+    parser.add_argument("--jitter", type=float, default=0.2, help="Random +/- seconds added to latency")
+    parser.add_argument("--token-latency", type=float, default=0.0, help="Extra seconds per output token")
+    args = parser.parse_args()
+
+    StubHandler.latency = args.latency
+    StubHandler.jitter = args.jitter
+    StubHandler.token_latency = args.token_latency
+
+    server = ThreadingHTTPServer((args.host, args.port), StubHandler)
+    print(f"🧪 Stub server on http://{args.host}:{args.port}/v1 (latency {args.latency}s)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
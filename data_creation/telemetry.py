@@ -0,0 +1,304 @@
+"""
+Live Throughput and Quality Telemetry for Generation Runs
+=========================================================
+
+`RunTelemetry` collects per-call measurements from the generator and
+publishes them every `interval` seconds from a background thread:
+
+- JSONL metrics stream (one snapshot per line): p50/p95/p99 request
+  latency, output tokens/sec (overall and since the last snapshot), valid
+  and novel samples per call, parse-failure / truncation / duplicate rates
+  overall and per topic, plus live gauges (in-flight requests, writer
+  queue depth, writer lag, per-endpoint load)
+- Prometheus text exposition: written atomically to a .prom file (node
+  exporter textfile collector) and/or served on http://host:port/metrics
+
+Latency percentiles come from the last LATENCY_WINDOW calls; the
+Prometheus histogram uses fixed LATENCY_BUCKETS over the whole run.
+
+Standard library only; recording is thread-safe (sync loop, async
+workers and the writer thread can all report).
+"""
+
+import json
+import math
+import os
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+METRICS_PREFIX = "datagen"
+LATENCY_WINDOW = 2048  # Recent calls used for p50/p95/p99
+LATENCY_BUCKETS = (0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 180, 300)
+QUANTILES = (0.5, 0.95, 0.99)
+
+_TOPIC_FIELDS = ("calls", "requested", "valid", "novel", "parse_failures", "truncated", "errors")
+
+
+def percentile(sorted_values, q):
+    """Nearest-rank percentile of an already sorted list (None if empty)."""
+    if not sorted_values:
+        return None
+    rank = max(1, math.ceil(q * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+def _rate(numerator, denominator):
+    return numerator / denominator if denominator else 0.0
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in labels.items()) + "}"
+
+
+class RunTelemetry:
+    """Thread-safe metrics collector with JSONL and Prometheus outputs."""
+
+    def __init__(self, metrics_file=None, prometheus_file=None, prometheus_port=None,
+                 interval=15.0, gauges=None, target_size=None, host="127.0.0.1"):
+        self.metrics_file = Path(metrics_file) if metrics_file else None
+        self.prometheus_file = Path(prometheus_file) if prometheus_file else None
+        self.prometheus_port = prometheus_port
+        self.interval = interval
+        self.gauges = gauges  # callable -> [(name, {labels}, value), ...]
+        self.target_size = target_size
+        self.host = host
+
+        self.started = time.time()
+        self._lock = threading.Lock()
+        self._latencies = deque(maxlen=LATENCY_WINDOW)
+        self._buckets = [0] * len(LATENCY_BUCKETS)
+        self._latency_sum = 0.0
+        self._output_tokens = 0
+        self._errors = {}
+        self._topics = {}
+        self._last_emit = (self.started, 0)  # (time, output tokens) at the last snapshot
+
+        self._stop = threading.Event()
+        self._thread = None
+        self._server = None
+
+    # --- recording -----------------------------------------------------
+
+    def _topic(self, topic):
+        stats = self._topics.get(topic)
+        if stats is None:
+            stats = self._topics[topic] = dict.fromkeys(_TOPIC_FIELDS, 0)
+        return stats
+
+    def record_call(self, topic, latency, output_tokens, requested, valid, novel,
+                    parse_failed=False, truncated=False):
+        """One completed generation call."""
+        with self._lock:
+            self._latencies.append(latency)
+            self._latency_sum += latency
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if latency <= bound:
+                    self._buckets[i] += 1
+                    break
+            self._output_tokens += output_tokens or 0
+            stats = self._topic(topic)
+            stats["calls"] += 1
+            stats["requested"] += requested
+            stats["valid"] += valid
+            stats["novel"] += novel
+            stats["parse_failures"] += bool(parse_failed)
+            stats["truncated"] += bool(truncated)
+
+    def record_error(self, topic, kind="error"):
+        """A call that failed outright (timeout, connection error, ...)."""
+        with self._lock:
+            self._errors[kind] = self._errors.get(kind, 0) + 1
+            self._topic(topic)["errors"] += 1
+
+    # --- snapshots -----------------------------------------------------
+
+    def _totals(self):
+        totals = dict.fromkeys(_TOPIC_FIELDS, 0)
+        for stats in self._topics.values():
+            for field in _TOPIC_FIELDS:
+                totals[field] += stats[field]
+        return totals
+
+    def _read_gauges(self):
+        if self.gauges is None:
+            return []
+        try:
+            return list(self.gauges())
+        except Exception as e:  # A gauge must never take the run down
+            return [("telemetry_gauge_errors", {"error": type(e).__name__}, 1)]
+
+    def snapshot(self, generated=None):
+        """Current metrics as a JSON-friendly dict."""
+        now = time.time()
+        gauges = self._read_gauges()
+        with self._lock:
+            latencies = sorted(self._latencies)
+            totals = self._totals()
+            topics = {topic: dict(stats) for topic, stats in self._topics.items()}
+            output_tokens = self._output_tokens
+            errors = dict(self._errors)
+            last_time, last_tokens = self._last_emit
+
+        elapsed = now - self.started
+        calls = totals["calls"]
+        latency = {f"p{int(q * 100)}": percentile(latencies, q) for q in QUANTILES}
+        latency["mean"] = _rate(sum(latencies), len(latencies)) if latencies else None
+        return {
+            "ts": now,
+            "elapsed_s": round(elapsed, 3),
+            "samples": generated,
+            "target": self.target_size,
+            "calls": calls,
+            "errors": errors,
+            "latency_s": latency,
+            "output_tokens": output_tokens,
+            "tokens_per_sec": _rate(output_tokens, elapsed),
+            "tokens_per_sec_recent": _rate(output_tokens - last_tokens, now - last_time),
+            "valid_per_call": _rate(totals["valid"], calls),
+            "novel_per_call": _rate(totals["novel"], calls),
+            "yield": _rate(totals["valid"], totals["requested"]),
+            "parse_failure_rate": _rate(totals["parse_failures"], calls),
+            "truncation_rate": _rate(totals["truncated"], calls),
+            "duplicate_rate": _rate(totals["valid"] - totals["novel"], totals["valid"]),
+            "topics": {
+                topic: {
+                    "calls": stats["calls"],
+                    "errors": stats["errors"],
+                    "valid_per_call": _rate(stats["valid"], stats["calls"]),
+                    "parse_failure_rate": _rate(stats["parse_failures"], stats["calls"]),
+                    "duplicate_rate": _rate(stats["valid"] - stats["novel"], stats["valid"]),
+                }
+                for topic, stats in topics.items()
+            },
+            "gauges": {
+                name + _labels(labels): value for name, labels, value in gauges
+            },
+        }
+
+    def prometheus_text(self, generated=None):
+        """Prometheus text exposition format (version 0.0.4)."""
+        p = METRICS_PREFIX
+        now = time.time()
+        gauges = self._read_gauges()
+        with self._lock:
+            latencies = sorted(self._latencies)
+            buckets = list(self._buckets)
+            latency_sum = self._latency_sum
+            topics = {topic: dict(stats) for topic, stats in self._topics.items()}
+            output_tokens = self._output_tokens
+            errors = dict(self._errors)
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            lines.append(f"# HELP {p}_{name} {help_text}")
+            lines.append(f"# TYPE {p}_{name} {kind}")
+            for suffix, labels, value in samples:
+                lines.append(f"{p}_{name}{suffix}{_labels(labels)} {value}")
+
+        per_topic = lambda field: [("", {"topic": t}, s[field]) for t, s in sorted(topics.items())]
+        metric("requests_total", "counter", "Completed generation calls.", per_topic("calls"))
+        metric("samples_requested_total", "counter", "Samples asked for.", per_topic("requested"))
+        metric("samples_valid_total", "counter", "Valid samples returned.", per_topic("valid"))
+        metric("samples_novel_total", "counter", "Samples kept after dedup.", per_topic("novel"))
+        metric("parse_failures_total", "counter", "Calls with no recoverable samples.", per_topic("parse_failures"))
+        metric("truncated_total", "counter", "Calls cut off at max_tokens.", per_topic("truncated"))
+        metric("request_errors_total", "counter", "Calls that failed outright.",
+               [("", {"kind": k}, v) for k, v in sorted(errors.items())])
+        metric("output_tokens_total", "counter", "Completion tokens received.", [("", {}, output_tokens)])
+
+        cumulative = 0
+        histogram = []
+        for bound, count in zip(LATENCY_BUCKETS, buckets):
+            cumulative += count
+            histogram.append(("_bucket", {"le": bound}, cumulative))
+        histogram.append(("_bucket", {"le": "+Inf"}, sum(s["calls"] for s in topics.values())))
+        histogram.append(("_sum", {}, round(latency_sum, 6)))
+        histogram.append(("_count", {}, sum(s["calls"] for s in topics.values())))
+        metric("request_latency_seconds", "histogram", "Generation call latency.", histogram)
+        metric("request_latency_recent_seconds", "gauge",
+               f"Latency percentiles over the last {LATENCY_WINDOW} calls.",
+               [("", {"quantile": q}, percentile(latencies, q)) for q in QUANTILES if latencies])
+        metric("tokens_per_second", "gauge", "Output tokens per second since start.",
+               [("", {}, round(_rate(output_tokens, now - self.started), 3))])
+        if generated is not None:
+            metric("samples_generated", "gauge", "Samples written so far.", [("", {}, generated)])
+        if self.target_size:
+            metric("samples_target", "gauge", "Target sample count.", [("", {}, self.target_size)])
+        for name in sorted({g[0] for g in gauges}):
+            metric(name, "gauge", f"{name.replace('_', ' ')}.",
+                   [("", labels, value) for n, labels, value in gauges if n == name])
+        return "\n".join(lines) + "\n"
+
+    # --- publishing ----------------------------------------------------
+
+    def emit(self, generated=None):
+        """Append a JSONL snapshot and rewrite the Prometheus file."""
+        snapshot = self.snapshot(generated)
+        with self._lock:
+            self._last_emit = (snapshot["ts"], snapshot["output_tokens"])
+        if self.metrics_file is not None:
+            with open(self.metrics_file, "a", encoding="utf-8") as f:
+                f.write(json.dumps(snapshot) + "\n")
+        if self.prometheus_file is not None:
+            tmp_path = self.prometheus_file.with_name(self.prometheus_file.name + ".tmp")
+            tmp_path.write_text(self.prometheus_text(generated), encoding="utf-8")
+            os.replace(tmp_path, self.prometheus_file)
+        return snapshot
+
+    def start(self, generated=lambda: None):
+        """Publish every `interval` seconds (and serve /metrics if a port is set)."""
+        self._generated = generated
+
+        def loop():
+            while not self._stop.wait(self.interval):
+                try:
+                    self.emit(generated())
+                except Exception as e:
+                    print(f"  ⚠️  Telemetry snapshot failed: {e}")
+
+        self._thread = threading.Thread(target=loop, name="telemetry", daemon=True)
+        self._thread.start()
+        if self.prometheus_port:
+            self._serve()
+        return self
+
+    def _serve(self):
+        telemetry = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                if self.path.rstrip("/") not in ("", "/metrics"):
+                    self.send_error(404)
+                    return
+                body = telemetry.prometheus_text(telemetry._generated()).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        self._server = ThreadingHTTPServer((self.host, self.prometheus_port), MetricsHandler)
+        threading.Thread(target=self._server.serve_forever, name="metrics-http", daemon=True).start()
+        print(f"📈 Metrics on http://{self.host}:{self.prometheus_port}/metrics")
+
+    def close(self, generated=None):
+        """Stop publishing and write a final snapshot."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+        return self.emit(generated)
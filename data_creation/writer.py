@@ -0,0 +1,230 @@
+"""
+Buffered, Batched JSONL Writer for Generated Samples
+====================================================
+
+The generator hands batches of records to `BatchedJsonlWriter.submit()`,
+which only enqueues them. A background thread serializes the records
+(orjson when installed, stdlib json otherwise), buffers them, and flushes
+when either FLUSH_RECORDS records are pending or FLUSH_INTERVAL_SECONDS
+have passed. Every flush is fsynced, then `on_flush` is called with the
+durable position so the caller can checkpoint.
+
+Output modes:
+- Plain (default): append to a single .jsonl file, exactly like before
+- Sharded: rotate every `shard_max_records` records and/or compress
+  shards as .jsonl.gz (stdlib) or .jsonl.zst (needs `zstandard`).
+  Shards are never reopened: a resumed run starts the next shard index.
+"""
+
+import gzip
+import json
+import os
+import queue
+import threading
+import time
+from pathlib import Path
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+FLUSH_RECORDS = 200  # Flush once this many records are buffered
+FLUSH_INTERVAL_SECONDS = 5.0  # ...or this long after the first unflushed record
+MAX_QUEUED_BATCHES = 512  # Bound on batches waiting for the writer thread
+PUT_POLL_SECONDS = 1.0  # How often a blocked submit() checks the writer is still alive
+
+_CLOSE = object()
+
+
+class WriterError(RuntimeError):
+    """The background writer hit a disk error; generation must stop."""
+
+
+def dumps_line(record) -> bytes:
+    """Serialize one record as a JSONL line."""
+    if orjson is not None:
+        return orjson.dumps(record) + b"\n"
+    return (json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8")
+
+
+class BatchedJsonlWriter:
+    """Background-thread JSONL writer with size/time flushing, rotation and compression."""
+
+    def __init__(self, path, compression=None, shard_max_records=None,
+                 flush_records=FLUSH_RECORDS, flush_interval=FLUSH_INTERVAL_SECONDS,
+                 on_flush=None, start_shard=0):
+        if compression not in (None, "gz", "zst"):
+            raise ValueError(f"Unsupported compression: {compression!r} (use None, 'gz' or 'zst')")
+        if compression == "zst" and zstandard is None:
+            raise ImportError("zst output needs the zstandard package: pip install zstandard")
+
+        self.path = Path(path)
+        self.compression = compression
+        self.shard_max_records = shard_max_records
+        self.sharded = compression is not None or shard_max_records is not None
+        self.flush_records = flush_records
+        self.flush_interval = flush_interval
+        self.on_flush = on_flush
+
+        self.shard_index = start_shard
+        self.records_submitted = 0
+        self.records_written = 0  # Durably flushed this session
+        self.last_flush_time = time.time()
+
+        self._queue = queue.Queue(maxsize=MAX_QUEUED_BATCHES)
+        self._error = None
+        self._raw = None
+        self._stream = None
+        self._shard_records = 0
+
+        self._thread = threading.Thread(target=self._run, name="jsonl-writer", daemon=True)
+        self._thread.start()
+
+    # --- public API ----------------------------------------------------
+
+    def shard_path(self, index=None) -> Path:
+        """Path of shard `index` (the output file itself in plain mode)."""
+        if not self.sharded:
+            return self.path
+        index = self.shard_index if index is None else index
+        stem = self.path.name[:-len(".jsonl")] if self.path.name.endswith(".jsonl") else self.path.name
+        suffix = f".{self.compression}" if self.compression else ""
+        return self.path.with_name(f"{stem}.{index:05d}.jsonl{suffix}")
+
+    def submit(self, records, meta=None):
+        """
+        Queue a batch for writing. Returns immediately unless MAX_QUEUED_BATCHES
+        batches are already waiting (backpressure when the disk falls behind).
+
+        `meta` is passed back through `on_flush` once the batch is durable.
+        """
+        self.records_submitted += len(records)
+        self._put((list(records), meta))
+
+    @property
+    def pending(self) -> int:
+        """Records handed over but not yet durably flushed (writer lag)."""
+        return self.records_submitted - self.records_written
+
+    @property
+    def lag_seconds(self) -> float:
+        """Seconds since the last flush while records are pending (0 when caught up)."""
+        return time.time() - self.last_flush_time if self.pending else 0.0
+
+    @property
+    def queue_depth(self) -> int:
+        """Batches waiting for the writer thread."""
+        return self._queue.qsize()
+
+    def close(self):
+        """Flush everything, fsync, close the shard and stop the thread."""
+        if self._thread.is_alive():
+            self._put((_CLOSE, None))
+            self._thread.join()
+        self._raise_if_failed()
+
+    # --- writer thread -------------------------------------------------
+
+    def _raise_if_failed(self):
+        if self._error is not None:
+            raise WriterError(f"JSONL writer failed: {self._error}") from self._error
+
+    def _put(self, item):
+        """Enqueue `item`, raising instead of blocking forever if the writer dies while the queue is full."""
+        while True:
+            self._raise_if_failed()
+            if not self._thread.is_alive():
+                raise WriterError("JSONL writer thread is no longer running")
+            try:
+                self._queue.put(item, timeout=PUT_POLL_SECONDS)
+                return
+            except queue.Full:
+                continue
+
+    def _open_shard(self):
+        """Open the current shard (lazily, so rotation never leaves an empty file)."""
+        path = self.shard_path()
+        self._raw = open(path, "ab")
+        if self.compression == "gz":
+            self._stream = gzip.GzipFile(fileobj=self._raw, mode="ab")
+        elif self.compression == "zst":
+            self._stream = zstandard.ZstdCompressor(level=3).stream_writer(self._raw, closefd=False)
+        else:
+            self._stream = self._raw
+
+    def _close_shard(self):
+        if self._raw is None:
+            return
+        if self._stream is not self._raw:
+            self._stream.close()  # Writes the gzip trailer / final zstd frame
+        self._raw.flush()
+        os.fsync(self._raw.fileno())
+        self._raw.close()
+        self._raw = self._stream = None
+        self._shard_records = 0
+
+    def _flush(self, buffer, count, meta):
+        if not count:
+            return
+        if self._raw is None:
+            self._open_shard()
+        if buffer:
+            self._stream.write(b"".join(buffer))
+        if self._stream is not self._raw:
+            if self.compression == "zst":
+                self._stream.flush(zstandard.FLUSH_BLOCK)
+            else:
+                self._stream.flush()
+        self._raw.flush()
+        os.fsync(self._raw.fileno())
+
+        self.records_written += count
+        self.last_flush_time = time.time()
+        if self.on_flush is not None:
+            self.on_flush({
+                "records_written": self.records_written,
+                "shard": str(self.shard_path()),
+                "shard_index": self.shard_index,
+                "byte_offset": self._raw.tell(),
+                "meta": meta,
+            })
+
+    def _run(self):
+        buffer, count, meta = [], 0, None
+        deadline = None
+        try:
+            while True:
+                timeout = None if deadline is None else max(0.0, deadline - time.time())
+                try:
+                    records, batch_meta = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    records = None
+
+                if records is _CLOSE:
+                    self._flush(buffer, count, meta)
+                    self._close_shard()
+                    return
+
+                if records is not None:
+                    buffer.extend(dumps_line(r) for r in records)
+                    count += len(records)
+                    self._shard_records += len(records)
+                    meta = batch_meta
+                    if deadline is None:
+                        deadline = time.time() + self.flush_interval
+
+                rotate = self.shard_max_records and self._shard_records >= self.shard_max_records
+                if count and (count >= self.flush_records or time.time() >= deadline or rotate):
+                    self._flush(buffer, count, meta)
+                    buffer, count, deadline = [], 0, None
+                if rotate:
+                    self._close_shard()
+                    self.shard_index += 1
+        except BaseException as e:  # Surface disk errors to the generator
+            self._error = e
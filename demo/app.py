@@ -1,9 +1,13 @@
+import asyncio
 import gradio as gr
 import torch
 from pathlib import Path
 import os
 import sys
-from threading import Lock
+
+sys.path.append(str(Path(__file__).resolve().parent.parent / "training"))  # prefix_cache.py
+from generation import EXAMPLES, build_prompt
+from scheduler import ContinuousBatcher
 
 # Configuration
 ADAPTER_PATH = "/home/ysk/Downloads/zima/trained_model"
@@ -16,7 +20,6 @@ print(f"Adapter Path: {ADAPTER_PATH}")
 model = None
 tokenizer = None
 USE_GPU = torch.cuda.is_available()
-generate_lock = Lock() # Prevent concurrent interference with adapter toggling
 
 if USE_GPU:
     try:
@@ -67,94 +70,59 @@ if not USE_GPU:
         print(f"❌ Critical Error loading model: {e}")
         sys.exit(1)
 
-def run_generate(prompt):
-    """Core generation helper"""
-    device = "cuda" if USE_GPU else "cpu"
-    inputs = tokenizer([prompt], return_tensors = "pt").to(device)
-    
-    with torch.no_grad():
-        outputs = model.generate(
-            **inputs,
-            max_new_tokens = 512,
-            use_cache = True,
-            temperature = 0.7,
-            top_p = 0.9,
-            do_sample = True
-        )
-    
-    response = tokenizer.batch_decode(outputs)[0]
-    
-    # Cleaning
-    response_start = response.find("### Response:")
-    if response_start != -1:
-        clean_response = response[response_start + len("### Response:"):].strip()
-    else:
-        clean_response = response
-        
-    if tokenizer.eos_token in clean_response:
-        clean_response = clean_response.replace(tokenizer.eos_token, "").strip()
-        
-    return clean_response
-
-def generate_comparison(instruction, patient_context, progress=gr.Progress()):
-    """
-    Generate responses from BOTH Base Model and Zima Fine-Tuned Model.
-    """
-    prompt = f"""Below is an instruction that describes a task, paired with an input that provides further context. Write a response that appropriately completes the request.
+# One thread owns the model and batches all requests (both panes, all users);
+# the Alpaca preamble's KV is computed once per pane and reused by every prompt.
+# An Unsloth model is served through model.generate instead (see scheduler.py)
+scheduler = ContinuousBatcher(model, tokenizer)
 
-### Instruction:
-{instruction}
+PANES = {False: "Base", True: "Zima"}
 
-### Input:
-{patient_context}
+def pane_error(adapter, error):
+    # Unsloth doesn't easily support dynamic disable in 4bit inference mode same as PEFT
+    if not adapter and USE_GPU:
+        return "(Comparison not available in accelerated unsloth 4-bit mode)"
+    return f"Error: {error}"
 
-### Response:
-"""
+async def generate_comparison(instruction, patient_context):
+    """
+    Stream responses from BOTH Base Model and Zima Fine-Tuned Model.
+    Yields (base text, zima text, latency metrics) as tokens arrive.
+    """
+    prompt = build_prompt(instruction, patient_context)
+    loop = asyncio.get_running_loop()
+    updates = asyncio.Queue()
     
-    # We use a lock because we are modifying global model state (enabling/disabling adapters)
-    with generate_lock:
-        try:
-            # 1. Generate with ZIMA (Adapters Active)
-            progress(0.3, desc="Generating Zima Response...")
-            
-            # Ensure adapters are active
-            if hasattr(model, "enable_adapter_layers"): # Unsloth 
-                 # Unsloth is always active by default in this flow, usually handles it differently
-                 # For Unsloth specifically, disabling is tricky dynamically without reloading sometimes
-                 # So we might trust it's active.
-                 pass
-            elif hasattr(model, "enable_adapter"): # PEFT
-                # Sometimes peft uses 'default' adapter name
-                try: 
-                    model.enable_adapter("default")
-                except: 
-                    pass
-            
-            zima_output = run_generate(prompt)
-            
-            # 2. Generate with BASE MODEL (Adapters Disabled)
-            progress(0.7, desc="Generating Base Model Response...")
-            
-            if USE_GPU:
-                # Unsloth specific disable
-                # Unsloth doesn't easily support dynamic disable in 4bit inference mode same as PEFT
-                # Hack: For Unsloth, we might just say "Not supported in 4bit optimized mode" or try a specific context
-                # But actual PeftModel (CPU fallback) supports it perfectly.
-                # Let's try PEFT context manager if applicable, or skip if strictly Unsloth objects don't support it
-                try:
-                    with model.disable_adapter():
-                         base_output = run_generate(prompt)
-                except:
-                     base_output = "(Comparison not available in accelerated unsloth 4-bit mode)"
-            else:
-                # PEFT (CPU) supports this perfectly
-                with model.disable_adapter():
-                    base_output = run_generate(prompt)
-                    
-        except Exception as e:
-            return f"Error: {e}", f"Error: {e}"
-
-    return base_output, zima_output
+    # Both requests are queued at once; the scheduler runs Zima (adapters active)
+    # and base (adapters disabled) sequences in separate batches and calls back
+    # from its own thread with each decoded piece of text
+    futures = {}
+    for adapter in (True, False):
+        on_text = lambda piece, adapter = adapter: loop.call_soon_threadsafe(updates.put_nowait, (adapter, piece))
+        futures[adapter] = scheduler.submit(prompt, adapter = adapter, on_text = on_text)
+        futures[adapter].add_done_callback(lambda _, adapter = adapter: loop.call_soon_threadsafe(updates.put_nowait, (adapter, None)))
+    
+    texts = {False: "", True: ""}
+    metrics = {False: "", True: ""}
+    running = len(futures)
+    while running:
+        # Coalesce everything that arrived since the last update into one yield
+        batch = [await updates.get()]
+        while not updates.empty():
+            batch.append(updates.get_nowait())
+        for adapter, piece in batch:
+            if piece is not None:
+                texts[adapter] += piece
+                continue
+            running -= 1
+            try:
+                completion = futures[adapter].result()
+            except Exception as e:
+                texts[adapter] = pane_error(adapter, e)
+                continue
+            texts[adapter] = completion.text
+            metrics[adapter] = completion.summary()
+            print(f"⏱️  {PANES[adapter]}: {metrics[adapter]}")
+        yield texts[False], texts[True], "\n\n".join(f"**{PANES[a]}:** {metrics[a]}" for a in (False, True) if metrics[a])
 
 # Define the Gradio Interface
 # Note: theme moved to launch() in newer gradio, but kept here for compat with some versions.
@@ -202,21 +170,19 @@ with gr.Blocks(theme=gr.themes.Soft(primary_hue="teal", secondary_hue="blue")) a
                     lines=12,
                     interactive=False
                 )
+            latency_output = gr.Markdown()
             
     # Example queries
     gr.Examples(
-        examples=[
-            ["What can I do about constipation?", "Patient is 73 years old, reports infrequent bowel movements."],
-            ["I have a headache.", "Patient is 82, history of migraines, took aspirin 2 hours ago."],
-            ["My knee hurts when I walk.", "Patient is 70, no history of injury, pain started 2 days ago."]
-        ],
+        examples=EXAMPLES,
         inputs=[instruction_input, context_input]
     )
 
     submit_btn.click(
         fn=generate_comparison,
         inputs=[instruction_input, context_input],
-        outputs=[base_output, zima_output]
+        outputs=[base_output, zima_output, latency_output],
+        concurrency_limit=None # Requests are batched by the scheduler, not serialized here
     )
 
 if __name__ == "__main__":
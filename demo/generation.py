@@ -0,0 +1,106 @@
+"""
+Prompt Formatting and Generation for the Comparison Demo
+========================================================
+
+Model-agnostic helpers used by app.py (and the CPU benchmark in
+benchmarks/): build the Alpaca prompt, run `model.generate` with the demo's
+decoding settings, strip the prompt / EOS from the decoded text and decode
+streamed tokens incrementally. No Gradio and no model loading here.
+"""
+
+import torch
+
+PROMPT_TEMPLATE = """Below is an instruction that describes a task, paired with an input that provides further context. Write a response that appropriately completes the request.
+
+### Instruction:
+{instruction}
+
+### Input:
+{input}
+
+### Response:
+"""
+
+EXAMPLES = [
+    ["What can I do about constipation?", "Patient is 73 years old, reports infrequent bowel movements."],
+    ["I have a headache.", "Patient is 82, history of migraines, took aspirin 2 hours ago."],
+    ["My knee hurts when I walk.", "Patient is 70, no history of injury, pain started 2 days ago."]
+]
+
+GENERATION_KWARGS = dict(
+    max_new_tokens = 512,
+    use_cache = True,
+    temperature = 0.7,
+    top_p = 0.9,
+    do_sample = True,
+)
+
+
+def build_prompt(instruction, patient_context):
+    return PROMPT_TEMPLATE.format(instruction=instruction, input=patient_context)
+
+
+def clean_response(response, eos_token):
+    """Text after "### Response:", without the EOS token"""
+    response_start = response.find("### Response:")
+    if response_start != -1:
+        clean = response[response_start + len("### Response:"):].strip()
+    else:
+        clean = response
+
+    if eos_token and eos_token in clean:
+        clean = clean.replace(eos_token, "").strip()
+
+    return clean
+
+
+def generate(model, tokenizer, prompt, device, **overrides):
+    """Generate one response; `overrides` replace entries of GENERATION_KWARGS"""
+    inputs = tokenizer([prompt], return_tensors = "pt").to(device)
+
+    with torch.no_grad():
+        outputs = model.generate(**inputs, **{**GENERATION_KWARGS, **overrides})
+
+    return clean_response(tokenizer.batch_decode(outputs)[0], tokenizer.eos_token)
+
+
+class IncrementalDecoder:
+    """
+    Token-by-token detokenizer for streaming.
+
+    Byte-level BPE splits multi-byte characters (accents, CJK, emoji) over
+    several tokens, and decoding a token alone can differ from decoding it
+    in context. Each new token is decoded together with the previous ones
+    since the last emitted text; a delta is emitted only once it no longer
+    ends in an incomplete character (U+FFFD), so the concatenated deltas
+    equal the decoding of all tokens.
+    """
+
+    def __init__(self, tokenizer, skip_special_tokens = True):
+        self.tokenizer = tokenizer
+        self.skip_special_tokens = skip_special_tokens
+        self.ids = []
+        self.prefix_offset = 0  # Context tokens, already emitted
+        self.read_offset = 0  # First token not emitted yet
+
+    def _decode(self, ids):
+        return self.tokenizer.decode(ids, skip_special_tokens = self.skip_special_tokens)
+
+    def push(self, token_id):
+        """Add a token; returns the newly completed text ("" while a character is incomplete)"""
+        self.ids.append(token_id)
+        prefix = self._decode(self.ids[self.prefix_offset:self.read_offset])
+        text = self._decode(self.ids[self.prefix_offset:])
+        if text.endswith("\ufffd") or len(text) <= len(prefix):
+            return ""
+        self.prefix_offset, self.read_offset = self.read_offset, len(self.ids)
+        return text[len(prefix):]
+
+    def flush(self):
+        """Whatever is still held back (an incomplete character at the very end)"""
+        if self.read_offset == len(self.ids):
+            return ""
+        prefix = self._decode(self.ids[self.prefix_offset:self.read_offset])
+        text = self._decode(self.ids[self.prefix_offset:])
+        self.prefix_offset = self.read_offset = len(self.ids)
+        return text[len(prefix):]
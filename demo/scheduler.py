@@ -0,0 +1,520 @@
+"""
+Continuous-Batching Scheduler for the Comparison Demo
+=====================================================
+
+One background thread owns the model. Gradio handlers `submit()` prompts
+and get a `concurrent.futures.Future` back; the thread decodes every
+running sequence one token per step, in a shared batch:
+
+- Dynamic batches: when idle, the first request waits up to MAX_WAIT_MS
+  for others to arrive so they are prefilled together
+- Continuous batching: between two decode steps, queued requests are
+  prefilled and merged into the running batch (KV cache and attention mask
+  left-padded to a common length) and finished sequences (EOS or
+  max_new_tokens) are retired at once, so a long answer never holds a
+  short one back
+- Limits: MAX_BATCH_SIZE sequences and MAX_TOKENS_IN_FLIGHT tokens
+  (prompt + max_new_tokens, reserved on admission) at a time; the rest
+  wait in FIFO order
+
+Zima (adapters on) and base (adapters off) sequences run as two separate
+batches, each step under its own adapter state - with PEFT toggling the
+adapter is global to the model, and the two KV caches never mix.
+
+The step loop drives the model's forward with hand-built masks, position
+ids and a DynamicCache, then slices and merges the cache the forward
+returns. That is verified with the stock Transformers forward (the
+Transformers + PEFT CPU fallback). Unsloth replaces the forward with its
+own KV handling, so Unsloth-patched models (prefix_cache.unsloth_patched)
+are served through `model.generate` instead: each admitted group runs to
+completion as one left-padded batch, streamed the same way. There is no
+continuous batching and no prefix cache on that path.
+
+Prefix cache (training/prefix_cache.py): the Alpaca preamble's KV is
+computed once per adapter state and pinned; every prefilled prompt (minus
+its last token) also goes into an LRU, so a repeated prompt - an example
+clicked again - only prefills its last token. New prompts are grouped by
+the longest cached prefix they start with and prefill only what follows.
+
+Streaming: `on_text` is called from the scheduler thread with each newly
+decoded piece of text (IncrementalDecoder). The future resolves to a
+Completion carrying the text and the request's latency: time to first
+token (queueing + prefill) and the gaps between later tokens.
+"""
+
+import queue
+import statistics
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from contextlib import nullcontext
+from dataclasses import dataclass, field
+from typing import Callable, List, Optional
+
+import torch
+import torch.nn.functional as F
+from transformers import (
+    DynamicCache,
+    LogitsProcessorList,
+    RepetitionPenaltyLogitsProcessor,
+    TemperatureLogitsWarper,
+    TopKLogitsWarper,
+    TopPLogitsWarper,
+)
+from transformers.generation.streamers import BaseStreamer
+
+from generation import GENERATION_KWARGS, PROMPT_TEMPLATE, IncrementalDecoder
+from prefix_cache import PREFIX_CACHE_TOKENS, PrefixCache, row_entry, template_preamble, unsloth_patched
+
+MAX_BATCH_SIZE = 8  # Sequences decoded together (both panes count)
+MAX_TOKENS_IN_FLIGHT = 8192  # Prompt + max_new_tokens, summed over running sequences
+MAX_WAIT_MS = 20  # Batching window for requests arriving at an idle server
+PREFIX_STATES = {True: "zima", False: "base"}  # Prefix cache namespaces: KV of one never serves the other
+
+
+@dataclass
+class Completion:
+    text: str
+    tokens: int
+    ttft: float  # Submit -> first token (queueing + prefill), seconds
+    total: float  # Submit -> last token, seconds
+    inter_token: List[float]  # Gaps between consecutive tokens, seconds
+
+    @property
+    def inter_token_mean(self) -> Optional[float]:
+        return statistics.fmean(self.inter_token) if self.inter_token else None
+
+    @property
+    def inter_token_p50(self) -> Optional[float]:
+        return statistics.median(self.inter_token) if self.inter_token else None
+
+    def summary(self):
+        line = f"TTFT {self.ttft:.2f}s | {self.tokens} tokens in {self.total:.1f}s"
+        if self.inter_token:
+            line += f" | inter-token {self.inter_token_mean * 1000:.0f} ms mean, {max(self.inter_token) * 1000:.0f} ms max"
+        return line
+
+
+@dataclass
+class _Sequence:
+    prompt_ids: List[int]
+    adapter: bool
+    max_new_tokens: int
+    future: Future
+    on_text: Optional[Callable[[str], None]] = None
+    decoder: Optional[IncrementalDecoder] = None
+    generated: List[int] = field(default_factory = list)
+    submitted: float = field(default_factory = time.perf_counter)
+    token_times: List[float] = field(default_factory = list)
+
+    @property
+    def budget(self):
+        return len(self.prompt_ids) + self.max_new_tokens
+
+    def emit(self, text):
+        if not text or self.on_text is None:
+            return
+        try:
+            self.on_text(text)
+        except Exception:
+            self.on_text = None  # Listener gone (client disconnected); keep generating for the future
+
+
+class _Batch:
+    """Running sequences of one adapter state; each has one sampled token not yet in the cache."""
+
+    def __init__(self):
+        self.sequences = []
+        self.cache = None
+        self.attention_mask = None
+        self.pending = None
+
+
+class _RowStreamer(BaseStreamer):
+    """`model.generate` streamer feeding each step's tokens to the scheduler, for the rows still running"""
+
+    def __init__(self, record, sequences):
+        self.record = record
+        self.sequences = sequences
+        self.rows = list(range(len(sequences)))
+        self.prompt_seen = False
+
+    def put(self, value):
+        if not self.prompt_seen:  # generate() pushes the prompt first
+            self.prompt_seen = True
+            return
+        if not self.rows:
+            return
+        tokens = value.reshape(-1)[self.rows]
+        keep = self.record([self.sequences[i] for i in self.rows], tokens)
+        self.rows = [self.rows[i] for i in keep]
+
+    def end(self):
+        pass
+
+
+def _left_pad(tensor, width, dim):
+    """Zero-pad `tensor` on the left of `dim` (-1 for masks, -2 for KV states) up to `width`"""
+    missing = width - tensor.shape[dim]
+    if missing == 0:
+        return tensor
+    pad = [0, 0] * (-dim - 1) + [missing, 0]
+    return F.pad(tensor, pad)
+
+
+class ContinuousBatcher:
+    """Token-level continuous batching of generation requests over one model"""
+
+    def __init__(self, model, tokenizer, max_batch_size = MAX_BATCH_SIZE,
+                 max_tokens_in_flight = MAX_TOKENS_IN_FLIGHT, max_wait_ms = MAX_WAIT_MS,
+                 preamble = template_preamble(PROMPT_TEMPLATE), prefix_cache_tokens = PREFIX_CACHE_TOKENS,
+                 **generation_kwargs):
+        # Same decoding as model.generate: the model's generation config, then the demo's settings
+        config = model.generation_config
+        settings = {
+            "top_k": getattr(config, "top_k", None),
+            "repetition_penalty": getattr(config, "repetition_penalty", None),
+            **GENERATION_KWARGS,
+            **generation_kwargs,
+        }
+        self.model = model
+        self.tokenizer = tokenizer
+        self.device = model.device
+        self.max_batch_size = max_batch_size
+        self.max_tokens_in_flight = max_tokens_in_flight
+        self.max_wait = max_wait_ms / 1000
+        self.max_new_tokens = settings["max_new_tokens"]
+        self.stepwise = not unsloth_patched(model)  # False: serve through model.generate
+        self.generate_kwargs = {**GENERATION_KWARGS, **generation_kwargs}
+        self.do_sample = settings.get("do_sample", False)
+        self.processors = LogitsProcessorList()
+        self.penalize = settings["repetition_penalty"] not in (None, 1.0)
+        if self.penalize:
+            self.processors.append(RepetitionPenaltyLogitsProcessor(settings["repetition_penalty"]))
+        if self.do_sample:
+            if settings.get("temperature") not in (None, 1.0):
+                self.processors.append(TemperatureLogitsWarper(settings["temperature"]))
+            if settings["top_k"]:
+                self.processors.append(TopKLogitsWarper(settings["top_k"]))
+            if settings.get("top_p") not in (None, 1.0):
+                self.processors.append(TopPLogitsWarper(settings["top_p"]))
+
+        eos = model.generation_config.eos_token_id
+        self.eos_ids = set(eos if isinstance(eos, list) else [eos]) | {tokenizer.eos_token_id}
+        self.eos_ids.discard(None)
+        self.pad_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id
+
+        self.queue = queue.Queue()
+        self.waiting = deque()
+        self.batches = {True: _Batch(), False: _Batch()}
+        self.prefix_cache = PrefixCache(prefix_cache_tokens) if prefix_cache_tokens and self.stepwise else None
+        self.preamble_ids = tokenizer(preamble)["input_ids"] if preamble else None
+        self.stats = {"requests": 0, "steps": 0, "prefills": 0, "prefill_tokens": 0, "max_running": 0}
+        self._closed = threading.Event()
+        self._thread = threading.Thread(target = self._loop, name = "continuous-batcher", daemon = True)
+        self._thread.start()
+
+    # --- client side ---------------------------------------------------
+
+    def submit(self, prompt, adapter = True, max_new_tokens = None, on_text = None) -> Future:
+        """
+        Queue a prompt; the future resolves to a Completion. `adapter=False` = base model.
+        `on_text(piece)` streams the response as it is decoded (called from the scheduler thread).
+        """
+        if self._closed.is_set():
+            raise RuntimeError("Scheduler is closed")
+        sequence = _Sequence(
+            prompt_ids = self.tokenizer(prompt)["input_ids"],
+            adapter = adapter,
+            max_new_tokens = max_new_tokens or self.max_new_tokens,
+            future = Future(),
+            on_text = on_text,
+            decoder = IncrementalDecoder(self.tokenizer) if on_text is not None else None,
+        )
+        self.queue.put(sequence)
+        return sequence.future
+
+    def generate(self, prompt, adapter = True, max_new_tokens = None):
+        """Blocking submit; returns the response text"""
+        return self.submit(prompt, adapter, max_new_tokens).result().text
+
+    def close(self):
+        self._closed.set()
+        self._thread.join()
+        error = RuntimeError("Scheduler closed")
+        while not self.queue.empty():
+            self.waiting.append(self.queue.get_nowait())
+        for sequence in self.waiting:
+            sequence.future.set_exception(error)
+        for batch in self.batches.values():
+            self._fail(batch.sequences, error)
+            batch.__init__()
+
+    # --- scheduler thread ----------------------------------------------
+
+    def _running(self):
+        return [s for batch in self.batches.values() for s in batch.sequences]
+
+    def _loop(self):
+        with torch.inference_mode():
+            while not self._closed.is_set():
+                self._admit()
+                for adapter, batch in self.batches.items():
+                    if batch.sequences:
+                        self._step(adapter, batch)
+
+    def _collect(self, idle):
+        """Move queued requests to `waiting`; when idle, wait for the first one plus the batching window"""
+        if idle:
+            try:
+                self.waiting.append(self.queue.get(timeout = 0.1))  # Wakes up to notice close()
+            except queue.Empty:
+                return
+            deadline = time.perf_counter() + self.max_wait
+            while len(self.waiting) < self.max_batch_size:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                try:
+                    self.waiting.append(self.queue.get(timeout = remaining))
+                except queue.Empty:
+                    break
+        while True:
+            try:
+                self.waiting.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+
+    def _admit(self):
+        running = self._running()
+        self._collect(idle = not running and not self.waiting)
+
+        in_flight = sum(s.budget for s in running)
+        admitted = {True: [], False: []}
+        while self.waiting and len(running) < self.max_batch_size:
+            sequence = self.waiting[0]
+            # An oversized request still runs, alone
+            if running and in_flight + sequence.budget > self.max_tokens_in_flight:
+                break
+            self.waiting.popleft()
+            if not sequence.future.set_running_or_notify_cancel():
+                continue
+            admitted[sequence.adapter].append(sequence)
+            running.append(sequence)
+            in_flight += sequence.budget
+        self.stats["max_running"] = max(self.stats["max_running"], len(running))
+
+        for adapter, sequences in admitted.items():
+            if sequences and self.stepwise:
+                self._prefill(adapter, sequences)
+            elif sequences:
+                self._generate(adapter, sequences)
+
+    def _adapter_state(self, adapter):
+        if adapter:
+            return nullcontext()
+        if not hasattr(self.model, "disable_adapter"):
+            raise RuntimeError("Model has no adapters to disable")
+        return self.model.disable_adapter()
+
+    def _forward(self, **inputs):
+        """Last-position logits and the KV cache the forward returned (always used from here on)"""
+        outputs = self.model(**inputs)
+        cache = outputs.past_key_values
+        if isinstance(cache, (tuple, list)):  # Legacy per-layer (keys, values) pairs
+            cache = DynamicCache(cache, config = self.model.config)
+        elif not isinstance(cache, DynamicCache):
+            raise TypeError(f"Unsupported KV cache {type(cache).__name__}: batches are merged as DynamicCache layers")
+        return outputs.logits[:, -1], cache
+
+    def _sample(self, logits, sequences):
+        input_ids = None
+        if self.penalize:
+            # Each row's prompt + generated tokens, left-filled with its own first token (no pad penalized)
+            histories = [s.prompt_ids + s.generated for s in sequences]
+            width = max(len(h) for h in histories)
+            input_ids = torch.tensor([h[:1] * (width - len(h)) + h for h in histories], device = self.device)
+        scores = self.processors(input_ids, logits.float())
+        if not self.do_sample:
+            return scores.argmax(dim = -1)
+        return torch.multinomial(torch.softmax(scores, dim = -1), num_samples = 1).squeeze(-1)
+
+    def _prefill(self, adapter, sequences):
+        """Prefill new prompts, grouped by the longest cached prefix each one starts with"""
+        if self.prefix_cache is None:
+            self._prefill_group(adapter, sequences)
+            return
+        state = PREFIX_STATES[adapter]
+        try:
+            if self.preamble_ids:
+                with self._adapter_state(adapter):
+                    self.prefix_cache.get(self.model, state, self.preamble_ids, pin = True)
+        except Exception as e:
+            self._fail(sequences, e)
+            return
+        groups = {}
+        for sequence in sequences:
+            prefix = self.prefix_cache.lookup(state, sequence.prompt_ids)
+            groups.setdefault(prefix.ids if prefix else (), (prefix, []))[1].append(sequence)
+        for prefix, group in groups.values():
+            self._prefill_group(adapter, group, prefix)
+
+    def _prefill_group(self, adapter, sequences, prefix = None):
+        """
+        Encode new prompts, sample their first token and merge them in. Without a
+        prefix they are left-padded together; with one, only the tokens after it
+        run: [prefix][padding][suffix], starting from a copy of its KV states.
+        """
+        skip = len(prefix) if prefix is not None else 0
+        suffixes = [s.prompt_ids[skip:] for s in sequences]
+        width = max(len(suffix) for suffix in suffixes)
+        input_ids = torch.tensor([[self.pad_id] * (width - len(suffix)) + suffix for suffix in suffixes])
+        attention_mask = torch.tensor([[0] * (width - len(suffix)) + [1] * len(suffix) for suffix in suffixes])
+        if prefix is not None:
+            attention_mask = prefix.attention_mask(attention_mask)
+        input_ids, attention_mask = input_ids.to(self.device), attention_mask.to(self.device)
+        try:
+            with self._adapter_state(adapter):
+                logits, cache = self._forward(
+                    input_ids = input_ids,
+                    attention_mask = attention_mask,
+                    position_ids = (attention_mask.cumsum(-1) - 1).clamp(min = 0)[:, skip:],
+                    past_key_values = prefix.cache(len(sequences)) if prefix is not None else DynamicCache(),
+                    use_cache = True,
+                    logits_to_keep = 1,
+                )
+            tokens = self._sample(logits, sequences)
+        except Exception as e:
+            self._fail(sequences, e)
+            return
+        self.stats["requests"] += len(sequences)
+        self.stats["prefills"] += 1
+        self.stats["prefill_tokens"] += sum(len(suffix) for suffix in suffixes)
+        if self.prefix_cache is not None:
+            self._remember_prompts(adapter, sequences, cache, attention_mask, skip)
+
+        keep = self._record(sequences, tokens)
+        if not keep:
+            return
+        self._select(cache, attention_mask, keep)
+        attention_mask = attention_mask[keep]
+        batch = self.batches[adapter]
+        if not batch.sequences:
+            batch.cache, batch.attention_mask, batch.pending = cache, attention_mask, tokens[keep]
+        else:
+            width = max(batch.attention_mask.shape[1], attention_mask.shape[1])
+            for old, new in zip(batch.cache.layers, cache.layers):
+                old.keys = torch.cat([_left_pad(old.keys, width, -2), _left_pad(new.keys, width, -2)])
+                old.values = torch.cat([_left_pad(old.values, width, -2), _left_pad(new.values, width, -2)])
+            batch.attention_mask = torch.cat([_left_pad(batch.attention_mask, width, -1),
+                                              _left_pad(attention_mask, width, -1)])
+            batch.pending = torch.cat([batch.pending, tokens[keep]])
+        batch.sequences += [sequences[i] for i in keep]
+
+    def _remember_prompts(self, adapter, sequences, cache, attention_mask, skip):
+        """Keep each prompt's KV (all but its last token) in the LRU, for repeated prompts"""
+        for row, sequence in enumerate(sequences):
+            if len(sequence.prompt_ids) - 1 <= skip:
+                continue
+            columns = attention_mask[row].nonzero().squeeze(-1)[:-1]
+            entry = row_entry(cache, row, columns, sequence.prompt_ids[:-1], self.model.config)
+            self.prefix_cache.put(PREFIX_STATES[adapter], entry)
+
+    def _step(self, adapter, batch):
+        """Feed every pending token through the model once"""
+        batch.attention_mask = F.pad(batch.attention_mask, (0, 1), value = 1)
+        try:
+            with self._adapter_state(adapter):
+                logits, batch.cache = self._forward(
+                    input_ids = batch.pending[:, None],
+                    attention_mask = batch.attention_mask,
+                    position_ids = batch.attention_mask.sum(-1, keepdim = True) - 1,
+                    past_key_values = batch.cache,
+                    use_cache = True,
+                )
+            tokens = self._sample(logits, batch.sequences)
+        except Exception as e:
+            self._fail(batch.sequences, e)
+            batch.__init__()
+            return
+        self.stats["steps"] += 1
+
+        keep = self._record(batch.sequences, tokens)
+        if len(keep) < len(batch.sequences):
+            batch.sequences = [batch.sequences[i] for i in keep]
+            if not keep:
+                batch.__init__()
+                return
+            self._select(batch.cache, batch.attention_mask, keep)
+            batch.attention_mask = batch.attention_mask[keep]
+            # Drop columns that are now padding in every row
+            first = int(batch.attention_mask.any(0).int().argmax())
+            if first:
+                batch.attention_mask = batch.attention_mask[:, first:]
+                for layer in batch.cache.layers:
+                    layer.keys, layer.values = layer.keys[:, :, first:], layer.values[:, :, first:]
+        batch.pending = tokens[keep]
+
+    def _generate(self, adapter, sequences):
+        """Run a group to completion through model.generate (models whose forward the step loop can't drive)"""
+        width = max(len(s.prompt_ids) for s in sequences)
+        input_ids = torch.tensor([[self.pad_id] * (width - len(s.prompt_ids)) + s.prompt_ids for s in sequences])
+        attention_mask = torch.tensor([[0] * (width - len(s.prompt_ids)) + [1] * len(s.prompt_ids) for s in sequences])
+        streamer = _RowStreamer(self._record, sequences)
+        try:
+            with self._adapter_state(adapter):
+                self.model.generate(
+                    input_ids = input_ids.to(self.device),
+                    attention_mask = attention_mask.to(self.device),
+                    pad_token_id = self.pad_id,
+                    streamer = streamer,
+                    **{**self.generate_kwargs, "max_new_tokens": max(s.max_new_tokens for s in sequences)},
+                )
+        except Exception as e:
+            self._fail(sequences, e)
+            return
+        self.stats["requests"] += len(sequences)
+        self.stats["prefills"] += 1
+        self.stats["prefill_tokens"] += sum(len(s.prompt_ids) for s in sequences)
+        for i in streamer.rows:  # Stopped by a criterion _record doesn't know about
+            self._finish(sequences[i])
+
+    def _select(self, cache, attention_mask, keep):
+        if len(keep) < attention_mask.shape[0]:
+            cache.batch_select_indices(torch.tensor(keep, device = self.device))
+
+    def _record(self, sequences, tokens) -> List[int]:
+        """Append sampled tokens; resolve finished sequences. Returns the rows still running."""
+        keep = []
+        now = time.perf_counter()
+        for i, (sequence, token) in enumerate(zip(sequences, tokens.tolist())):
+            sequence.token_times.append(now)
+            if token in self.eos_ids:
+                self._finish(sequence)
+                continue
+            sequence.generated.append(token)
+            if sequence.decoder is not None:
+                sequence.emit(sequence.decoder.push(token))
+            if len(sequence.generated) >= sequence.max_new_tokens:
+                self._finish(sequence)
+            else:
+                keep.append(i)
+        return keep
+
+    def _finish(self, sequence):
+        if sequence.decoder is not None:
+            sequence.emit(sequence.decoder.flush())
+        times = sequence.token_times
+        sequence.future.set_result(Completion(
+            text = self.tokenizer.decode(sequence.generated, skip_special_tokens = True).strip(),
+            tokens = len(sequence.generated),
+            ttft = times[0] - sequence.submitted,
+            total = times[-1] - sequence.submitted,
+            inter_token = [later - earlier for earlier, later in zip(times, times[1:])],
+        ))
+
+    def _fail(self, sequences, error: Exception):
+        for sequence in sequences:
+            if not sequence.future.done():
+                sequence.future.set_exception(error)
@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+"""
+Evaluation Result Cache
+Per-sample perplexity terms and generations in SQLite, computed once per model
+
+Tables (one row per model x sample x settings):
+
+    scores       model_key, sample_key, settings_key -> loss_sum, tokens
+    generations  model_key, prompt_key, params_key   -> text, tokens, latency
+    models       model_key -> path, first seen
+
+- model_key: blake2b of the weights a directory would load (adapter files
+  when present, else full model shards) plus its tokenizer files, so every
+  checkpoint under checkpoints/ gets its own key and an unchanged one hits
+- sample_key: the token ids scored and the response offset
+- prompt_key: the full prompt text
+- settings_key / params_key: everything else that changes the numbers
+  (scope, MAX_SEQ_LENGTH, quantization; decoding parameters, stop strings)
+
+Perplexity is stored as per-sample (summed NLL, token count) so any subset
+aggregates exactly. Writes are committed per batch: an interrupted run keeps
+what it finished. Generated samples are cached as sampled - re-running does
+not resample them.
+"""
+
+import hashlib
+import json
+import sqlite3
+import time
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from token_cache import TOKENIZER_FILES, file_digest
+
+MODEL_FILE_PATTERNS = ["adapter_config.json", "adapter_model.safetensors", "adapter_model.bin"]
+FULL_MODEL_PATTERNS = ["config.json", "model*.safetensors", "pytorch_model*.bin"]
+LOOKUP_CHUNK = 500  # Keys per SELECT ... IN (...) (SQLite variable limit)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS scores (
+    model_key TEXT, sample_key TEXT, settings_key TEXT,
+    loss_sum REAL, tokens INTEGER, created REAL,
+    PRIMARY KEY (model_key, sample_key, settings_key)
+);
+CREATE TABLE IF NOT EXISTS generations (
+    model_key TEXT, prompt_key TEXT, params_key TEXT,
+    text TEXT, tokens INTEGER, latency REAL, created REAL,
+    PRIMARY KEY (model_key, prompt_key, params_key)
+);
+CREATE TABLE IF NOT EXISTS models (
+    model_key TEXT PRIMARY KEY, path TEXT, created REAL
+);
+"""
+
+
+def digest(*parts) -> str:
+    """16-byte blake2b of str/bytes parts."""
+    h = hashlib.blake2b(digest_size=16)
+    for part in parts:
+        h.update(part if isinstance(part, bytes) else str(part).encode("utf-8"))
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+def settings_key(settings: Dict) -> str:
+    return digest(json.dumps(settings, sort_keys=True))
+
+
+def model_key(model_dir: Path) -> str:
+    """Hash of the weight + tokenizer files a model directory would load."""
+    model_dir = Path(model_dir)
+    files = [p for pattern in MODEL_FILE_PATTERNS for p in sorted(model_dir.glob(pattern))]
+    if not files:
+        files = [p for pattern in FULL_MODEL_PATTERNS for p in sorted(model_dir.glob(pattern))]
+    if not files:
+        raise FileNotFoundError(f"No adapter or model weights in {model_dir}")
+    files += [model_dir / name for name in TOKENIZER_FILES if (model_dir / name).exists()]
+    return digest(*(f"{p.name}={file_digest(p)}" for p in files))
+
+
+def sample_key(input_ids: List[int], response_start: int) -> str:
+    return digest(",".join(map(str, input_ids)), response_start)
+
+
+def prompt_key(prompt: str) -> str:
+    return digest(prompt)
+
+
+class EvalCache:
+    """SQLite-backed store of per-sample evaluation results."""
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.db = sqlite3.connect(str(self.path))
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript(_SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def register_model(self, key: str, path: Path):
+        with self.db:
+            self.db.execute("INSERT OR IGNORE INTO models VALUES (?, ?, ?)", (key, str(path), time.time()))
+
+    def _lookup(self, query: str, fixed: Tuple, keys: Iterable[str]) -> Dict[str, Tuple]:
+        keys = list(dict.fromkeys(keys))
+        found = {}
+        for start in range(0, len(keys), LOOKUP_CHUNK):
+            chunk = keys[start:start + LOOKUP_CHUNK]
+            marks = ",".join("?" * len(chunk))
+            for row in self.db.execute(query.format(marks=marks), fixed + tuple(chunk)):
+                found[row[0]] = row[1:]
+        return found
+
+    # --- perplexity ----------------------------------------------------
+
+    def get_scores(self, model: str, settings: str, keys: Iterable[str]) -> Dict[str, Tuple[float, int]]:
+        """sample_key -> (loss_sum, tokens) for the cached keys."""
+        return self._lookup(
+            "SELECT sample_key, loss_sum, tokens FROM scores "
+            "WHERE model_key = ? AND settings_key = ? AND sample_key IN ({marks})",
+            (model, settings), keys)
+
+    def put_scores(self, model: str, settings: str, rows: Iterable[Tuple[str, float, int]]):
+        now = time.time()
+        with self.db:
+            self.db.executemany("INSERT OR REPLACE INTO scores VALUES (?, ?, ?, ?, ?, ?)",
+                                [(model, key, settings, loss, tokens, now) for key, loss, tokens in rows])
+
+    # --- generations ---------------------------------------------------
+
+    def get_generations(self, model: str, params: str, keys: Iterable[str]) -> Dict[str, Dict]:
+        """prompt_key -> {"text", "tokens", "latency"} for the cached keys."""
+        found = self._lookup(
+            "SELECT prompt_key, text, tokens, latency FROM generations "
+            "WHERE model_key = ? AND params_key = ? AND prompt_key IN ({marks})",
+            (model, params), keys)
+        return {key: {"text": text, "tokens": tokens, "latency": latency}
+                for key, (text, tokens, latency) in found.items()}
+
+    def put_generations(self, model: str, params: str, rows: Iterable[Tuple[str, Dict]]):
+        now = time.time()
+        with self.db:
+            self.db.executemany("INSERT OR REPLACE INTO generations VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                [(model, key, params, r["text"], r["tokens"], r["latency"], now)
+                                 for key, r in rows])
+
+    def stats(self, model: Optional[str] = None) -> Dict[str, int]:
+        where, args = ("WHERE model_key = ?", (model,)) if model else ("", ())
+        return {table: self.db.execute(f"SELECT COUNT(*) FROM {table} {where}", args).fetchone()[0]
+                for table in ("scores", "generations")}
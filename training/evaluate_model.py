@@ -5,32 +5,56 @@ Evaluate trained Qwen model on validation set
 """
 
 import torch
-from unsloth import FastLanguageModel
+import torch.nn.functional as F
 from datasets import load_dataset
 from pathlib import Path
+import functools
 import json
+import math
 from tqdm import tqdm
 import time
+from typing import Dict, List, Tuple
+
+from transformers import AutoTokenizer, StopStringCriteria, StoppingCriteria, StoppingCriteriaList
+
+from eval_cache import EvalCache, model_key, prompt_key, sample_key, settings_key
+from prefix_cache import PrefixEntry, compute_prefix, template_preamble, unsloth_patched
+from prepare_data import ALPACA_PROMPT
+from token_cache import find_token_cache
 
 # Paths - Lightning.ai compatible
 DATA_DIR = Path("./data")
 MODEL_DIR = Path("./outputs/zima_qwen_geriatric/final_model")
 OUTPUT_FILE = Path("./outputs/evaluation_results.json")
+EVAL_CACHE_FILE = Path("./outputs/eval_cache.sqlite")  # None = always recompute everything
 
 # Config
 MAX_SEQ_LENGTH = 512
-NUM_SAMPLES = 50  # Number of samples to generate for manual review
+LOAD_IN_4BIT = True
+NUM_SAMPLES = None  # Samples to generate (None = the whole validation set)
+MAX_NEW_TOKENS = 256
+TEMPERATURE = 0.7
+TOP_P = 0.9
+GENERATION_BATCH_SIZE = 16  # Prompts per generate() call (sorted by length, left-padded)
+STOP_STRINGS = ["### Instruction:", "### Response:"]  # The model starting another Alpaca turn
+USE_TOKEN_CACHE = True  # Score perplexity on data/token_cache/ ids when available
+PERPLEXITY_SAMPLES = None  # None = the whole validation set
+PERPLEXITY_BATCH_SIZE = 16
+PERPLEXITY_RESPONSE_ONLY = False  # True = score response tokens only (the prompt is context)
+LOSS_CHUNK_TOKENS = 256  # Positions per lm_head + cross-entropy step (bounds the vocab-sized logits)
+USE_PREFIX_CACHE = None  # Compute the Alpaca header's KV once per run instead of once per row. None = only if the model is not Unsloth-patched (unverified there)
 
 
 def load_model(model_path: Path):
     """Load trained model"""
     print(f"📂 Loading model from: {model_path}")
+    from unsloth import FastLanguageModel
     
     model, tokenizer = FastLanguageModel.from_pretrained(
         model_name=str(model_path),
         max_seq_length=MAX_SEQ_LENGTH,
         dtype=None,
-        load_in_4bit=True,
+        load_in_4bit=LOAD_IN_4BIT,
     )
     
     # Enable inference mode
@@ -56,61 +80,293 @@ def extract_instruction_input(text: str) -> tuple:
         return "", ""
 
 
-def generate_response(model, tokenizer, instruction: str, input_text: str = "") -> str:
-    """Generate response for given instruction"""
-    prompt = f"""Below is an instruction that describes a task, paired with an input that provides further context. Write a response that appropriately completes the request.
+def build_prompt(instruction: str, input_text: str = "") -> str:
+    """Alpaca prompt up to and including "### Response:\n" """
+    return ALPACA_PROMPT.format(instruction=instruction, input=input_text, output="")
 
-### Instruction:
-{instruction}
 
-### Input:
-{input_text}
+class StepClock(StoppingCriteria):
+    """Never stops generation; records when each decoding step finished"""
+    
+    def __init__(self):
+        self.times = []
+    
+    def __call__(self, input_ids, scores, **kwargs):
+        self.times.append(time.perf_counter())
+        return torch.zeros(input_ids.shape[0], dtype=torch.bool, device=input_ids.device)
 
-### Response:
-"""
+
+_stop_criteria = {}
+
+
+def stop_string_criteria(tokenizer) -> StopStringCriteria:
+    """STOP_STRINGS matcher, built once per tokenizer (construction scans the whole vocabulary, ~3s)"""
+    if id(tokenizer) not in _stop_criteria:
+        _stop_criteria[id(tokenizer)] = StopStringCriteria(tokenizer, STOP_STRINGS)
+    return _stop_criteria[id(tokenizer)]
+
+
+def trim_generation(tokenizer, new_ids: List[int]) -> Tuple[str, int]:
+    """(response text, generated tokens) for one row: cut at EOS/padding, then at the first stop string"""
+    length = len(new_ids)
+    for i, token in enumerate(new_ids):
+        if token == tokenizer.eos_token_id:
+            length = i + 1
+            break
+        if token == tokenizer.pad_token_id:
+            length = i
+            break
+    text = tokenizer.decode(new_ids[:length], skip_special_tokens=True)
+    for stop in STOP_STRINGS:
+        text = text.split(stop)[0]
+    return text.strip(), length
+
+
+def _loaded(model):
+    """`model` is a model, or a zero-argument loader called only when something is not cached"""
+    return model if isinstance(model, torch.nn.Module) else model()
+
+
+def prefix_enabled(model) -> bool:
+    """USE_PREFIX_CACHE for `model`: Unsloth's forward is not known to accept an external cache + mid-row padding"""
+    if USE_PREFIX_CACHE is None:
+        return not unsloth_patched(model)
+    return USE_PREFIX_CACHE
+
+
+def preamble_prefix(model, tokenizer) -> PrefixEntry:
+    """KV (and hidden) states of the Alpaca header for the weights loaded right now"""
+    ids = tokenizer(template_preamble(ALPACA_PROMPT), add_special_tokens=False)["input_ids"]
+    return compute_prefix(model, ids)
+
+
+def generation_params(max_new_tokens: int = MAX_NEW_TOKENS) -> Dict:
+    """Everything besides the prompt and the weights that changes a generation (eval cache key)"""
+    return {"max_new_tokens": max_new_tokens, "temperature": TEMPERATURE, "top_p": TOP_P,
+            "do_sample": True, "stop_strings": STOP_STRINGS, "load_in_4bit": LOAD_IN_4BIT,
+            "prefix_cache": USE_PREFIX_CACHE}
+
+
+def generate_responses(model, tokenizer, prompts: List[Tuple[str, str]],
+                       batch_size: int = GENERATION_BATCH_SIZE,
+                       max_new_tokens: int = MAX_NEW_TOKENS,
+                       cache: EvalCache = None, cache_model: str = None) -> List[Dict]:
+    """
+    Generate responses for (instruction, input) pairs in left-padded batches.
     
-    inputs = tokenizer([prompt], return_tensors="pt").to("cuda")
+    Prompts are sorted by token length so a batch pads little; results come
+    back in input order. Each row stops on its own at EOS or a stop string.
+    With the prefix cache (prefix_enabled) the shared header is prefilled
+    once (prefix_cache.py) and each batch starts from a copy of its KV.
+    Per sample: text, generated tokens, latency (time until its last token;
+    rows of a batch share the prefill) and whether it came from `cache`.
+    """
+    texts = [build_prompt(instruction, input_text) for instruction, input_text in prompts]
+    results = [None] * len(texts)
+    if cache is not None:
+        params = settings_key(generation_params(max_new_tokens))
+        keys = [prompt_key(text) for text in texts]
+        hits = cache.get_generations(cache_model, params, keys)
+        for i, key in enumerate(keys):
+            if key in hits:
+                results[i] = {**hits[key], "cached": True}
+    todo = [i for i, result in enumerate(results) if result is None]
+    if not todo:
+        return results
     
-    outputs = model.generate(
-        **inputs,
-        max_new_tokens=256,
-        temperature=0.7,
-        top_p=0.9,
-        do_sample=True,
-        use_cache=True,
-    )
+    model = _loaded(model)
+    prefix = preamble_prefix(model, tokenizer) if prefix_enabled(model) else None
+    lengths = [len(ids) for ids in tokenizer([texts[i] for i in todo], add_special_tokens=False)["input_ids"]]
+    order = [todo[j] for j in sorted(range(len(todo)), key=lambda j: -lengths[j])]
+    
+    padding_side = tokenizer.padding_side
+    tokenizer.padding_side = "left"
+    try:
+        for start in tqdm(range(0, len(order), batch_size), desc="Batches"):
+            batch = order[start:start + batch_size]
+            ids = tokenizer([texts[i] for i in batch])["input_ids"]
+            if prefix is not None and all(prefix.matches(row) for row in ids):
+                inputs = prefixed_inputs(ids, prefix, tokenizer.pad_token_id, model.device)
+            else:
+                inputs = tokenizer.pad({"input_ids": ids}, return_tensors="pt").to(model.device)
+            clock = StepClock()
+            started = time.perf_counter()
+            
+            outputs = model.generate(
+                **inputs,
+                max_new_tokens=max_new_tokens,
+                temperature=TEMPERATURE,
+                top_p=TOP_P,
+                do_sample=True,
+                use_cache=True,
+                pad_token_id=tokenizer.pad_token_id,
+                stopping_criteria=StoppingCriteriaList([stop_string_criteria(tokenizer), clock]),
+            )
+            
+            new_tokens = outputs[:, inputs["input_ids"].shape[1]:].tolist()
+            for i, ids in zip(batch, new_tokens):
+                text, n_tokens = trim_generation(tokenizer, ids)
+                finished = clock.times[min(max(n_tokens, 1), len(clock.times)) - 1] if clock.times else time.perf_counter()
+                results[i] = {"text": text, "tokens": n_tokens, "latency": finished - started, "cached": False}
+            if cache is not None:
+                cache.put_generations(cache_model, params, [(keys[i], results[i]) for i in batch])
+    finally:
+        tokenizer.padding_side = padding_side
     
-    response = tokenizer.batch_decode(outputs)[0]
+    return results
+
+
+def prefixed_inputs(ids: List[List[int]], prefix: PrefixEntry, pad_id: int, device) -> Dict:
+    """
+    generate() inputs laid out as [prefix][left padding][suffix] with the
+    prefix KV as past_key_values, so only the suffixes are prefilled.
+    Positions come from the attention mask and skip the padding.
+    """
+    suffixes = [row[len(prefix):] for row in ids]
+    width = max(len(row) for row in suffixes)
+    suffix_ids = torch.tensor([[pad_id] * (width - len(row)) + row for row in suffixes])
+    suffix_mask = torch.tensor([[0] * (width - len(row)) + [1] * len(row) for row in suffixes])
+    input_ids = torch.cat([torch.tensor([prefix.ids] * len(ids)), suffix_ids], dim=1)
+    return {
+        "input_ids": input_ids.to(device),
+        "attention_mask": prefix.attention_mask(suffix_mask).to(device),
+        "past_key_values": prefix.cache(len(ids)),
+    }
+
+
+def generate_response(model, tokenizer, instruction: str, input_text: str = "",
+                      max_new_tokens: int = MAX_NEW_TOKENS) -> str:
+    """Generate response for given instruction"""
+    return generate_responses(model, tokenizer, [(instruction, input_text)], 1, max_new_tokens)[0]["text"]
+
+
+def scoring_rows(tokenizer, dataset, token_dataset=None) -> List[Tuple[List[int], int]]:
+    """
+    (input_ids, response_start) per sample, matching tokenizer(text) truncated
+    to MAX_SEQ_LENGTH. Cache rows drop their appended EOS; text rows locate the
+    response by tokenizing the prompt up to "### Response:\n".
+    """
+    if token_dataset is not None:
+        rows = []
+        for sample in token_dataset:
+            ids = sample["input_ids"]
+            if ids and ids[-1] == tokenizer.eos_token_id:
+                ids = ids[:-1]
+            rows.append((ids[:MAX_SEQ_LENGTH], sample["response_start"]))
+        return rows
     
-    # Extract just the response part
-    if "### Response:" in response:
-        response = response.split("### Response:")[-1].strip()
-        # Remove EOS token if present
-        if tokenizer.eos_token in response:
-            response = response.split(tokenizer.eos_token)[0].strip()
+    texts = list(dataset["text"])
+    prompts = [text[:text.find("### Response:") + len("### Response:\n")] for text in texts]
+    ids = tokenizer(texts, truncation=True, max_length=MAX_SEQ_LENGTH)["input_ids"]
+    starts = [len(p) for p in tokenizer(prompts)["input_ids"]]
+    return list(zip(ids, starts))
+
+
+def token_losses(model, input_ids, score_mask, attention_mask,
+                 prefix: PrefixEntry = None) -> Tuple[List[float], List[int]]:
+    """
+    Per-row summed next-token NLL over the positions in score_mask, and their counts.
     
-    return response
+    Runs the decoder once, then lm_head + cross_entropy(reduction="none")
+    over at most LOSS_CHUNK_TOKENS scored positions at a time, so the
+    vocabulary-sized logits never exist for the whole batch. With `prefix`
+    (every row starts with it) the decoder only runs on the columns after
+    it and the prefix's cached hidden states fill in the rest.
+    """
+    decoder = model.get_decoder()
+    if prefix is None:
+        hidden = decoder(input_ids=input_ids, attention_mask=attention_mask).last_hidden_state
+    else:
+        hidden = decoder(input_ids=input_ids[:, len(prefix):], attention_mask=attention_mask,
+                         past_key_values=prefix.cache(len(input_ids)), use_cache=True).last_hidden_state
+        hidden = torch.cat([prefix.hidden.expand(len(input_ids), -1, -1), hidden], dim=1)
+    lm_head = model.get_output_embeddings()
+    # Position t predicts token t + 1
+    scored = score_mask[:, 1:]
+    targets = input_ids[:, 1:][scored]
+    hidden = hidden[:, :-1][scored]
+    rows = torch.arange(len(input_ids), device=input_ids.device)[:, None].expand_as(scored)[scored]
+    totals = torch.zeros(len(input_ids), dtype=torch.float64, device=input_ids.device)
+    for start in range(0, len(targets), LOSS_CHUNK_TOKENS):
+        logits = lm_head(hidden[start:start + LOSS_CHUNK_TOKENS]).float()
+        losses = F.cross_entropy(logits, targets[start:start + LOSS_CHUNK_TOKENS], reduction="none")
+        totals.index_add_(0, rows[start:start + LOSS_CHUNK_TOKENS], losses.double())
+    return totals.tolist(), scored.sum(dim=1).tolist()
 
 
-def calculate_perplexity(model, tokenizer, dataset, max_samples=100):
-    """Calculate perplexity on validation set"""
-    print(f"\n📊 Calculating perplexity on {max_samples} samples...")
+def score_dataset(model, tokenizer, dataset, max_samples=PERPLEXITY_SAMPLES, token_dataset=None,
+                  batch_size: int = PERPLEXITY_BATCH_SIZE, response_only: bool = PERPLEXITY_RESPONSE_ONLY,
+                  cache: EvalCache = None, cache_model: str = None) -> Dict:
+    """
+    Perplexity over length-sorted, right-padded batches with exact token counts.
     
-    total_loss = 0
-    total_tokens = 0
+    With `cache`, samples already scored for `cache_model` are read back and
+    only the rest are run (the model is not loaded at all if none are left).
+    """
+    source = token_dataset if token_dataset is not None else dataset
+    n = len(source) if max_samples is None else min(max_samples, len(source))
+    print(f"\n📊 Calculating perplexity on {n} samples (batches of {batch_size}, "
+          f"{'response' if response_only else 'all'} tokens)...")
     
-    for i, sample in enumerate(tqdm(dataset.select(range(min(max_samples, len(dataset)))))):
-        text = sample["text"]
-        inputs = tokenizer(text, return_tensors="pt", truncation=True, max_length=MAX_SEQ_LENGTH).to("cuda")
+    rows = scoring_rows(tokenizer, dataset.select(range(n)) if token_dataset is None else None,
+                        token_dataset.select(range(n)) if token_dataset is not None else None)
+    scope = "response" if response_only else "full_text"
+    per_sample = [None] * n
+    if cache is not None:
+        settings = settings_key({"scope": scope, "max_seq_length": MAX_SEQ_LENGTH, "load_in_4bit": LOAD_IN_4BIT,
+                                 "prefix_cache": USE_PREFIX_CACHE})
+        keys = [sample_key(ids, response_start) for ids, response_start in rows]
+        hits = cache.get_scores(cache_model, settings, keys)
+        per_sample = [hits.get(key) for key in keys]
+    todo = [i for i in range(n) if per_sample[i] is None]
+    if len(todo) < n:
+        print(f"♻️  {n - len(todo)} of {n} samples from the eval cache")
+    order = sorted(todo, key=lambda i: -len(rows[i][0]))
+    pad_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id
+    
+    prefix = None
+    if order:
+        model = _loaded(model)
+        prefix = preamble_prefix(model, tokenizer) if prefix_enabled(model) else None
+    for start in tqdm(range(0, len(order), batch_size)):
+        indices = order[start:start + batch_size]
+        batch = [rows[i] for i in indices]
+        width = max(len(ids) for ids, _ in batch)
+        input_ids = torch.full((len(batch), width), pad_id, dtype=torch.long)
+        attention_mask = torch.zeros((len(batch), width), dtype=torch.long)
+        score_mask = torch.zeros((len(batch), width), dtype=torch.bool)
+        for row, (ids, response_start) in enumerate(batch):
+            input_ids[row, :len(ids)] = torch.tensor(ids, dtype=torch.long)
+            attention_mask[row, :len(ids)] = 1
+            score_mask[row, response_start if response_only else 0:len(ids)] = True
         
+        shared = prefix if prefix is not None and all(prefix.matches(ids) for ids, _ in batch) else None
         with torch.no_grad():
-            outputs = model(**inputs, labels=inputs["input_ids"])
-            loss = outputs.loss
-            total_loss += loss.item() * inputs["input_ids"].size(1)
-            total_tokens += inputs["input_ids"].size(1)
+            losses, counts = token_losses(model, input_ids.to(model.device), score_mask.to(model.device),
+                                          attention_mask.to(model.device), shared)
+        for i, loss, tokens in zip(indices, losses, counts):
+            per_sample[i] = (loss, tokens)
+        if cache is not None:
+            cache.put_scores(cache_model, settings, [(keys[i], *per_sample[i]) for i in indices])
     
-    perplexity = torch.exp(torch.tensor(total_loss / total_tokens))
-    return perplexity.item()
+    total_loss = sum(loss for loss, _ in per_sample)
+    total_tokens = sum(tokens for _, tokens in per_sample)
+    mean_loss = total_loss / max(total_tokens, 1)
+    return {
+        "perplexity": math.exp(mean_loss),
+        "mean_loss": mean_loss,
+        "samples": n,
+        "tokens": total_tokens,
+        "scored": scope,
+        "cached_samples": n - len(todo),
+    }
+
+
+def calculate_perplexity(model, tokenizer, dataset, max_samples=PERPLEXITY_SAMPLES, token_dataset=None,
+                         batch_size: int = PERPLEXITY_BATCH_SIZE,
+                         response_only: bool = PERPLEXITY_RESPONSE_ONLY) -> float:
+    """Calculate perplexity on validation set"""
+    return score_dataset(model, tokenizer, dataset, max_samples, token_dataset, batch_size, response_only)["perplexity"]
 
 
 def main():
@@ -127,44 +383,73 @@ def main():
     
     print(f"✅ Loaded {len(dataset)} validation samples")
     
-    # Load model
-    model, tokenizer = load_model(MODEL_DIR)
+    # Model is loaded on first use: with a warm eval cache it may not be needed at all
+    tokenizer = AutoTokenizer.from_pretrained(str(MODEL_DIR))
+    model = functools.cache(lambda: load_model(MODEL_DIR)[0])
+    cache, cache_model = None, None
+    if EVAL_CACHE_FILE is not None:
+        cache = EvalCache(EVAL_CACHE_FILE)
+        cache_model = model_key(MODEL_DIR)
+        cache.register_model(cache_model, MODEL_DIR)
+        print(f"🗄️  Eval cache: {EVAL_CACHE_FILE} (model {cache_model[:12]}, "
+              f"{cache.stats(cache_model)['generations']} generations cached)")
     
     # Calculate perplexity
-    perplexity = calculate_perplexity(model, tokenizer, dataset, max_samples=100)
-    print(f"\n📈 Perplexity: {perplexity:.2f}")
+    cached = find_token_cache(DATA_DIR, ALPACA_PROMPT, tokenizer, splits=("validation",)) if USE_TOKEN_CACHE else None
+    scores = score_dataset(model, tokenizer, dataset,
+                           token_dataset=cached["validation"] if cached is not None else None,
+                           cache=cache, cache_model=cache_model)
+    perplexity = scores["perplexity"]
+    print(f"\n📈 Perplexity: {perplexity:.2f} ({scores['tokens']:,} {scores['scored']} tokens, "
+          f"{scores['samples']} samples)")
     
     # Generate sample responses
-    print(f"\n🎯 Generating {NUM_SAMPLES} sample responses...")
+    num_samples = len(dataset) if NUM_SAMPLES is None else min(NUM_SAMPLES, len(dataset))
+    print(f"\n🎯 Generating {num_samples} sample responses (batches of {GENERATION_BATCH_SIZE})...")
+    
+    prompts = [extract_instruction_input(dataset[i]["text"]) for i in range(num_samples)]
+    start_time = time.time()
+    generated = generate_responses(model, tokenizer, prompts, cache=cache, cache_model=cache_model)
+    gen_time = time.time() - start_time
+    if cache is not None:
+        cache.close()
     
     samples = []
-    for i in tqdm(range(min(NUM_SAMPLES, len(dataset)))):
-        sample = dataset[i]
-        instruction, input_text = extract_instruction_input(sample["text"])
-        
-        # Extract expected output
-        expected = sample["output"]
-        
-        # Generate response
-        start_time = time.time()
-        generated = generate_response(model, tokenizer, instruction, input_text)
-        gen_time = time.time() - start_time
-        
+    for i, ((instruction, input_text), result) in enumerate(zip(prompts, generated)):
         samples.append({
             "instruction": instruction,
             "input": input_text,
-            "expected": expected,
-            "generated": generated,
-            "generation_time": f"{gen_time:.2f}s"
+            "expected": dataset[i]["output"],
+            "generated": result["text"],
+            "generation_time": f"{result['latency']:.2f}s",
+            "generated_tokens": result["tokens"],
+            "tokens_per_sec": round(result["tokens"] / result["latency"], 1) if result["latency"] > 0 else None,
         })
     
+    fresh = [r for r in generated if not r["cached"]]
+    fresh_tokens = sum(r["tokens"] for r in fresh)
+    generation = {
+        "batch_size": GENERATION_BATCH_SIZE,
+        "max_new_tokens": MAX_NEW_TOKENS,
+        "total_time": round(gen_time, 2),
+        "generated_tokens": sum(r["tokens"] for r in generated),
+        "cached_samples": len(generated) - len(fresh),
+        # Rates cover what this run generated
+        "tokens_per_sec": round(fresh_tokens / gen_time, 1) if fresh and gen_time > 0 else None,
+        "samples_per_sec": round(len(fresh) / gen_time, 2) if fresh and gen_time > 0 else None,
+    }
+    print(f"⚡ {len(fresh)} generated in {gen_time:.1f}s ({generation['tokens_per_sec']} tokens/sec), "
+          f"{generation['cached_samples']} from the eval cache")
+    
     # Save results
     print(f"\n💾 Saving evaluation results...")
     
     results = {
         "perplexity": perplexity,
+        "perplexity_details": scores,
         "validation_samples": len(dataset),
         "generated_samples": len(samples),
+        "generation": generation,
         "samples": samples
     }
     
@@ -186,7 +471,7 @@ def main():
             print(f"Input: {sample['input']}")
         print(f"\n✅ Expected:\n{sample['expected']}")
         print(f"\n🤖 Generated:\n{sample['generated']}")
-        print(f"\n⏱️  Time: {sample['generation_time']}")
+        print(f"\n⏱️  Time: {sample['generation_time']} ({sample['generated_tokens']} tokens)")
         print("-" * 70)
     
     print("\n" + "="*70)
@@ -195,6 +480,7 @@ def main():
     print(f"\n📊 Summary:")
     print(f"   Perplexity: {perplexity:.2f}")
     print(f"   Samples evaluated: {len(samples)}")
+    print(f"   Generation: {generation['tokens_per_sec']} tokens/sec")
     print(f"   Results: {OUTPUT_FILE}")
     print(f"\n💡 Review the samples to assess quality!")
 
@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+"""
+Corpus-Level Near-Duplicate Clustering
+MinHash + LSH over the whole prepared corpus, used by prepare_data.py
+
+- Shingles: word 3-grams of the normalized instruction + output (the
+  boilerplate `input` field is ignored, it would make unrelated samples look
+  alike)
+- MinHash: NUM_PERM universal hashes, vectorized with numpy over batches
+  of HASH_BATCH samples; this is the part that runs in the worker pool
+- LSH: BANDS bands of NUM_PERM / BANDS rows; samples sharing a band are
+  candidates (collision probability ~ jaccard ** rows, ~0.77 Jaccard for
+  64 x 8), kept only if their signatures agree on >= SIMILARITY_THRESHOLD
+- Clusters: connected components of the verified pairs (vectorized label
+  propagation); every cluster is labelled with its earliest member, so the
+  result does not depend on worker count
+
+Signatures are NUM_PERM uint32 per sample (256 bytes), so a million-sample
+corpus needs ~256 MB in the parent for the clustering step.
+"""
+
+import re
+import zlib
+from typing import Dict, List
+
+import numpy as np
+
+NUM_PERM = 64
+BANDS = 8
+SHINGLE_WORDS = 3
+SIMILARITY_THRESHOLD = 0.7  # Estimated Jaccard needed to merge an LSH candidate pair
+VERIFY_BATCH = 1 << 16  # Candidate pairs compared per step
+HASH_BATCH = 256  # Samples per vectorized MinHash step (~256 * shingles * NUM_PERM * 8 bytes)
+
+_MIX = np.uint64(0x100000001B3)  # FNV prime, combines token hashes into n-gram hashes
+_WORD_RE = re.compile(r"[a-z0-9]+")
+
+
+def sample_text(sample: Dict) -> str:
+    """The part of a sample that decides whether it is a duplicate."""
+    return f"{sample.get('instruction', '')}\n{sample.get('output', '')}"
+
+
+def normalize(text: str) -> List[str]:
+    """Lowercase word tokens with punctuation stripped."""
+    return _WORD_RE.findall(str(text).lower())
+
+
+def shingle_hashes(tokens: List[str]) -> np.ndarray:
+    """
+    64-bit hash of every word n-gram (deterministic across processes).
+    
+    Each token is crc32-hashed once and n-grams are combined arithmetically,
+    instead of joining and hashing every n-gram string.
+    """
+    token_hashes = np.fromiter(map(zlib.crc32, map(str.encode, tokens)), dtype=np.uint64, count=len(tokens))
+    if len(tokens) == 0:
+        return np.zeros(1, dtype=np.uint64)
+    width = max(1, len(tokens) - SHINGLE_WORDS + 1)
+    hashes = token_hashes[:width].copy()
+    for k in range(1, min(SHINGLE_WORDS, len(tokens))):
+        hashes = (hashes * _MIX) ^ token_hashes[k:k + width]
+    return hashes
+
+
+class MinHasher:
+    """NUM_PERM-wide MinHash signatures from a fixed seed (multiply-shift hash family)."""
+
+    def __init__(self, num_perm: int = NUM_PERM, seed: int = 42):
+        rng = np.random.default_rng(seed)
+        self.num_perm = num_perm
+        self.a = rng.integers(0, 1 << 63, size=num_perm, dtype=np.uint64) * np.uint64(2) + np.uint64(1)
+        self.b = rng.integers(0, 1 << 63, size=num_perm, dtype=np.uint64)
+
+    def _permute(self, hashes: np.ndarray) -> np.ndarray:
+        """(num_perm, len(hashes)) upper 32 bits of a * h + b (mod 2**64)."""
+        return (np.outer(self.a, hashes) + self.b[:, None]) >> np.uint64(32)
+
+    def signature(self, sample: Dict) -> np.ndarray:
+        hashes = shingle_hashes(normalize(sample_text(sample)))
+        return self._permute(hashes).min(axis=1).astype(np.uint32)
+
+    def signatures(self, samples: List[Dict]) -> np.ndarray:
+        """Signatures for many samples: one (shingles x perms) matrix per HASH_BATCH samples."""
+        out = np.empty((len(samples), self.num_perm), dtype=np.uint32)
+        for start in range(0, len(samples), HASH_BATCH):
+            hashes = [shingle_hashes(normalize(sample_text(s))) for s in samples[start:start + HASH_BATCH]]
+            offsets = np.cumsum([0] + [len(h) for h in hashes[:-1]])
+            # Perm-major layout keeps each reduction contiguous
+            out[start:start + len(hashes)] = np.minimum.reduceat(self._permute(np.concatenate(hashes)), offsets, axis=1).T
+        return out
+
+
+def band_keys(signatures: np.ndarray, band: int, rows: int) -> np.ndarray:
+    """64-bit hash of one band of every signature (collisions are caught by verification)."""
+    key = np.full(len(signatures), band + 1, dtype=np.uint64)
+    for column in signatures[:, band * rows:(band + 1) * rows].T:
+        key = (key ^ column.astype(np.uint64)) * _MIX
+    return key
+
+
+def candidate_pairs(signatures: np.ndarray, bands: int = BANDS,
+                    threshold: float = SIMILARITY_THRESHOLD) -> np.ndarray:
+    """(k, 2) array of verified near-duplicate pairs (member, first member of its LSH bucket)."""
+    n, num_perm = signatures.shape
+    rows = num_perm // bands
+    candidates = []
+    for band in range(bands):
+        keys = band_keys(signatures, band, rows)
+        order = np.argsort(keys, kind="stable")
+        grouped = keys[order]
+        is_start = np.ones(n, dtype=bool)
+        is_start[1:] = grouped[1:] != grouped[:-1]
+        starts = np.maximum.accumulate(np.where(is_start, np.arange(n), 0))
+        members, firsts = order[~is_start], order[starts[~is_start]]
+        candidates.append(members.astype(np.int64) * n + firsts)
+    # The same pair usually collides in several bands: verify it once
+    candidates = np.unique(np.concatenate(candidates))
+    members, firsts = candidates // n, candidates % n
+    similar = np.empty(len(candidates), dtype=bool)
+    for start in range(0, len(candidates), VERIFY_BATCH):
+        block = slice(start, start + VERIFY_BATCH)
+        agreement = (signatures[members[block]] == signatures[firsts[block]]).mean(axis=1)
+        similar[block] = agreement >= threshold
+    return np.stack([members[similar], firsts[similar]], axis=1)
+
+
+def connected_components(n: int, pairs: np.ndarray) -> np.ndarray:
+    """Smallest member index of each row's component (min-label propagation + pointer jumping)."""
+    labels = np.arange(n)
+    if len(pairs) == 0:
+        return labels
+    i, j = pairs[:, 0], pairs[:, 1]
+    while True:
+        previous = labels.copy()
+        np.minimum.at(labels, i, labels[j])
+        np.minimum.at(labels, j, labels[i])
+        while True:  # Pointer jumping: follow labels to their roots
+            jumped = labels[labels]
+            if np.array_equal(jumped, labels):
+                break
+            labels = jumped
+        if np.array_equal(labels, previous):
+            return labels
+
+
+def cluster(signatures: np.ndarray, bands: int = BANDS,
+            threshold: float = SIMILARITY_THRESHOLD) -> np.ndarray:
+    """Cluster label per row: the index of the cluster's earliest member."""
+    return connected_components(len(signatures), candidate_pairs(signatures, bands, threshold))
+
+
+def leakage(roots: np.ndarray, is_validation: np.ndarray) -> Dict:
+    """How many clusters (and validation samples) have members on both sides of a split."""
+    train_roots = np.unique(roots[~is_validation])
+    val_roots = np.unique(roots[is_validation])
+    straddling = np.intersect1d(train_roots, val_roots)
+    return {
+        "straddling_clusters": int(len(straddling)),
+        "leaked_validation_samples": int(np.isin(roots[is_validation], straddling).sum()),
+        "validation_samples": int(is_validation.sum()),
+    }
+
+
+def cluster_report(roots: np.ndarray) -> Dict:
+    """Dedup ratios for a clustering."""
+    _, sizes = np.unique(roots, return_counts=True)
+    n = len(roots)
+    return {
+        "samples": int(n),
+        "clusters": int(len(sizes)),
+        "duplicate_clusters": int((sizes > 1).sum()),
+        "duplicates_removed": int(n - len(sizes)),
+        "dedup_ratio": float((n - len(sizes)) / n) if n else 0.0,
+        "largest_cluster": int(sizes.max()) if n else 0,
+    }
@@ -0,0 +1,345 @@
+#!/usr/bin/env python3
+"""
+Length Bucketing and Sequence Packing for SFT
+Cut padding out of training/eval batches built from the token cache (token_cache.py)
+
+- Bucketing: LengthBucketSampler shuffles, cuts the order into mega-batches
+  of `batch_size * BUCKET_MEGABATCHES` samples, sorts each by length and
+  emits whole batches in random order, so a batch holds similar lengths.
+  Eval batches are simply sorted by length (order does not matter there).
+- Packing: pack_dataset concatenates samples (best-fit decreasing) into rows
+  of at most `max_length` tokens. PackedCollator restarts position_ids at
+  every sample and sends no 2D attention mask, which makes transformers
+  build a block-diagonal causal mask (varlen kernels with flash-attention),
+  so there is no cross-sample attention. Packed batches must run with
+  use_cache=False (the trainer mixin sets it): with a KV cache transformers
+  falls back to a plain causal mask. The label of each sample's first
+  token is -100 so no sample is trained to predict the next sample's start;
+  that is exactly the target the unpacked path never has either.
+  All of this relies on the stock transformers forward. Unsloth replaces
+  the Qwen2 model/attention forward with its own causal mask, so
+  Unsloth-patched models (prefix_cache.unsloth_patched) are not packed by
+  default (train_unsloth.py).
+- Response-only loss: with response_only=True both collators also set the
+  labels before each sample's `response_start` (the first token after
+  "### Response:\n", computed once by prepare_data.py into the token cache)
+  to -100, so the Alpaca preamble, instruction and input are context only.
+- Reporting: padding_report compares padding for random batches, bucketed
+  batches and packed rows before training; BucketingTrainerMixin logs
+  effective (non-padding) tokens/sec and the padding ratio as training runs.
+"""
+
+import bisect
+import time
+from typing import Dict, List
+
+import numpy as np
+import pyarrow as pa
+import torch
+from datasets import Dataset
+from torch.utils.data import Sampler
+
+BUCKET_MEGABATCHES = 50  # Batches per sorted mega-batch: more = tighter buckets, less randomness
+PAD_TO_MULTIPLE_OF = 8  # Tensor-core friendly widths
+
+
+def _padded_width(width: int) -> int:
+    return -(-width // PAD_TO_MULTIPLE_OF) * PAD_TO_MULTIPLE_OF
+
+
+# --- bucketing --------------------------------------------------------
+
+class LengthBucketSampler(Sampler):
+    """Shuffled batches of similar length (train) or one length-sorted pass (eval)."""
+
+    def __init__(self, lengths, batch_size: int, shuffle: bool = True, seed: int = 42,
+                 megabatches: int = BUCKET_MEGABATCHES):
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.seed = seed
+        self.megabatch_size = batch_size * megabatches
+        self.epoch = 0
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
+
+    def batches(self) -> List[np.ndarray]:
+        if not self.shuffle:
+            order = np.argsort(-self.lengths, kind="stable")
+            return [order[i:i + self.batch_size] for i in range(0, len(order), self.batch_size)]
+
+        rng = np.random.default_rng(self.seed + self.epoch)
+        order = rng.permutation(len(self.lengths))
+        batches = []
+        for start in range(0, len(order), self.megabatch_size):
+            mega = order[start:start + self.megabatch_size]
+            mega = mega[np.argsort(-self.lengths[mega], kind="stable")]
+            batches.extend(mega[i:i + self.batch_size] for i in range(0, len(mega), self.batch_size))
+        # Keep the last (possibly short) batch last so the DataLoader's batch boundaries line up
+        head = [batches[i] for i in rng.permutation(len(batches) - 1)] if len(batches) > 1 else []
+        return head + batches[-1:]
+
+    def __iter__(self):
+        batches = self.batches()
+        self.epoch += 1
+        for batch in batches:
+            yield from batch.tolist()
+
+
+# --- packing ----------------------------------------------------------
+
+def pack_rows(lengths: np.ndarray, max_length: int) -> List[List[int]]:
+    """Best-fit decreasing: sample indices per row, each row summing to <= max_length."""
+    rows = []
+    free = []  # Sorted (remaining capacity, row index)
+    for i in np.argsort(-lengths, kind="stable").tolist():
+        length = int(lengths[i])
+        slot = bisect.bisect_left(free, (length, -1))
+        if slot < len(free):
+            capacity, row = free.pop(slot)
+        else:
+            capacity, row = max_length, len(rows)
+            rows.append([])
+        rows[row].append(i)
+        if capacity - length > 0:
+            bisect.insort(free, (capacity - length, row))
+    return rows
+
+
+def pack_dataset(dataset: Dataset, max_length: int) -> Dataset:
+    """
+    Concatenate token-cache rows into packed rows of at most max_length tokens.
+
+    Works on the Arrow buffers directly (no per-token Python); samples longer
+    than max_length are truncated first, like the unpacked collator does.
+    Columns: input_ids, seq_lengths (tokens per packed sample),
+    response_starts (per packed sample, relative to its own start), length.
+    """
+    table = dataset.with_format("arrow")[:]
+    column = table["input_ids"].combine_chunks()
+    values = column.values.to_numpy(zero_copy_only=False)
+    offsets = column.offsets.to_numpy()
+    lengths = np.minimum(np.diff(offsets), max_length)
+
+    rows = pack_rows(lengths, max_length)
+    order = np.fromiter((i for row in rows for i in row), dtype=np.int64, count=len(lengths))
+    seq_lengths = lengths[order]
+    seq_starts = np.cumsum(seq_lengths) - seq_lengths
+    gather = np.repeat(offsets[:-1][order] - seq_starts, seq_lengths) + np.arange(seq_lengths.sum())
+
+    row_sizes = np.array([len(row) for row in rows], dtype=np.int64)
+    row_lengths = np.add.reduceat(seq_lengths, np.cumsum(row_sizes) - row_sizes) if len(rows) else row_sizes
+    row_offsets = np.concatenate([[0], np.cumsum(row_lengths)]).astype(np.int32)
+    seq_offsets = pa.array(np.concatenate([[0], np.cumsum(row_sizes)]).astype(np.int32))
+    if "response_start" in table.column_names:
+        response_starts = table["response_start"].to_numpy()[order]
+    else:
+        response_starts = np.zeros(len(order), dtype=np.int32)
+    return Dataset(pa.table({
+        "input_ids": pa.ListArray.from_arrays(pa.array(row_offsets), pa.array(values[gather].astype(np.int32))),
+        "seq_lengths": pa.ListArray.from_arrays(seq_offsets, pa.array(seq_lengths.astype(np.int32))),
+        "response_starts": pa.ListArray.from_arrays(seq_offsets, pa.array(response_starts.astype(np.int32))),
+        "length": pa.array(row_lengths.astype(np.int32)),
+    }))
+
+
+class PackedCollator:
+    """
+    Pad packed rows; restart position_ids per sample; mask sample starts and
+    padding in labels (and each sample's prompt if response_only).
+    """
+
+    def __init__(self, pad_token_id: int, max_length: int, response_only: bool = False):
+        self.pad_token_id = pad_token_id
+        self.max_length = max_length
+        self.response_only = response_only
+
+    def __call__(self, features: List[Dict]) -> Dict:
+        width = _padded_width(max(sum(f["seq_lengths"]) for f in features))
+        input_ids = torch.full((len(features), width), self.pad_token_id, dtype=torch.long)
+        labels = torch.full((len(features), width), -100, dtype=torch.long)
+        position_ids = torch.zeros((len(features), width), dtype=torch.long)
+        real = samples = 0
+        for row, f in enumerate(features):
+            ids = torch.tensor(f["input_ids"], dtype=torch.long)
+            used = len(ids)
+            input_ids[row, :used] = ids
+            labels[row, :used] = ids
+            prompts = f["response_starts"] if self.response_only else [0] * len(f["seq_lengths"])
+            start = 0
+            # Trailing padding is its own "sequence" (its labels are already -100)
+            for length, prompt in zip(list(f["seq_lengths"]) + [width - used], list(prompts) + [0]):
+                position_ids[row, start:start + length] = torch.arange(length)
+                # Always mask the sample's first token; with response_only its whole prompt
+                labels[row, start:start + min(max(prompt, 1), length)] = -100
+                start += length
+            real += used
+            samples += len(f["seq_lengths"])
+        return {"input_ids": input_ids, "labels": labels, "position_ids": position_ids,
+                "num_tokens": torch.tensor([real, input_ids.numel(), samples])}
+
+
+class PaddedCollator:
+    """
+    Unpacked cache rows: truncate, right-pad to a multiple of 8, mask padding
+    in labels (and the prompt if response_only).
+    """
+
+    def __init__(self, pad_token_id: int, max_length: int, response_only: bool = False):
+        self.pad_token_id = pad_token_id
+        self.max_length = max_length
+        self.response_only = response_only
+
+    def __call__(self, features: List[Dict]) -> Dict:
+        rows = [list(f["input_ids"][:self.max_length]) for f in features]
+        width = _padded_width(max(len(r) for r in rows))
+        input_ids = torch.full((len(rows), width), self.pad_token_id, dtype=torch.long)
+        attention_mask = torch.zeros((len(rows), width), dtype=torch.long)
+        for i, ids in enumerate(rows):
+            input_ids[i, :len(ids)] = torch.tensor(ids, dtype=torch.long)
+            attention_mask[i, :len(ids)] = 1
+        labels = input_ids.masked_fill(attention_mask == 0, -100)
+        if self.response_only:
+            for i, f in enumerate(features):
+                labels[i, :f["response_start"]] = -100
+        return {"input_ids": input_ids, "attention_mask": attention_mask, "labels": labels,
+                "num_tokens": torch.tensor([int(attention_mask.sum()), input_ids.numel(), len(rows)])}
+
+
+# --- reporting --------------------------------------------------------
+
+def _batch_padding(lengths: np.ndarray, batches) -> float:
+    slots = sum(_padded_width(int(lengths[b].max())) * len(b) for b in batches)
+    return 1 - lengths.sum() / slots if slots else 0.0
+
+
+def padding_report(lengths: np.ndarray, batch_size: int, max_length: int, seed: int = 42) -> Dict:
+    """Padding ratio (pad slots / all slots) for random batches, bucketed batches and packed rows."""
+    lengths = np.minimum(np.asarray(lengths), max_length)
+    order = np.random.default_rng(seed).permutation(len(lengths))
+    random_batches = [order[i:i + batch_size] for i in range(0, len(order), batch_size)]
+    bucketed = LengthBucketSampler(lengths, batch_size, seed=seed).batches()
+
+    row_lengths = np.array([lengths[row].sum() for row in pack_rows(lengths, max_length)])
+    packed_order = LengthBucketSampler(row_lengths, batch_size, seed=seed).batches()
+    return {
+        "samples": int(len(lengths)),
+        "real_tokens": int(lengths.sum()),
+        "padding_random": float(_batch_padding(lengths, random_batches)),
+        "padding_bucketed": float(_batch_padding(lengths, bucketed)),
+        "packed_rows": int(len(row_lengths)),
+        "padding_packed": float(_batch_padding(row_lengths, packed_order)),
+    }
+
+
+def print_padding_report(name: str, report: Dict):
+    print(f"   {name}: {report['samples']} samples, {report['real_tokens']:,} tokens")
+    print(f"     Padding: random batches {report['padding_random']:.1%}, "
+          f"bucketed {report['padding_bucketed']:.1%}, "
+          f"packed {report['padding_packed']:.1%} ({report['packed_rows']} rows)")
+
+
+class BucketingTrainerMixin:
+    """
+    Trainer mixin: length-bucketed train/eval samplers plus throughput logging.
+
+    Put it before the Trainer class (`class T(BucketingTrainerMixin, SFTTrainer)`).
+    Collators must add a `num_tokens` entry ([real tokens, padded slots,
+    samples]); it is removed before the forward pass.
+    """
+
+    length_bucketing = True
+
+    def _bucket_sampler(self, dataset, batch_size, shuffle):
+        if not self.length_bucketing or dataset is None or "length" not in dataset.column_names:
+            return None
+        return LengthBucketSampler(dataset["length"], batch_size, shuffle=shuffle, seed=self.args.seed)
+
+    def _get_train_sampler(self, train_dataset=None):
+        dataset = train_dataset if train_dataset is not None else self.train_dataset
+        sampler = self._bucket_sampler(dataset, self.args.train_batch_size, shuffle=True)
+        if sampler is not None:
+            return sampler
+        # Older Trainers take no dataset argument
+        return super()._get_train_sampler() if train_dataset is None else super()._get_train_sampler(train_dataset)
+
+    def _get_eval_sampler(self, eval_dataset, *args, **kwargs):
+        sampler = self._bucket_sampler(eval_dataset, self.args.eval_batch_size, shuffle=False)
+        return sampler if sampler is not None else super()._get_eval_sampler(eval_dataset, *args, **kwargs)
+
+    # --- throughput ----------------------------------------------------
+
+    def _throughput(self):
+        if not hasattr(self, "_token_stats"):
+            now = time.perf_counter()
+            self._token_stats = {
+                "total": {"tokens": 0, "slots": 0, "samples": 0, "start": now, "excluded": 0.0},
+                "window": {"tokens": 0, "slots": 0, "samples": 0, "start": now, "excluded": 0.0},
+            }
+        return self._token_stats
+
+    @staticmethod
+    def _rates(counter, now):
+        seconds = max(now - counter["start"] - counter["excluded"], 1e-9)
+        padding = 1 - counter["tokens"] / counter["slots"] if counter["slots"] else None
+        return counter["tokens"] / seconds, padding
+
+    @staticmethod
+    def _without_cache(inputs):
+        # transformers only detects packed position_ids when no KV cache is being built
+        if "position_ids" in inputs and "attention_mask" not in inputs:
+            inputs["use_cache"] = False
+        return inputs
+
+    def training_step(self, model, inputs, *args, **kwargs):
+        inputs = self._without_cache(inputs)
+        counts = inputs.pop("num_tokens", None)
+        if counts is not None:
+            real, slots, samples = (int(x) for x in counts.reshape(-1, 3).sum(0))
+            for counter in self._throughput().values():
+                counter["tokens"] += real
+                counter["slots"] += slots
+                counter["samples"] += samples
+        return super().training_step(model, inputs, *args, **kwargs)
+
+    def prediction_step(self, model, inputs, *args, **kwargs):
+        inputs = self._without_cache(inputs)
+        inputs.pop("num_tokens", None)
+        return super().prediction_step(model, inputs, *args, **kwargs)
+
+    def evaluate(self, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return super().evaluate(*args, **kwargs)
+        finally:
+            for counter in self._throughput().values():  # Eval time is not training time
+                counter["excluded"] += time.perf_counter() - started
+
+    def log(self, logs, *args, **kwargs):
+        window = self._throughput()["window"]
+        if window["slots"] and "loss" in logs:
+            now = time.perf_counter()
+            tokens_per_sec, padding = self._rates(window, now)
+            logs["effective_tokens_per_sec"] = round(tokens_per_sec, 1)
+            logs["padding_ratio"] = round(padding, 4)
+            window.update(tokens=0, slots=0, samples=0, start=now, excluded=0.0)
+        return super().log(logs, *args, **kwargs)
+
+    def token_counts(self) -> Dict:
+        """Cumulative training samples, real tokens and padded slots (for TrainingProfiler)."""
+        total = self._throughput()["total"]
+        return {"samples": total["samples"], "tokens": total["tokens"], "slots": total["slots"]}
+
+    def throughput_summary(self) -> Dict:
+        total = self._throughput()["total"]
+        tokens_per_sec, padding = self._rates(total, time.perf_counter())
+        return {
+            "train_tokens": total["tokens"],
+            "train_slots": total["slots"],
+            "padding_ratio": padding,
+            "effective_tokens_per_sec": tokens_per_sec,
+        }
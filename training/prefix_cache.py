@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+"""
+Shared-Prefix KV Cache
+KV states of the Alpaca preamble (and other repeated prompt prefixes), computed once per model state
+
+Every prompt starts with the same header ("Below is an instruction that
+describes a task, ...### Instruction:\n"). Its keys/values depend only on
+the weights that are active, so they are computed once and every batch
+only prefills the tokens after it:
+
+    input_ids       [prefix (cached)] [pad ... pad] [prompt suffix]
+    attention_mask   1 ........... 1   0 ....... 0   1 ........... 1
+    position_ids     0 ......... P-1   (masked)      P, P+1, ...
+
+Padding sits between the prefix and each row's suffix, so one prefix
+entry serves a whole batch; positions skip the padding, which gives the
+same states as an unpadded prompt.
+
+- Entries are read-only: `PrefixEntry.cache(batch_size)` copies them into
+  a fresh DynamicCache for each batch (copy-on-write - the batch appends,
+  the entry never changes)
+- PrefixCache is an LRU keyed by (state, token ids) under a token budget.
+  `state` names the weights the states were computed with ("zima",
+  "base", a checkpoint hash) so adapter and base KV never mix; pinned
+  entries (the preamble) are never evicted
+- Lookups match on token ids, so a prompt whose tokenization does not
+  start with the cached ids simply misses
+
+Training does not use it: LoRA weights change every optimizer step and the
+prefix's KV carries gradient, so there is nothing stable to reuse.
+
+All of this feeds a hand-built DynamicCache and a mask with padding in the
+middle of each row into the stock Transformers forward. Unsloth replaces
+that forward (unsloth_patched), and parity there is unverified, so the
+evaluator and the demo scheduler skip the prefix cache for such models.
+"""
+
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import List, Optional, Sequence, Tuple
+
+import torch
+from transformers import DynamicCache
+
+PREFIX_CACHE_TOKENS = 4096  # LRU budget (Qwen2.5-1.5B fp32: ~57 KB of KV per token)
+
+
+def unsloth_patched(model) -> bool:
+    """True if Unsloth replaced any module forward (its own masks and KV handling, not transformers')"""
+    for module in model.modules():
+        forward = getattr(type(module), "forward", None)
+        if getattr(forward, "__module__", "").startswith("unsloth"):
+            return True
+    return False
+
+
+def template_preamble(template: str) -> str:
+    """The constant text of a prompt template, up to its first {field}"""
+    return template[:template.index("{")]
+
+
+@dataclass
+class PrefixEntry:
+    ids: Tuple[int, ...]
+    keys: List[torch.Tensor]  # Per layer [1, kv_heads, P, head_dim]
+    values: List[torch.Tensor]
+    hidden: Optional[torch.Tensor] = None  # Final decoder states [1, P, hidden] (perplexity scoring)
+    config: object = None  # Model config, for the cache layer types
+
+    def __len__(self):
+        return len(self.ids)
+
+    def matches(self, ids: Sequence[int]) -> bool:
+        """True if `ids` starts with this prefix and has at least one token after it"""
+        return len(ids) > len(self.ids) and tuple(ids[:len(self.ids)]) == self.ids
+
+    def cache(self, batch_size: int) -> DynamicCache:
+        """A new DynamicCache holding the prefix for `batch_size` rows"""
+        return DynamicCache([(k.expand(batch_size, -1, -1, -1), v.expand(batch_size, -1, -1, -1))
+                             for k, v in zip(self.keys, self.values)], config=self.config)
+
+    def attention_mask(self, suffix_mask: torch.Tensor) -> torch.Tensor:
+        """Mask over prefix + suffix columns for a batch of suffix masks"""
+        ones = suffix_mask.new_ones((suffix_mask.shape[0], len(self.ids)))
+        return torch.cat([ones, suffix_mask], dim=1)
+
+
+def compute_prefix(model, ids: Sequence[int]) -> PrefixEntry:
+    """Run the decoder over `ids` with the model's current weights/adapter state"""
+    with torch.no_grad():
+        outputs = model.get_decoder()(
+            input_ids=torch.tensor([list(ids)], device=model.device),
+            past_key_values=DynamicCache(config=model.config),
+            use_cache=True,
+        )
+    cache = outputs.past_key_values  # The returned cache, not the one passed in
+    if isinstance(cache, (tuple, list)):
+        keys, values = [k for k, _ in cache], [v for _, v in cache]
+    else:
+        keys, values = [layer.keys for layer in cache.layers], [layer.values for layer in cache.layers]
+    return PrefixEntry(tuple(ids), keys, values, outputs.last_hidden_state, model.config)
+
+
+def row_entry(cache: DynamicCache, row: int, columns: torch.Tensor, ids: Sequence[int], config=None) -> PrefixEntry:
+    """Prefix entry for `ids` from one row of a prefilled batch cache: its unmasked `columns`, copied"""
+    keys = [layer.keys[row:row + 1, :, columns] for layer in cache.layers]
+    values = [layer.values[row:row + 1, :, columns] for layer in cache.layers]
+    return PrefixEntry(tuple(ids), keys, values, config=config)
+
+
+class PrefixCache:
+    """LRU of PrefixEntry per (state, token ids) within a token budget; pinned entries stay."""
+
+    def __init__(self, max_tokens: int = PREFIX_CACHE_TOKENS):
+        self.max_tokens = max_tokens
+        self.entries = OrderedDict()
+        self.pinned = set()
+        self.tokens = 0
+        self.stats = {"hits": 0, "misses": 0, "reused_tokens": 0, "evicted": 0}
+
+    def lookup(self, state: str, ids: Sequence[int]) -> Optional[PrefixEntry]:
+        """Longest cached prefix of `ids` for `state` (always shorter than `ids`)"""
+        best = None
+        for (entry_state, _), entry in self.entries.items():
+            if entry_state == state and (best is None or len(entry) > len(best)) and entry.matches(ids):
+                best = entry
+        if best is None:
+            self.stats["misses"] += 1
+            return None
+        self.entries.move_to_end((state, best.ids))
+        self.stats["hits"] += 1
+        self.stats["reused_tokens"] += len(best)
+        return best
+
+    def get(self, model, state: str, ids: Sequence[int], pin: bool = False) -> PrefixEntry:
+        """The entry for exactly `ids`, computed with `model` as it is now if missing"""
+        key = (state, tuple(ids))
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return self.entries[key]
+        entry = compute_prefix(model, ids)
+        self.put(state, entry, pin)
+        return entry
+
+    def put(self, state: str, entry: PrefixEntry, pin: bool = False):
+        key = (state, entry.ids)
+        if pin:
+            self.pinned.add(key)
+        if key in self.entries:
+            return
+        self.entries[key] = entry
+        self.tokens += len(entry)
+        for old in list(self.entries):
+            if self.tokens <= self.max_tokens:
+                break
+            if old not in self.pinned and old != key:
+                self.tokens -= len(self.entries.pop(old))
+                self.stats["evicted"] += 1
+
+    def clear(self, state: Optional[str] = None):
+        """Drop the entries of `state` (all states if None), e.g. after the weights changed"""
+        for key in [k for k in self.entries if state is None or k[0] == state]:
+            self.tokens -= len(self.entries.pop(key))
+            self.pinned.discard(key)
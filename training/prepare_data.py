@@ -4,12 +4,20 @@ Data Preparation Script for Unsloth Fine-tuning
 Prepares synthetic geriatric data for training Qwen 1.7B
 """
 
+import hashlib
 import json
+import os
 import random
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
-from typing import Dict, List
+from typing import Dict, Iterator, List, Tuple
+import numpy as np
 from datasets import Dataset
 
+from near_dedup import (BANDS, NUM_PERM, SIMILARITY_THRESHOLD, MinHasher, cluster,
+                        cluster_report, leakage)
+
 # Paths - Lightning.ai compatible (current directory)
 DATA_DIR = Path(".")
 OUTPUT_DIR = Path("./data")
@@ -19,6 +27,22 @@ INPUT_FILE = "synthetic_geriatric_data (2).jsonl"
 TRAIN_SPLIT = 0.9
 RANDOM_SEED = 42
 
+# Streaming mode: constant memory, parallel formatting, hash-based split.
+# Output depends only on the input and RANDOM_SEED (not on NUM_WORKERS).
+STREAMING = True  # False = original load-all / shuffle / split pipeline
+NUM_WORKERS = os.cpu_count() or 1
+CHUNK_LINES = 20_000  # Input lines per work unit
+MAX_PENDING_CHUNKS = 2  # Per worker: bounds memory to ~(workers * 2) chunks
+MIN_OUTPUT_CHARS = 10
+
+# Near-duplicate clustering (see near_dedup.py): split by cluster so no
+# cluster straddles train/validation, and keep one sample per cluster
+DEDUP = True
+DEDUP_COLLAPSE = True  # False = keep every member, only split by cluster
+
+# Pre-tokenize train/validation into data/token_cache/ (see token_cache.py)
+TOKENIZE = True
+
 # Alpaca-style prompt template for Qwen
 ALPACA_PROMPT = """Below is an instruction that describes a task, paired with an input that provides further context. Write a response that appropriately completes the request.
 
@@ -43,7 +67,7 @@ def load_jsonl(file_path: Path) -> List[Dict]:
             try:
                 sample = json.loads(line.strip())
                 # Filter out samples with missing or empty outputs
-                if not sample.get("output") or len(sample.get("output", "").strip()) < 10:
+                if not sample.get("output") or len(sample.get("output", "").strip()) < MIN_OUTPUT_CHARS:
                     skipped += 1
                     continue
                 data.append(sample)
@@ -63,11 +87,11 @@ def format_sample(sample: Dict) -> Dict:
     return {
         "text": ALPACA_PROMPT.format(
             instruction=sample["instruction"],
-            input=sample.get("input", ""),
+            input=sample.get("input") or "",
             output=sample["output"]
         ),
         "instruction": sample["instruction"],
-        "input": sample.get("input", ""),
+        "input": sample.get("input") or "",
         "output": sample["output"]
     }
 
@@ -88,6 +112,53 @@ def split_data(data: List[Dict], train_ratio: float = 0.9) -> tuple:
     return train_data, val_data
 
 
+def dedup_in_memory(data: List[Dict]) -> Tuple[List[Dict], np.ndarray, Dict]:
+    """Cluster near-duplicates; measure leakage of the plain split_data split and collapse clusters."""
+    print(f"\n🧬 Clustering near-duplicates (MinHash {NUM_PERM} perms, {BANDS} bands, "
+          f"similarity >= {SIMILARITY_THRESHOLD})...")
+    roots = cluster(MinHasher().signatures(data))
+    report = cluster_report(roots)
+    
+    # split_data's shuffle depends only on the length and the seed
+    order = list(range(len(data)))
+    random.seed(RANDOM_SEED)
+    random.shuffle(order)
+    is_validation = np.zeros(len(data), dtype=bool)
+    is_validation[order[int(len(data) * TRAIN_SPLIT):]] = True
+    report["leakage_before"] = leakage(roots, is_validation)
+    
+    report["collapsed"] = DEDUP_COLLAPSE
+    if DEDUP_COLLAPSE:
+        keep = np.flatnonzero(roots == np.arange(len(roots)))
+        data, roots = [data[i] for i in keep], roots[keep]
+    return data, roots, report
+
+
+def split_by_cluster(data: List[Dict], roots: np.ndarray, train_ratio: float = 0.9) -> tuple:
+    """split_data over whole clusters: shuffle clusters, fill train up to the ratio."""
+    members = {}
+    for i, root in enumerate(roots.tolist()):
+        members.setdefault(root, []).append(i)
+    clusters = list(members)
+    random.seed(RANDOM_SEED)
+    random.shuffle(clusters)
+    
+    train_idx, val_idx = [], []
+    for root in clusters:
+        target = train_idx if len(train_idx) < train_ratio * len(data) else val_idx
+        target.extend(members[root])
+    train_data = [data[i] for i in train_idx]
+    val_data = [data[i] for i in val_idx]
+    
+    print(f"\n📊 Data Split (by near-duplicate cluster):")
+    print(f"   Training: {len(train_data)} samples ({100 * len(train_data) / max(len(data), 1):.1f}%)")
+    print(f"   Validation: {len(val_data)} samples ({100 * len(val_data) / max(len(data), 1):.1f}%)")
+    
+    is_validation = np.zeros(len(data), dtype=bool)
+    is_validation[val_idx] = True
+    return train_data, val_data, leakage(roots, is_validation)
+
+
 def save_jsonl(data: List[Dict], output_path: Path):
     """Save data to JSONL file"""
     output_path.parent.mkdir(parents=True, exist_ok=True)
@@ -118,7 +189,7 @@ def validate_data(data: List[Dict]):
                 issues.append(f"Sample {i}: Missing or empty '{field}'")
         
         # Check reasonable length
-        if len(sample.get("output", "")) < 10:
+        if len(sample.get("output", "")) < MIN_OUTPUT_CHARS:
             issues.append(f"Sample {i}: Output too short ({len(sample['output'])} chars)")
     
     if issues:
@@ -133,6 +204,286 @@ def validate_data(data: List[Dict]):
     return len(issues) == 0
 
 
+def split_for(sample: Dict, train_ratio: float = TRAIN_SPLIT, seed: int = RANDOM_SEED) -> str:
+    """
+    Deterministic train/validation assignment from the sample's content.
+    
+    Replaces the global shuffle: the split is a pure function of
+    (seed, instruction, input, output), so it needs no memory, parallelizes
+    trivially, and exact duplicates always land on the same side.
+    """
+    key = "\x1f".join((sample["instruction"], sample.get("input") or "", sample["output"]))
+    digest = hashlib.blake2b(key.encode("utf-8"), digest_size=8, key=str(seed).encode("utf-8")).digest()
+    return "train" if int.from_bytes(digest, "big") / 2**64 < train_ratio else "validation"
+
+
+def read_chunks(file_path: Path, chunk_lines: int = CHUNK_LINES) -> Iterator[Tuple[int, List[bytes]]]:
+    """Yield (first line number, raw lines) work units without reading the whole file."""
+    with open(file_path, 'rb') as f:
+        lines = []
+        first = 1
+        for i, line in enumerate(f, 1):
+            lines.append(line)
+            if len(lines) >= chunk_lines:
+                yield first, lines
+                lines, first = [], i + 1
+        if lines:
+            yield first, lines
+
+
+def valid_samples(first: int, lines: List[bytes], result: Dict) -> Iterator[Tuple[int, Dict]]:
+    """(line number, sample) for lines passing the load/validate filters; counts the rest in result."""
+    for line_no, raw in enumerate(lines, first):
+        try:
+            sample = json.loads(raw.decode("utf-8").strip())
+        except (json.JSONDecodeError, UnicodeDecodeError) as e:
+            result["skipped"] += 1
+            if len(result["messages"]) < 10:
+                result["messages"].append(f"Skipping line {line_no}: {e}")
+            continue
+        # Same filter as load_jsonl
+        if not sample.get("output") or len(sample.get("output", "").strip()) < MIN_OUTPUT_CHARS:
+            result["skipped"] += 1
+            continue
+        result["loaded"] += 1
+        # Same checks as validate_data; samples that would break format_sample are dropped
+        if not sample.get("instruction"):
+            result["invalid"] += 1
+            if len(result["issues"]) < 10:
+                result["issues"].append(f"Line {line_no}: Missing or empty 'instruction'")
+            continue
+        yield line_no, sample
+
+
+def new_chunk_result() -> Dict:
+    return {"loaded": 0, "skipped": 0, "invalid": 0, "duplicates": 0,
+            "messages": [], "issues": [], "first_train": None}
+
+
+def process_chunk(work: Tuple) -> Dict:
+    """
+    Parse, filter, validate, format and split one chunk (runs in a worker).
+    
+    Work is (first line, lines) or (first line, lines, assignment); an
+    assignment maps line number -> split from the dedup plan, and lines
+    missing from it are dropped as duplicates.
+    
+    Returns the serialized train/validation lines for the chunk plus
+    counts and the first few messages, so the parent only concatenates.
+    """
+    first, lines = work[:2]
+    assignment = work[2] if len(work) > 2 else None
+    out = {"train": [], "validation": []}
+    result = new_chunk_result()
+    
+    for line_no, sample in valid_samples(first, lines, result):
+        formatted = format_sample(sample)
+        if assignment is None:
+            split = split_for(formatted)
+        elif line_no in assignment:
+            split = assignment[line_no]
+        else:
+            result["duplicates"] += 1
+            continue
+        out[split].append(json.dumps(formatted, ensure_ascii=False) + '\n')
+        if split == "train" and result["first_train"] is None:
+            result["first_train"] = formatted["text"]
+    
+    for split, rows in out.items():
+        result[split] = len(rows)
+        result[split + "_bytes"] = "".join(rows).encode("utf-8")
+    return result
+
+
+def signature_chunk(work: Tuple[int, List[bytes]]) -> Dict:
+    """MinHash one chunk (runs in a worker): line numbers, signatures, sample-level split."""
+    first, lines = work
+    line_nos, samples = [], []
+    for line_no, sample in valid_samples(first, lines, new_chunk_result()):
+        line_nos.append(line_no)
+        samples.append(sample)
+    return {
+        "line_nos": np.array(line_nos, dtype=np.int64),
+        "signatures": MinHasher().signatures(samples),
+        "is_validation": np.array([split_for(s) == "validation" for s in samples], dtype=bool),
+    }
+
+
+def plan_dedup(input_file: Path, workers: int = NUM_WORKERS) -> Tuple[np.ndarray, np.ndarray, Dict]:
+    """
+    First pass: cluster the corpus and decide each kept line's split.
+    
+    A cluster goes to the split its earliest member hashes to, so the
+    whole cluster lands on one side. Returns (kept line numbers, matching
+    is-validation flags, report).
+    """
+    print(f"🧬 Clustering near-duplicates (MinHash {NUM_PERM} perms, {BANDS} bands, "
+          f"similarity >= {SIMILARITY_THRESHOLD})...")
+    parts = list(iter_processed(input_file, workers, fn=signature_chunk))
+    line_nos = np.concatenate([p["line_nos"] for p in parts])
+    signatures = np.concatenate([p["signatures"] for p in parts])
+    is_validation = np.concatenate([p["is_validation"] for p in parts])
+    del parts
+    
+    roots = cluster(signatures)
+    del signatures
+    report = cluster_report(roots)
+    report["leakage_before"] = leakage(roots, is_validation)
+    
+    cluster_validation = is_validation[roots]  # Follow the earliest member
+    keep = roots == np.arange(len(roots)) if DEDUP_COLLAPSE else np.ones(len(roots), dtype=bool)
+    report["leakage_after"] = leakage(roots[keep], cluster_validation[keep])
+    report["collapsed"] = DEDUP_COLLAPSE
+    return line_nos[keep], cluster_validation[keep], report
+
+
+def print_dedup_report(report: Dict):
+    before, after = report["leakage_before"], report["leakage_after"]
+    print(f"\n🧬 Near-duplicate clusters:")
+    print(f"   Samples: {report['samples']} -> {report['clusters']} clusters "
+          f"({report['duplicate_clusters']} with duplicates, largest {report['largest_cluster']})")
+    if report["collapsed"]:
+        print(f"   Removed: {report['duplicates_removed']} duplicates ({100 * report['dedup_ratio']:.1f}%)")
+    print(f"   Leakage with per-sample split: {before['straddling_clusters']} clusters straddle train/validation, "
+          f"{before['leaked_validation_samples']}/{before['validation_samples']} validation samples have a train near-duplicate")
+    print(f"   Leakage with per-cluster split: {after['straddling_clusters']} clusters, "
+          f"{after['leaked_validation_samples']} validation samples")
+
+
+def assigned_chunks(file_path: Path, line_nos: np.ndarray, is_validation: np.ndarray) -> Iterator[Tuple]:
+    """read_chunks plus each chunk's slice of the dedup plan."""
+    for first, lines in read_chunks(file_path):
+        lo, hi = np.searchsorted(line_nos, [first, first + len(lines)])
+        splits = np.where(is_validation[lo:hi], "validation", "train")
+        yield first, lines, dict(zip(line_nos[lo:hi].tolist(), splits.tolist()))
+
+
+def iter_processed(file_path: Path, workers: int = NUM_WORKERS, fn=process_chunk,
+                   chunks: Iterator[Tuple] = None) -> Iterator[Dict]:
+    """Chunk results in input order, with at most workers * MAX_PENDING_CHUNKS in flight."""
+    chunks = read_chunks(file_path) if chunks is None else chunks
+    if workers <= 1:
+        yield from map(fn, chunks)
+        return
+    
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = deque()
+        for chunk in chunks:
+            pending.append(pool.submit(fn, chunk))
+            if len(pending) >= workers * MAX_PENDING_CHUNKS:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def prepare_streaming(input_file: Path, output_dir: Path, workers: int = NUM_WORKERS) -> Dict:
+    """Input chunks -> worker pool -> train/validation JSONL (plus a clustering pass if DEDUP)."""
+    print(f"📂 Streaming {input_file} ({workers} worker(s), {CHUNK_LINES} lines/chunk)")
+    output_dir.mkdir(parents=True, exist_ok=True)
+    totals = {"loaded": 0, "skipped": 0, "invalid": 0, "duplicates": 0, "train": 0, "validation": 0}
+    messages, issues = [], []
+    first_train = None
+    
+    chunks, report = None, None
+    if DEDUP:
+        line_nos, is_validation, report = plan_dedup(input_file, workers)
+        chunks = assigned_chunks(input_file, line_nos, is_validation)
+    
+    with open(output_dir / "train.jsonl", 'wb') as train_f, \
+         open(output_dir / "validation.jsonl", 'wb') as val_f:
+        for result in iter_processed(input_file, workers, chunks=chunks):
+            train_f.write(result["train_bytes"])
+            val_f.write(result["validation_bytes"])
+            for key in totals:
+                totals[key] += result[key]
+            messages.extend(result["messages"][:10 - len(messages)])
+            issues.extend(result["issues"][:10 - len(issues)])
+            first_train = first_train or result["first_train"]
+    
+    for message in messages:
+        print(f"⚠️  {message}")
+    print(f"✅ Loaded {totals['loaded']} valid samples")
+    if totals["skipped"] > 0:
+        print(f"⚠️  Skipped {totals['skipped']} samples with missing/empty outputs")
+    if issues:
+        print(f"⚠️  Dropped {totals['invalid']} samples failing validation:")
+        for issue in issues:
+            print(f"   - {issue}")
+    
+    if report is not None:
+        print_dedup_report(report)
+    
+    kept = totals["train"] + totals["validation"]
+    basis = "earliest member of each near-duplicate cluster" if report is not None else "sample content"
+    print(f"\n📊 Data Split (hash of {basis}, seed {RANDOM_SEED}):")
+    print(f"   Training: {totals['train']} samples ({100 * totals['train'] / max(kept, 1):.1f}%)")
+    print(f"   Validation: {totals['validation']} samples ({100 * totals['validation'] / max(kept, 1):.1f}%)")
+    print(f"💾 Saved to: {output_dir / 'train.jsonl'}")
+    print(f"💾 Saved to: {output_dir / 'validation.jsonl'}")
+    totals["first_train"] = first_train
+    totals["dedup"] = report
+    return totals
+
+
+def build_token_cache(output_dir: Path = OUTPUT_DIR):
+    """Tokenize the written splits once so training and evaluation skip it."""
+    import token_cache
+    
+    tokenizer_dir = token_cache.resolve_tokenizer_dir()
+    if tokenizer_dir is None:
+        print(f"\n⚠️  No tokenizer found in {[str(d) for d in token_cache.TOKENIZER_SEARCH_DIRS]}; skipping token cache")
+        return None
+    
+    from transformers import AutoTokenizer
+    tokenizer = AutoTokenizer.from_pretrained(str(tokenizer_dir))
+    key = token_cache.cache_key(tokenizer_dir, ALPACA_PROMPT)
+    if token_cache.load_token_cache(output_dir, key, tokenizer) is not None:
+        return token_cache.cache_dir_for(output_dir, key)
+    print(f"\n🔤 Building token cache with tokenizer from {tokenizer_dir}...")
+    return token_cache.build_token_cache(output_dir, tokenizer, key, ALPACA_PROMPT)
+
+
+def main_streaming():
+    print("="*70)
+    print("ZIMA GERIATRIC HEALTH ASSISTANT - DATA PREPARATION (STREAMING)")
+    print("="*70)
+    
+    totals = prepare_streaming(Path(INPUT_FILE), OUTPUT_DIR)
+    
+    dataset_info = {
+        "total_samples": totals["loaded"],
+        "train_samples": totals["train"],
+        "val_samples": totals["validation"],
+        "train_split": TRAIN_SPLIT,
+        "random_seed": RANDOM_SEED,
+        "split_method": "hash_by_cluster" if totals["dedup"] else "hash",
+        "dedup": totals["dedup"],
+        "source_file": str(INPUT_FILE),
+        "fields": ["text", "instruction", "input", "output"]
+    }
+    
+    with open(OUTPUT_DIR / "dataset_info.json", 'w') as f:
+        json.dump(dataset_info, f, indent=2)
+    
+    cache_dir = build_token_cache(OUTPUT_DIR) if TOKENIZE else None
+    
+    if totals["first_train"]:
+        print(f"\n📄 Sample formatted data:")
+        print("-" * 70)
+        print(totals["first_train"][:500] + "...")
+        print("-" * 70)
+    
+    print(f"\n✅ Data preparation complete!")
+    print(f"\n📁 Output directory: {OUTPUT_DIR}")
+    print(f"   - train.jsonl ({totals['train']} samples)")
+    print(f"   - validation.jsonl ({totals['validation']} samples)")
+    print(f"   - dataset_info.json")
+    if cache_dir is not None:
+        print(f"   - {cache_dir.relative_to(OUTPUT_DIR)}/ (pre-tokenized)")
+    print(f"\n🚀 Ready for training!")
+    print("="*70)
+
+
 def main():
     print("="*70)
     print("ZIMA GERIATRIC HEALTH ASSISTANT - DATA PREPARATION")
@@ -149,8 +500,14 @@ def main():
     print(f"\n🔄 Formatting {len(raw_data)} samples with Alpaca template...")
     formatted_data = [format_sample(sample) for sample in raw_data]
     
-    # Split
-    train_data, val_data = split_data(formatted_data, TRAIN_SPLIT)
+    # Dedup + split
+    report = None
+    if DEDUP:
+        formatted_data, roots, report = dedup_in_memory(formatted_data)
+        train_data, val_data, report["leakage_after"] = split_by_cluster(formatted_data, roots, TRAIN_SPLIT)
+        print_dedup_report(report)
+    else:
+        train_data, val_data = split_data(formatted_data, TRAIN_SPLIT)
     
     # Save to JSONL
     print(f"\n💾 Saving processed data...")
@@ -171,6 +528,8 @@ def main():
         "val_samples": len(val_data),
         "train_split": TRAIN_SPLIT,
         "random_seed": RANDOM_SEED,
+        "split_method": "shuffle_by_cluster" if report else "shuffle",
+        "dedup": report,
         "source_file": str(INPUT_FILE),
         "fields": ["text", "instruction", "input", "output"]
     }
@@ -178,6 +537,9 @@ def main():
     with open(OUTPUT_DIR / "dataset_info.json", 'w') as f:
         json.dump(dataset_info, f, indent=2)
     
+    # Pre-tokenize
+    cache_dir = build_token_cache(OUTPUT_DIR) if TOKENIZE else None
+    
     # Print sample
     print(f"\n📄 Sample formatted data:")
     print("-" * 70)
@@ -190,9 +552,14 @@ def main():
     print(f"   - train.jsonl ({len(train_data)} samples)")
     print(f"   - validation.jsonl ({len(val_data)} samples)")
     print(f"   - dataset_info.json")
+    if cache_dir is not None:
+        print(f"   - {cache_dir.relative_to(OUTPUT_DIR)}/ (pre-tokenized)")
     print(f"\n🚀 Ready for training!")
     print("="*70)
 
 
 if __name__ == "__main__":
-    main()
+    if STREAMING:
+        main_streaming()
+    else:
+        main()
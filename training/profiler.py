@@ -0,0 +1,275 @@
+#!/usr/bin/env python3
+"""
+Training Step Profiler
+TrainerCallback recording where each optimizer step spends its time and memory
+
+Per optimizer step (all gradient-accumulation micro-batches), written to
+`profile_steps.jsonl` and to TensorBoard under `profile/`:
+
+- step_time: wall time since the previous step finished (eval/save excluded)
+- dataloader_wait: fetching + collating the step's micro-batches. The
+  Trainer prefetches them before `on_step_begin`, so this is the time from
+  the last trainer event (step end, log, evaluate, save) to the step begin
+- compute_time: forward + backward of every micro-batch (and grad clipping)
+- optimizer_time: `optimizer.step()`
+- samples/sec, tokens/sec and padding ratio, from the counters of
+  BucketingTrainerMixin (token cache path); without them only samples/sec,
+  estimated from the batch size
+- memory: CUDA peak allocated/reserved per step; on CPU the process RSS,
+  its high-water mark, and the tracemalloc peak (Python heap: tokenizer,
+  collator, datasets - tensors are not traced)
+
+On CUDA each hook synchronizes first so kernel time is charged to the
+phase that queued it. `torch.profiler` traces (Chrome/TensorBoard format)
+can be captured over a window of steps with `trace_window=(first, count)`.
+`summary()` averages the steps and says which phase dominates.
+"""
+
+import json
+import resource
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+from typing import Callable, Dict, Optional, Tuple
+
+import torch
+from transformers import TrainerCallback
+
+JSONL_NAME = "profile_steps.jsonl"
+TRACE_DIR_NAME = "traces"
+TENSORBOARD_PREFIX = "profile"
+# ru_maxrss is KiB on Linux, bytes on macOS
+_MAXRSS_UNIT = 1 if sys.platform == "darwin" else 1024
+
+
+def _rss_bytes() -> Optional[int]:
+    """Current resident set size (Linux /proc; None elsewhere)."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def _mb(value) -> Optional[float]:
+    return round(value / 2**20, 1) if value is not None else None
+
+
+class TrainingProfiler(TrainerCallback):
+    """
+    Step timing, throughput and memory as JSONL + TensorBoard scalars.
+
+    `counters` returns cumulative {"samples", "tokens", "slots"} (e.g.
+    `trainer.token_counts` from BucketingTrainerMixin); per-step values are
+    the differences between steps.
+    """
+
+    def __init__(self, output_dir: Path, counters: Optional[Callable[[], Dict]] = None,
+                 trace_window: Optional[Tuple[int, int]] = None, use_tracemalloc: bool = True,
+                 tensorboard: bool = True):
+        self.output_dir = Path(output_dir)
+        self.counters = counters
+        self.trace_window = trace_window
+        self.use_tracemalloc = use_tracemalloc and not torch.cuda.is_available()
+        self.tensorboard = tensorboard
+        self.steps = []
+        self._jsonl = None
+        self._writer = None
+        self._torch_profiler = None
+        self._marks = {}
+        self._last_counts = None
+
+    # --- helpers -------------------------------------------------------
+
+    def _now(self) -> float:
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        return time.perf_counter()
+
+    def _counts(self) -> Optional[Dict]:
+        return dict(self.counters()) if self.counters is not None else None
+
+    def _open_writer(self, args):
+        if not self.tensorboard or "tensorboard" not in (args.report_to or []):
+            return None
+        try:
+            from torch.utils.tensorboard import SummaryWriter
+        except ImportError:
+            print("⚠️  tensorboard not installed; profiler writes JSONL only")
+            return None
+        return SummaryWriter(log_dir=args.logging_dir)
+
+    def _start_trace(self):
+        first, count = self.trace_window
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        trace_dir = self.output_dir / TRACE_DIR_NAME
+        # One warmup step before the window so the trace has no profiler start-up cost
+        profiler = torch.profiler.profile(
+            activities=activities,
+            schedule=torch.profiler.schedule(skip_first=max(first - 1, 0), wait=0,
+                                             warmup=1 if first > 0 else 0, active=count, repeat=1),
+            on_trace_ready=torch.profiler.tensorboard_trace_handler(str(trace_dir)),
+            record_shapes=True,
+            profile_memory=True,
+            with_stack=False,
+        )
+        profiler.start()
+        print(f"🔬 torch.profiler: steps {first}-{first + count - 1} -> {trace_dir}")
+        return profiler
+
+    def _memory(self) -> Dict:
+        if torch.cuda.is_available():
+            return {
+                "cuda_peak_allocated_mb": _mb(torch.cuda.max_memory_allocated()),
+                "cuda_peak_reserved_mb": _mb(torch.cuda.max_memory_reserved()),
+            }
+        memory = {
+            "rss_mb": _mb(_rss_bytes()),
+            "peak_rss_mb": _mb(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * _MAXRSS_UNIT),
+        }
+        if self.use_tracemalloc:
+            memory["tracemalloc_peak_mb"] = _mb(tracemalloc.get_traced_memory()[1])
+        return memory
+
+    # --- callback events -----------------------------------------------
+
+    def on_train_begin(self, args, state, control, **kwargs):
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        self._jsonl = open(self.output_dir / JSONL_NAME, "a", encoding="utf-8")
+        self._writer = self._open_writer(args)
+        if self.use_tracemalloc and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        if self.trace_window:
+            self._torch_profiler = self._start_trace()
+        self._last_counts = self._counts()
+        self._marks = {"last_event": self._now()}
+
+    def _mark_event(self):
+        self._marks["last_event"] = self._now()
+
+    def on_epoch_begin(self, args, state, control, **kwargs):
+        self._mark_event()
+
+    def on_log(self, args, state, control, **kwargs):
+        self._mark_event()
+
+    def on_evaluate(self, args, state, control, **kwargs):
+        self._mark_event()
+
+    def on_save(self, args, state, control, **kwargs):
+        self._mark_event()
+
+    def on_step_begin(self, args, state, control, **kwargs):
+        now = self._now()
+        self._marks.update(step_begin=now, pre_optimizer=None, optimizer=None)
+        if torch.cuda.is_available():
+            torch.cuda.reset_peak_memory_stats()
+        if self.use_tracemalloc:
+            tracemalloc.reset_peak()
+
+    def on_pre_optimizer_step(self, args, state, control, **kwargs):
+        self._marks["pre_optimizer"] = self._now()
+
+    def on_optimizer_step(self, args, state, control, **kwargs):
+        self._marks["optimizer"] = self._now()
+
+    def on_step_end(self, args, state, control, **kwargs):
+        now = self._now()
+        marks = self._marks
+        begin = marks.get("step_begin", now)
+        pre_optimizer = marks.get("pre_optimizer") or now
+        optimizer = marks.get("optimizer") or now
+        wait = max(begin - marks["last_event"], 0.0)
+        step_time = wait + (now - begin)
+
+        record = {
+            "step": state.global_step,
+            "epoch": round(state.epoch or 0.0, 4),
+            "step_time": round(step_time, 4),
+            "dataloader_wait": round(wait, 4),
+            "compute_time": round(pre_optimizer - begin, 4),
+            "optimizer_time": round(optimizer - pre_optimizer, 4),
+        }
+        counts = self._counts()
+        if counts is not None:
+            delta = {k: counts[k] - self._last_counts.get(k, 0) for k in counts}
+            self._last_counts = counts
+            record["samples"] = delta["samples"]
+            record["tokens"] = delta["tokens"]
+            record["tokens_per_sec"] = round(delta["tokens"] / step_time, 1) if step_time else None
+            record["padding_ratio"] = round(1 - delta["tokens"] / delta["slots"], 4) if delta["slots"] else None
+        else:
+            record["samples"] = args.train_batch_size * args.gradient_accumulation_steps * args.world_size
+        record["samples_per_sec"] = round(record["samples"] / step_time, 2) if step_time else None
+        record.update(self._memory())
+
+        self.steps.append(record)
+        self._jsonl.write(json.dumps(record) + "\n")
+        self._jsonl.flush()
+        if self._writer is not None:
+            for name, value in record.items():
+                if name not in ("step", "epoch") and value is not None:
+                    self._writer.add_scalar(f"{TENSORBOARD_PREFIX}/{name}", value, state.global_step)
+        if self._torch_profiler is not None:
+            self._torch_profiler.step()
+        marks["last_event"] = self._now()
+
+    def on_train_end(self, args, state, control, **kwargs):
+        if self._torch_profiler is not None:
+            self._torch_profiler.stop()
+            self._torch_profiler = None
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        if self._jsonl is not None:
+            self._jsonl.close()
+            self._jsonl = None
+        if self.use_tracemalloc and tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+    # --- summary -------------------------------------------------------
+
+    def summary(self, skip_first: int = 1) -> Optional[Dict]:
+        """Mean phase times and rates over the recorded steps (the first is warmup)."""
+        steps = self.steps[skip_first:] or self.steps
+        if not steps:
+            return None
+        total = sum(s["step_time"] for s in steps) or 1e-9
+        shares = {
+            phase: sum(s[phase] for s in steps) / total
+            for phase in ("dataloader_wait", "compute_time", "optimizer_time")
+        }
+        summary = {
+            "steps": len(steps),
+            "mean_step_time": total / len(steps),
+            "samples_per_sec": sum(s["samples"] for s in steps) / total,
+            "share": {phase: round(share, 4) for phase, share in shares.items()},
+            "bound_by": max(shares, key=shares.get).replace("_time", "").replace("_wait", ""),
+        }
+        if "tokens" in steps[0]:
+            summary["tokens_per_sec"] = sum(s["tokens"] for s in steps) / total
+        for key in ("cuda_peak_allocated_mb", "peak_rss_mb", "tracemalloc_peak_mb"):
+            values = [s[key] for s in steps if s.get(key) is not None]
+            if values:
+                summary[key] = max(values)
+        return summary
+
+
+def print_profile_summary(summary: Optional[Dict]):
+    if summary is None:
+        return
+    share = summary["share"]
+    print(f"\n🔬 Step profile ({summary['steps']} steps, {summary['mean_step_time']:.3f}s/step):")
+    print(f"   Dataloader {share['dataloader_wait']:.1%} | compute {share['compute_time']:.1%} | "
+          f"optimizer {share['optimizer_time']:.1%} -> bound by {summary['bound_by']}")
+    rates = f"   {summary['samples_per_sec']:.1f} samples/sec"
+    if "tokens_per_sec" in summary:
+        rates += f", {summary['tokens_per_sec']:,.0f} tokens/sec"
+    print(rates)
+    for key, label in (("cuda_peak_allocated_mb", "CUDA peak"), ("peak_rss_mb", "Peak RSS"),
+                       ("tracemalloc_peak_mb", "Python heap peak")):
+        if key in summary:
+            print(f"   {label}: {summary[key]:,.0f} MB")
@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+"""
+Checkpoint Sweep
+Evaluate every saved LoRA checkpoint against one in-memory base model
+
+train_unsloth.py saves `checkpoint-<step>/` directories every SAVE_STEPS
+(adapter weights only, the base never changes). Instead of one
+evaluate_model.py run per checkpoint - each reloading the 1.5B base - the
+sweep loads the first checkpoint once and swaps only the LoRA tensors in
+place for the next ones (peft hotswap_adapter; incompatible adapters fall
+back to load_adapter / set_adapter). Every checkpoint is scored on the same
+validation samples and the same generation prompts with the same seed,
+through the eval cache (eval_cache.py), so re-running after a new
+checkpoint appears only evaluates that checkpoint.
+
+Output: a perplexity / latency table and outputs/checkpoint_sweep.json.
+"""
+
+import json
+import statistics
+import time
+from pathlib import Path
+from typing import Dict, List
+
+import torch
+from datasets import load_dataset
+from transformers import AutoTokenizer
+
+import evaluate_model
+from eval_cache import EvalCache, model_key
+from evaluate_model import DATA_DIR, extract_instruction_input, generate_responses, score_dataset
+from prepare_data import ALPACA_PROMPT
+from token_cache import find_token_cache
+
+# Paths - Lightning.ai compatible
+SWEEP_DIRS = [Path("./outputs/zima_qwen_geriatric"), Path("./checkpoints")]
+FINAL_MODEL_DIR = Path("./outputs/zima_qwen_geriatric/final_model")
+EVAL_CACHE_FILE = Path("./outputs/eval_cache.sqlite")
+RESULTS_FILE = Path("./outputs/checkpoint_sweep.json")
+
+# Config
+SWEEP_PERPLEXITY_SAMPLES = None  # None = the whole validation set
+SWEEP_GENERATIONS = 32  # Prompts generated per checkpoint (latency + spot checks)
+SEED = 42  # Same sampling stream for every checkpoint
+
+
+def find_checkpoints(search_dirs: List[Path] = SWEEP_DIRS, final_model: Path = FINAL_MODEL_DIR) -> List[Path]:
+    """checkpoint-<step> adapter directories in step order, then the final model"""
+    found = {}
+    for directory in search_dirs:
+        for path in directory.glob("checkpoint-*"):
+            step = path.name.split("-")[-1]
+            if step.isdigit() and (path / "adapter_config.json").exists():
+                found[path.resolve()] = int(step)
+    checkpoints = sorted(found, key=found.get)
+    if (final_model / "adapter_config.json").exists():
+        checkpoints.append(final_model.resolve())
+    return checkpoints
+
+
+class AdapterSwapper:
+    """One base model in memory; the active LoRA weights are replaced per checkpoint."""
+
+    def __init__(self, loader=lambda path: evaluate_model.load_model(path)[0]):
+        self.loader = loader
+        self.model = None
+        self.current = None
+        self.load_seconds = None
+        self.swap_seconds = {}
+        self.busy_seconds = 0.0  # load + swaps, to keep them out of generation throughput
+
+    def activate(self, checkpoint: Path):
+        if self.current == checkpoint:
+            return self.model
+        start = time.perf_counter()
+        if self.model is None:
+            self.model = self.loader(checkpoint)
+            self.load_seconds = time.perf_counter() - start
+        else:
+            self._swap(checkpoint)
+            self.swap_seconds[checkpoint] = time.perf_counter() - start
+            print(f"🔁 Swapped in {checkpoint.name} ({self.swap_seconds[checkpoint]:.2f}s)")
+        self.busy_seconds += time.perf_counter() - start
+        self.current = checkpoint
+        return self.model
+
+    def _swap(self, checkpoint: Path):
+        from peft.utils.hotswap import hotswap_adapter
+
+        adapter_name = self.model.active_adapter
+        try:
+            hotswap_adapter(self.model, str(checkpoint), adapter_name=adapter_name, torch_device=str(self.model.device))
+        except (ValueError, RuntimeError, KeyError) as e:
+            # Different rank / alpha / target modules: load it next to the current adapter
+            print(f"⚠️  {checkpoint.name} cannot be hot-swapped ({e}); loading it as a new adapter")
+            new_name = f"sweep_{len(self.swap_seconds)}"
+            self.model.load_adapter(str(checkpoint), adapter_name=new_name)
+            self.model.set_adapter(new_name)
+            self.model.delete_adapter(adapter_name)
+
+
+def print_sweep_table(rows: List[Dict]):
+    print(f"\n{'checkpoint':<20} {'perplexity':>11} {'loss':>8} {'gen p50':>9} {'tok/s':>8} {'swap':>7} {'cached':>8}")
+    print("-" * 76)
+    best = min(rows, key=lambda r: r["perplexity"])
+    for r in rows:
+        swap = f"{r['swap_seconds']:.2f}s" if r["swap_seconds"] is not None else "-"
+        tokens_per_sec = f"{r['tokens_per_sec']:.1f}" if r["tokens_per_sec"] is not None else "-"
+        marker = "  ⭐" if r is best else ""
+        print(f"{r['checkpoint']:<20} {r['perplexity']:>11.3f} {r['mean_loss']:>8.4f} "
+              f"{r['generation_p50']:>8.2f}s {tokens_per_sec:>8} {swap:>7} {r['cached']:>8}{marker}")
+
+
+def main():
+    print("="*70)
+    print("ZIMA GERIATRIC HEALTH ASSISTANT - CHECKPOINT SWEEP")
+    print("="*70)
+
+    checkpoints = find_checkpoints(SWEEP_DIRS, FINAL_MODEL_DIR)
+    if not checkpoints:
+        print(f"❌ No checkpoint-*/ adapters under {[str(d) for d in SWEEP_DIRS]}")
+        return
+    print(f"\n📂 {len(checkpoints)} checkpoints: {', '.join(c.name for c in checkpoints)}")
+
+    dataset = load_dataset(
+        "json",
+        data_files={"validation": str(DATA_DIR / "validation.jsonl")}
+    )["validation"]
+    tokenizer = AutoTokenizer.from_pretrained(str(checkpoints[0]))
+    cached = find_token_cache(DATA_DIR, ALPACA_PROMPT, tokenizer, splits=("validation",))
+    token_dataset = cached["validation"] if cached is not None else None
+    prompts = [extract_instruction_input(dataset[i]["text"]) for i in range(min(SWEEP_GENERATIONS, len(dataset)))]
+
+    cache = EvalCache(EVAL_CACHE_FILE)
+    swapper = AdapterSwapper()
+    rows = []
+    sweep_start = time.time()
+    for checkpoint in checkpoints:
+        print(f"\n{'-'*70}\n🔎 {checkpoint.name}")
+        key = model_key(checkpoint)
+        cache.register_model(key, checkpoint)
+        activate = lambda: swapper.activate(checkpoint)
+
+        start = time.time()
+        scores = score_dataset(activate, tokenizer, dataset, SWEEP_PERPLEXITY_SAMPLES, token_dataset,
+                               cache=cache, cache_model=key)
+        torch.manual_seed(SEED)
+        gen_start, busy = time.perf_counter(), swapper.busy_seconds
+        generated = generate_responses(activate, tokenizer, prompts, cache=cache, cache_model=key)
+        gen_time = time.perf_counter() - gen_start - (swapper.busy_seconds - busy)
+        fresh = [g for g in generated if not g["cached"]]
+
+        rows.append({
+            "checkpoint": checkpoint.name,
+            "path": str(checkpoint),
+            "perplexity": scores["perplexity"],
+            "mean_loss": scores["mean_loss"],
+            "tokens": scores["tokens"],
+            "generation_p50": statistics.median(g["latency"] for g in generated),
+            "tokens_per_sec": sum(g["tokens"] for g in fresh) / gen_time if fresh and gen_time > 0 else None,
+            "swap_seconds": swapper.swap_seconds.get(checkpoint),
+            "eval_seconds": time.time() - start,
+            "cached": f"{scores['cached_samples'] + len(generated) - len(fresh)}/{scores['samples'] + len(generated)}",
+        })
+        print(f"📈 Perplexity: {scores['perplexity']:.3f}")
+    cache.close()
+
+    print("\n" + "="*70)
+    print("CHECKPOINT COMPARISON")
+    print("="*70)
+    print_sweep_table(rows)
+    best = min(rows, key=lambda r: r["perplexity"])
+    total = time.time() - sweep_start
+    if swapper.load_seconds is not None:
+        print(f"\n⏱️  Base load once: {swapper.load_seconds:.1f}s, "
+              f"{len(swapper.swap_seconds)} swaps: {sum(swapper.swap_seconds.values()):.1f}s, sweep total {total:.1f}s")
+    else:
+        print(f"\n⏱️  Everything came from the eval cache ({total:.1f}s, no model loaded)")
+    print(f"⭐ Best: {best['checkpoint']} (perplexity {best['perplexity']:.3f})")
+
+    RESULTS_FILE.parent.mkdir(parents=True, exist_ok=True)
+    with open(RESULTS_FILE, 'w', encoding='utf-8') as f:
+        json.dump({
+            "validation_samples": len(dataset),
+            "generation_prompts": len(prompts),
+            "base_load_seconds": swapper.load_seconds,
+            "sweep_seconds": total,
+            "best": best["checkpoint"],
+            "checkpoints": rows,
+        }, f, indent=2)
+    print(f"💾 Results: {RESULTS_FILE}")
+
+
+if __name__ == "__main__":
+    main()
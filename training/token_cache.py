@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+"""
+Pre-tokenized, Memory-Mapped Dataset Cache
+Tokenize train/validation once in prepare_data.py; train and evaluate from the cache
+
+Layout (one directory per tokenizer + template combination):
+
+    data/token_cache/<key>/
+        meta.json            # key, source file digests, counts, vocab size
+        train/               # Arrow dataset (datasets.save_to_disk)
+        validation/
+
+Each row stores:
+    input_ids       prompt tokens + response tokens (+ EOS), untruncated
+    length          len(input_ids)
+    response_start  index of the first response token in input_ids
+
+The prompt and the response are tokenized separately and concatenated, so
+`response_start` is exact (no BPE merge across the boundary).
+
+The key hashes the project tokenizer files (trained_model/ vocab, merges,
+added/special tokens, config), the Alpaca template and the EOS setting; a
+changed tokenizer or template lands in a new directory. meta.json also
+records a digest of each source JSONL, so re-running prepare_data.py with
+different data invalidates the cache. `load_from_disk` memory-maps the Arrow
+files, so loading is zero-copy and takes milliseconds.
+"""
+
+import hashlib
+import json
+import shutil
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional
+
+TOKEN_CACHE_VERSION = 1
+TOKENIZER_FILES = [
+    "vocab.json", "merges.txt", "tokenizer.json", "added_tokens.json",
+    "special_tokens_map.json", "tokenizer_config.json",
+]
+TOKENIZER_SEARCH_DIRS = [Path("./trained_model"), Path("../trained_model")]
+TOKENIZE_BATCH_SIZE = 1000
+APPEND_EOS = True  # Train the model to stop after the response
+SPLITS = ("train", "validation")
+
+
+def resolve_tokenizer_dir(search_dirs: List[Path] = TOKENIZER_SEARCH_DIRS) -> Optional[Path]:
+    """First directory holding the project tokenizer (vocab.json + merges.txt)."""
+    for directory in search_dirs:
+        if (directory / "vocab.json").exists() and (directory / "merges.txt").exists():
+            return directory
+    return None
+
+
+def file_digest(path: Path) -> str:
+    """blake2b of a file's bytes, read in 1 MB blocks."""
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def cache_key(tokenizer_dir: Path, template: str, append_eos: bool = APPEND_EOS) -> str:
+    """Hash of tokenizer files + prompt template + tokenization settings."""
+    h = hashlib.blake2b(digest_size=8)
+    h.update(f"v{TOKEN_CACHE_VERSION}|eos={append_eos}|".encode())
+    h.update(template.encode("utf-8"))
+    for name in TOKENIZER_FILES:
+        path = Path(tokenizer_dir) / name
+        if path.exists():
+            h.update(name.encode())
+            h.update(file_digest(path).encode())
+    return h.hexdigest()
+
+
+def cache_dir_for(data_dir: Path, key: str) -> Path:
+    return Path(data_dir) / "token_cache" / key
+
+
+def split_prompt_response(sample: Dict, template: str):
+    """(prompt text, response text) whose concatenation is the formatted `text`."""
+    prompt = template.format(
+        instruction=sample["instruction"],
+        input=sample.get("input") or "",
+        output="",
+    )
+    return prompt, sample["output"]
+
+
+def _tokenized_rows(jsonl_path: Path, tokenizer, template: str, append_eos: bool,
+                    batch_size: int) -> Iterator[Dict]:
+    """Stream rows of the cache schema, tokenizing batch_size samples per call."""
+    eos = [tokenizer.eos_token_id] if append_eos and tokenizer.eos_token_id is not None else []
+
+    def flush(batch):
+        prompts, responses = zip(*(split_prompt_response(s, template) for s in batch))
+        prompt_ids = tokenizer(list(prompts), add_special_tokens=False)["input_ids"]
+        response_ids = tokenizer(list(responses), add_special_tokens=False)["input_ids"]
+        for p, r in zip(prompt_ids, response_ids):
+            ids = p + r + eos
+            yield {"input_ids": ids, "length": len(ids), "response_start": len(p)}
+
+    batch = []
+    with open(jsonl_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            batch.append(json.loads(line))
+            if len(batch) >= batch_size:
+                yield from flush(batch)
+                batch = []
+    if batch:
+        yield from flush(batch)
+
+
+def build_token_cache(data_dir: Path, tokenizer, key: str, template: str,
+                      append_eos: bool = APPEND_EOS, batch_size: int = TOKENIZE_BATCH_SIZE) -> Path:
+    """Tokenize each split's JSONL into an Arrow dataset under data_dir/token_cache/<key>."""
+    from datasets import Dataset, Features, Sequence, Value
+
+    features = Features({
+        "input_ids": Sequence(Value("int32")),
+        "length": Value("int32"),
+        "response_start": Value("int32"),
+    })
+    final_dir = cache_dir_for(data_dir, key)
+    tmp_dir = final_dir.with_name(final_dir.name + ".tmp")
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    tmp_dir.mkdir(parents=True)
+
+    meta = {
+        "version": TOKEN_CACHE_VERSION,
+        "key": key,
+        "append_eos": append_eos,
+        "vocab_size": len(tokenizer),
+        "eos_token_id": tokenizer.eos_token_id,
+        "sources": {},
+        "rows": {},
+        "tokens": {},
+    }
+    for split in SPLITS:
+        source = Path(data_dir) / f"{split}.jsonl"
+        if not source.exists():
+            continue
+        print(f"🔤 Tokenizing {source} (batches of {batch_size})...")
+        dataset = Dataset.from_generator(
+            _tokenized_rows,
+            gen_kwargs={
+                "jsonl_path": source, "tokenizer": tokenizer, "template": template,
+                "append_eos": append_eos, "batch_size": batch_size,
+            },
+            features=features,
+            cache_dir=str(tmp_dir / ".build"),
+        )
+        dataset.save_to_disk(str(tmp_dir / split))
+        meta["sources"][split] = file_digest(source)
+        meta["rows"][split] = len(dataset)
+        meta["tokens"][split] = int(sum(dataset["length"]))
+        del dataset
+
+    shutil.rmtree(tmp_dir / ".build", ignore_errors=True)
+    with open(tmp_dir / "meta.json", 'w') as f:
+        json.dump(meta, f, indent=2)
+    shutil.rmtree(final_dir, ignore_errors=True)
+    tmp_dir.rename(final_dir)
+    print(f"💾 Token cache: {final_dir} ({meta['rows']} rows, {meta['tokens']} tokens)")
+    return final_dir
+
+
+def load_token_cache(data_dir: Path, key: str, tokenizer=None, splits=SPLITS):
+    """
+    Memory-map the cached splits, or return None if the cache is cold/stale.
+
+    Stale means: missing, built from different JSONL files, or built for a
+    tokenizer whose vocabulary size differs from `tokenizer`.
+    """
+    from datasets import DatasetDict, load_from_disk
+
+    cache_dir = cache_dir_for(data_dir, key)
+    meta_path = cache_dir / "meta.json"
+    if not meta_path.exists():
+        return None
+    with open(meta_path) as f:
+        meta = json.load(f)
+
+    if tokenizer is not None and meta.get("vocab_size") != len(tokenizer):
+        print(f"⚠️  Token cache {key} was built for a {meta.get('vocab_size')}-token vocabulary "
+              f"(tokenizer has {len(tokenizer)}); retokenizing")
+        return None
+    loaded = {}
+    for split in splits:
+        source = Path(data_dir) / f"{split}.jsonl"
+        if split not in meta["sources"] or (source.exists() and file_digest(source) != meta["sources"][split]):
+            print(f"⚠️  Token cache {key} is stale for {split}; retokenizing")
+            return None
+        loaded[split] = load_from_disk(str(cache_dir / split))
+    print(f"⚡ Token cache hit: {cache_dir} ({', '.join(f'{s}: {len(d)}' for s, d in loaded.items())})")
+    return DatasetDict(loaded)
+
+
+def find_token_cache(data_dir: Path, template: str, tokenizer=None, splits=SPLITS):
+    """Locate the project tokenizer, derive the key and load the cache (None if cold)."""
+    tokenizer_dir = resolve_tokenizer_dir()
+    if tokenizer_dir is None:
+        return None
+    return load_token_cache(data_dir, cache_key(tokenizer_dir, template), tokenizer, splits)
@@ -13,6 +13,13 @@ from transformers import TrainingArguments
 from pathlib import Path
 import json
 
+from packing import (BucketingTrainerMixin, PackedCollator, PaddedCollator, pack_dataset,
+                     padding_report, print_padding_report)
+from prefix_cache import unsloth_patched
+from prepare_data import ALPACA_PROMPT
+from profiler import TrainingProfiler, print_profile_summary
+from token_cache import find_token_cache
+
 # ============================================================================
 # CONFIGURATION
 # ============================================================================
@@ -25,6 +32,10 @@ CHECKPOINT_DIR = Path("./checkpoints")
 # Model Config
 MODEL_NAME = "unsloth/Qwen2.5-1.5B-Instruct"
 MAX_SEQ_LENGTH = 512
+USE_TOKEN_CACHE = True  # Train from data/token_cache/ when prepare_data.py built one
+SEQUENCE_PACKING = None  # Concatenate samples up to MAX_SEQ_LENGTH; needs the token cache. None = only if the model is not Unsloth-patched (boundaries unverified there)
+LENGTH_BUCKETING = True  # Batch similar lengths together (train and eval); needs the token cache
+TRAIN_ON_RESPONSES_ONLY = True  # Loss on "### Response:" tokens only (offsets from the token cache)
 DTYPE = None  # Auto-detect
 LOAD_IN_4BIT = True  # Use 4-bit quantization for efficiency
 
@@ -48,10 +59,18 @@ MAX_GRAD_NORM = 1.0
 WEIGHT_DECAY = 0.01
 LR_SCHEDULER_TYPE = "cosine"
 
+# Profiling Config
+PROFILE_STEPS = True  # Per-step timing/throughput/memory -> OUTPUT_DIR/profile/profile_steps.jsonl + TensorBoard
+TORCH_PROFILER_WINDOW = None  # (first step, steps) to capture torch.profiler traces, e.g. (20, 5)
+
 # ============================================================================
 # MAIN
 # ============================================================================
 
+class BucketedSFTTrainer(BucketingTrainerMixin, SFTTrainer):
+    """SFTTrainer with length-bucketed samplers and effective tokens/sec logging"""
+
+
 def print_gpu_stats():
     """Print GPU memory usage"""
     if torch.cuda.is_available():
@@ -166,17 +185,67 @@ def main():
         metric_for_best_model="eval_loss",
     )
     
+    # Pre-tokenized cache: skip SFTTrainer's tokenization pass entirely
+    cached = find_token_cache(DATA_DIR, ALPACA_PROMPT, tokenizer) if USE_TOKEN_CACHE else None
+    padding = None
+    packing = SEQUENCE_PACKING
+    if packing is None:
+        # Per-sample boundaries come from transformers' packed position_ids detection,
+        # which Unsloth's patched attention forward does not go through
+        packing = not unsloth_patched(model)
+    elif packing and unsloth_patched(model):
+        print("⚠️  SEQUENCE_PACKING forced on an Unsloth-patched model: cross-sample attention is not ruled out")
+    if cached is not None:
+        train_dataset, eval_dataset = cached["train"], cached["validation"]
+        print(f"\n📏 Padding per batch of {BATCH_SIZE} (max {MAX_SEQ_LENGTH} tokens):")
+        padding = {
+            name: padding_report(split["length"], BATCH_SIZE, MAX_SEQ_LENGTH)
+            for name, split in (("train", train_dataset), ("validation", eval_dataset))
+        }
+        for name, report in padding.items():
+            print_padding_report(name.capitalize(), report)
+        
+        if packing:
+            train_dataset = pack_dataset(train_dataset, MAX_SEQ_LENGTH)
+            eval_dataset = pack_dataset(eval_dataset, MAX_SEQ_LENGTH)
+            collator = PackedCollator(tokenizer.pad_token_id, MAX_SEQ_LENGTH, TRAIN_ON_RESPONSES_ONLY)
+            print(f"   📦 Packed into {len(train_dataset)} train / {len(eval_dataset)} validation rows")
+        else:
+            if SEQUENCE_PACKING is None:
+                print("   📦 Packing off: the model is Unsloth-patched (set SEQUENCE_PACKING = True to force it)")
+            collator = PaddedCollator(tokenizer.pad_token_id, MAX_SEQ_LENGTH, TRAIN_ON_RESPONSES_ONLY)
+        cache_kwargs = {
+            "data_collator": collator,
+            "dataset_kwargs": {"skip_prepare_dataset": True},
+        }
+        training_args.remove_unused_columns = False  # Collator needs input_ids / seq_lengths
+        trainer_class = BucketedSFTTrainer
+    else:
+        print("   (no token cache - tokenizing text on the fly, no packing/bucketing, loss on full text)")
+        train_dataset, eval_dataset = dataset["train"], dataset["validation"]
+        cache_kwargs = {"dataset_text_field": "text"}
+        trainer_class = SFTTrainer
+    
     # Create trainer
-    trainer = SFTTrainer(
+    trainer = trainer_class(
         model=model,
         tokenizer=tokenizer,
-        train_dataset=dataset["train"],
-        eval_dataset=dataset["validation"],
-        dataset_text_field="text",
+        train_dataset=train_dataset,
+        eval_dataset=eval_dataset,
         max_seq_length=MAX_SEQ_LENGTH,
         args=training_args,
-        packing=False,  # Don't pack samples (better for eval)
+        packing=False,  # TRL packing off: the token cache path packs with per-sample attention boundaries
+        **cache_kwargs,
     )
+    trainer.length_bucketing = LENGTH_BUCKETING
+    profiler = None
+    if PROFILE_STEPS:
+        profiler = TrainingProfiler(
+            OUTPUT_DIR / "profile",
+            counters=trainer.token_counts if cached is not None else None,
+            trace_window=TORCH_PROFILER_WINDOW,
+        )
+        trainer.add_callback(profiler)
     
     # Print memory before training
     print_gpu_stats()
@@ -188,6 +257,14 @@ def main():
     
     trainer.train()
     
+    throughput = trainer.throughput_summary() if cached is not None else None
+    if throughput is not None:
+        print(f"\n⚡ Effective throughput: {throughput['effective_tokens_per_sec']:,.0f} tokens/sec "
+              f"(padding {throughput['padding_ratio']:.1%}, packing {'on' if packing else 'off'}, "
+              f"bucketing {'on' if LENGTH_BUCKETING else 'off'})")
+    profile = profiler.summary() if profiler is not None else None
+    print_profile_summary(profile)
+    
     # Save final model
     print("\n" + "="*70)
     print("💾 SAVING MODEL")
@@ -210,6 +287,12 @@ def main():
         "lora_r": LORA_R,
         "lora_alpha": LORA_ALPHA,
         "final_loss": trainer.state.log_history[-1].get("eval_loss", "N/A"),
+        "sequence_packing": bool(packing) and cached is not None,
+        "length_bucketing": LENGTH_BUCKETING and cached is not None,
+        "loss_on": "response" if TRAIN_ON_RESPONSES_ONLY and cached is not None else "full_text",
+        "padding": padding,
+        "throughput": throughput,
+        "profile": profile,
     }
     
     with open(OUTPUT_DIR / "training_info.json", 'w') as f:
@@ -224,6 +307,8 @@ def main():
     print(f"\n📁 Output directory: {OUTPUT_DIR}")
     print(f"   - final_model/ (ready for inference)")
     print(f"   - training_info.json")
+    if profiler is not None:
+        print(f"   - profile/ (per-step timing and memory)")
     print(f"   - checkpoints/ (intermediate saves)")
     print(f"\n🎉 Your Zima geriatric health model is ready!")
 